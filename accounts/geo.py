@@ -0,0 +1,164 @@
+import math
+from dataclasses import dataclass
+
+import numpy as np
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+GEOHASH_PRECISION = 9  # ~5 м; хранится в колонке geohash
+# Сколько ячеек geohash максимум перебирать в запросе: больше ячеек — точнее префильтр, длиннее SQL
+MAX_CELLS = 16
+# Поиск по радиусу отдает не больше стольких ближайших объектов
+MAX_RESULTS = 5000
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def encode(lat, lon, precision=GEOHASH_PRECISION):
+    """Geohash точки: чередуются биты долготы и широты, по 5 бит на символ."""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        interval, coordinate = (lon_range, lon) if even else (lat_range, lat)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits = value = 0
+    return "".join(chars)
+
+
+def cell_size(precision):
+    """(высота, ширина) ячейки geohash в градусах."""
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180 / 2 ** lat_bits, 360 / 2 ** lon_bits
+
+
+def covering_cells(min_lat, min_lon, max_lat, max_lon, max_cells=MAX_CELLS):
+    """Ячейки самой мелкой точности, которые покрывают прямоугольник и которых не больше max_cells."""
+    cells = [""]
+    for precision in range(1, GEOHASH_PRECISION + 1):
+        height, width = cell_size(precision)
+        rows = range(math.floor((min_lat + 90) / height), math.floor((max_lat + 90) / height) + 1)
+        columns = range(math.floor((min_lon + 180) / width), math.floor((max_lon + 180) / width) + 1)
+        if len(rows) * len(columns) > max_cells:
+            break
+        # Ячейка по ее центру; на границе сетки (lat=90, lon=180) индекс не выходит за край
+        cells = sorted({
+            encode(min(-90 + (row + 0.5) * height, 90), min(-180 + (column + 0.5) * width, 180), precision)
+            for row in rows for column in columns
+        })
+    return cells
+
+
+def cell_ranges(cells):
+    """Соседние в порядке base32 ячейки сливаются в один диапазон [начало, конец) значений geohash."""
+    ranges = []
+    for cell in cells:
+        end = cell[:-1] + BASE32[BASE32.index(cell[-1]) + 1] if cell and cell[-1] != BASE32[-1] else cell + "~"
+        if ranges and ranges[-1][1] == cell:
+            ranges[-1][1] = end
+        else:
+            ranges.append([cell, end])
+    return ranges
+
+
+def haversine_km(lat, lon, lats, lons):
+    """Расстояния от точки до массивов точек (numpy), км."""
+    lat, lon = np.radians(lat), np.radians(lon)
+    lats, lons = np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+@dataclass
+class GeoFilter:
+    """
+    Поиск по кругу (?lat=&lon=&radius_km=) или прямоугольнику (?bbox=min_lon,min_lat,max_lon,max_lat)
+    без PostGIS: в БД — диапазоны по индексу geohash и границы прямоугольника, точное расстояние
+    до кандидатов считается векторно в numpy. Круг через антимеридиан хранится с min_lon > max_lon
+    и ищется по двум диапазонам долготы; ?bbox через антимеридиан не поддерживается.
+    """
+    min_lat: float
+    min_lon: float
+    max_lat: float
+    max_lon: float
+    center: tuple = None
+    radius_km: float = None
+
+    @classmethod
+    def from_params(cls, params):
+        """GeoFilter из параметров запроса или None, если гео-параметров нет."""
+        try:
+            if params.get('bbox'):
+                min_lon, min_lat, max_lon, max_lat = (float(value) for value in params['bbox'].split(','))
+                if not (-90 <= min_lat <= max_lat <= 90 and -180 <= min_lon <= max_lon <= 180):
+                    raise ValueError
+                return cls(min_lat, min_lon, max_lat, max_lon)
+            if params.get('lat') is None and params.get('lon') is None:
+                return None
+            lat, lon, radius = float(params['lat']), float(params['lon']), float(params.get('radius_km', 5))
+            if not (-90 <= lat <= 90 and -180 <= lon <= 180 and 0 < radius <= 1000):
+                raise ValueError
+        except (KeyError, TypeError, ValueError):
+            raise ValidationError({"geo": "Expected lat, lon and radius_km (0–1000), or bbox=min_lon,min_lat,max_lon,max_lat"})
+        dlat = radius / KM_PER_DEGREE
+        # Крайние долготы круга — там, где его касаются меридианы: asin(sin(r/R) / cos(lat)).
+        # dlat / cos(lat) у полюса заметно уже. Если круг накрывает полюс — все долготы
+        if lat + dlat >= 90 or lat - dlat <= -90:
+            ratio = 1
+        else:
+            ratio = math.sin(radius / EARTH_RADIUS_KM) / math.cos(math.radians(lat))
+        dlon = 180 if ratio >= 1 else math.degrees(math.asin(ratio))
+        if dlon >= 180:
+            min_lon, max_lon = -180, 180
+        else:
+            # Край круга за ±180 переносится на другую сторону: min_lon > max_lon
+            min_lon = lon - dlon + 360 if lon - dlon < -180 else lon - dlon
+            max_lon = lon + dlon - 360 if lon + dlon > 180 else lon + dlon
+        return cls(
+            max(-90, lat - dlat), min_lon, min(90, lat + dlat), max_lon, center=(lat, lon), radius_km=radius,
+        )
+
+    def lon_spans(self):
+        """Диапазоны долготы: один, или [min_lon, 180] и [-180, max_lon] для круга через антимеридиан."""
+        if self.min_lon <= self.max_lon:
+            return [(self.min_lon, self.max_lon)]
+        return [(self.min_lon, 180), (-180, self.max_lon)]
+
+    def prefilter(self):
+        """Условие для БД: диапазоны geohash покрывающих ячеек и сам прямоугольник, по каждому lon_spans."""
+        condition = Q()
+        for min_lon, max_lon in self.lon_spans():
+            ranges = Q()
+            for start, end in cell_ranges(covering_cells(self.min_lat, min_lon, self.max_lat, max_lon)):
+                ranges |= Q(geohash__gte=start, geohash__lt=end)
+            condition |= ranges & Q(
+                latitude__gte=self.min_lat, latitude__lte=self.max_lat,
+                longitude__gte=min_lon, longitude__lte=max_lon,
+            )
+        return condition
+
+    def apply(self, queryset):
+        """
+        (queryset, расстояния по pk). Для круга — не больше MAX_RESULTS ближайших в радиусе,
+        для прямоугольника расстояний нет (пустой словарь).
+        """
+        queryset = queryset.filter(self.prefilter())
+        if self.radius_km is None:
+            return queryset, {}
+        rows = np.array(list(queryset.values_list('pk', 'latitude', 'longitude')), dtype=float).reshape(-1, 3)
+        distances = haversine_km(*self.center, rows[:, 1], rows[:, 2])
+        inside = np.flatnonzero(distances <= self.radius_km)
+        nearest = inside[np.argsort(distances[inside], kind='stable')[:MAX_RESULTS]]
+        distances = {int(rows[i, 0]): float(distances[i]) for i in nearest}
+        return queryset.model.objects.filter(pk__in=list(distances)), distances
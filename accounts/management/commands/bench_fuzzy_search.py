@@ -0,0 +1,95 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from accounts.models import Event, User
+from accounts.search import FuzzySearch, index_trigrams
+from accounts.text import fold_text
+
+BATCH = 5000
+# Города в разных написаниях, как их вводят пользователи
+CITIES = [
+    "München", "Muenchen", "Munchen, Bayern", "Berlin", "Берлин", "Köln", "Koeln", "Київ", "Kyiv", "Tbilisi",
+    "Тбилиси", "Belgrade", "Београд", "Lisboa", "Lisbon", "Warszawa", "Kraków", "Düsseldorf", "Zürich", "Praha",
+]
+TOPICS = [
+    "Встреча эмигрантов", "Board games night", "Language exchange", "Налоги и ВНЖ", "Hiking trip", "Кинопоказ",
+    "Startup meetup", "Детский праздник", "Yoga in the park", "Разговорный клуб",
+]
+SYLLABLES = "ba ber bo da den ga gen ka kel la lin ma mar na ne no pa ra ri sa ster ta to va wal ze".split()
+# Доля событий с городом из CITIES и темой из TOPICS; остальные — из синтетического словаря
+REAL_SHARE = 0.1
+# (параметр, запрос): ?location= с location_match=fuzzy или ?q=
+QUERIES = [
+    ("location", "Muenchen"), ("location", "Munchen"), ("location", "Dusseldorf"),
+    ("q", "vstrecha emigrantov"), ("q", "boardgames"), ("q", "yoga park"),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Замеряет нечеткий поиск событий (триграммный индекс SearchTrigram) против location__icontains "
+        "на --events событиях. Данные откатываются в конце."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--events", type=int, default=100_000)
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run(options["events"], options["repeat"])
+            transaction.set_rollback(True)
+
+    def run(self, count, repeat):
+        rng = random.Random(0)
+        words = ["".join(rng.choices(SYLLABLES, k=rng.randint(2, 4))) for _ in range(5000)]
+        places = [" ".join(rng.sample(words, rng.randint(1, 2))).title() for _ in range(2000)]
+        creator = User.objects.create_user(email=f"bench-fuzzy-{time.time_ns()}@example.com")
+        date = timezone.now()
+        started = time.perf_counter()
+        for start in range(0, count, BATCH):
+            events = []
+            for _ in range(min(BATCH, count - start)):
+                real = rng.random() < REAL_SHARE
+                title = rng.choice(TOPICS) if real else " ".join(rng.sample(words, 3)).capitalize()
+                location = rng.choice(CITIES) if real else rng.choice(places)
+                description = " ".join(rng.sample(words, 8))
+                # bulk_create не вызывает save(): колонки поиска и триграммы считаются здесь
+                events.append(Event(
+                    title=title, description=description, location=location, creator=creator, date=date, time="18:00",
+                    search_location=fold_text(location), search_text=fold_text(f"{title} {description}"),
+                ))
+            index_trigrams(Event.objects.bulk_create(events), created=True)
+        self.stdout.write(f"inserted {count} events in {time.perf_counter() - started:.0f}s")
+
+        def measure(fn):
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                result = fn()
+                timings.append(time.perf_counter() - started)
+            return statistics.median(timings) * 1000, result
+
+        events = Event.objects.all()
+        self.stdout.write(
+            f"\n{'query':<28} {'fuzzy':>7} {'icontains':>9} {'fuzzy page':>11} {'fuzzy count':>12} {'icontains':>10}"
+            "  (matches; ms, median)"
+        )
+        for param, text in QUERIES:
+            field = "event.location" if param == "location" else "event.text"
+            search = FuzzySearch([(field, text)])
+            matches = search.filter(events)
+            paged, _ = measure(lambda: search.within(search.filter(events)).fetch(limit=20))
+            counted, fuzzy_count = measure(lambda: search.filter(events).count())
+            column = "location" if param == "location" else "title"
+            plain = events.filter(**{f"{column}__icontains": text})
+            scanned, plain_count = measure(plain.count)
+            label = f"{param}={text}"
+            self.stdout.write(
+                f"{label:<28} {matches.count():>7} {plain_count:>9} {paged:>11.1f} {counted:>12.1f} {scanned:>10.1f}"
+            )
@@ -0,0 +1,97 @@
+import datetime
+import random
+import statistics
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from accounts.geo import MAX_RESULTS, GeoFilter, encode, haversine_km
+from accounts.models import Event, User
+
+BATCH = 10000
+# Точки сгущаются вокруг городов (как профили и события эмигрантов), остальные — по Европе
+CITIES = {
+    "berlin": (52.52, 13.405), "munich": (48.137, 11.575), "paris": (48.857, 2.352), "madrid": (40.417, -3.704),
+    "warsaw": (52.230, 21.012), "tbilisi": (41.716, 44.783), "belgrade": (44.787, 20.457), "lisbon": (38.722, -9.139),
+    "prague": (50.076, 14.438), "vienna": (48.208, 16.373),
+}
+QUERIES = [
+    ("berlin", 1), ("berlin", 5), ("berlin", 25), ("tbilisi", 5), ("sparse", 50),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Замеряет поиск событий по радиусу на --points точках: geohash-префильтр с numpy, "
+        "прямоугольник по широте/долготе без индекса и перебор всех точек. Данные откатываются в конце."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--points", type=int, default=1_000_000)
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run(options["points"], options["repeat"])
+            transaction.set_rollback(True)
+
+    def run(self, count, repeat):
+        rng = random.Random(0)
+        creator = User.objects.create_user(email=f"bench-geo-{time.time_ns()}@example.com")
+        date = timezone.now() + datetime.timedelta(days=7)
+        centers = list(CITIES.values())
+        started = time.perf_counter()
+        for start in range(0, count, BATCH):
+            events = []
+            for _ in range(min(BATCH, count - start)):
+                if rng.random() < 0.7:
+                    lat, lon = rng.choice(centers)
+                    lat, lon = rng.gauss(lat, 0.15), rng.gauss(lon, 0.25)
+                else:
+                    lat, lon = rng.uniform(36, 60), rng.uniform(-10, 45)
+                # bulk_create не вызывает save(): geohash считается здесь
+                events.append(Event(
+                    title="Bench", location="", latitude=lat, longitude=lon, geohash=encode(lat, lon),
+                    creator=creator, date=date, time="18:00",
+                ))
+            Event.objects.bulk_create(events)
+        self.stdout.write(f"inserted {count} events in {time.perf_counter() - started:.0f}s")
+
+        def measure(fn):
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                result = fn()
+                timings.append(time.perf_counter() - started)
+            return statistics.median(timings) * 1000, result
+
+        def within(rows, lat, lon, radius):
+            rows = np.array(rows, dtype=float).reshape(-1, 3)
+            return int((haversine_km(lat, lon, rows[:, 1], rows[:, 2]) <= radius).sum())
+
+        # Как в EventSearchView — по всей таблице: фильтр по creator увел бы SQLite на индекс внешнего ключа
+        events = Event.objects.all()
+        self.stdout.write(
+            f"\n{'query':<16} {'matches':>8} {'candidates':>11} {'geohash+numpy':>14} "
+            f"{'lat/lon box':>12} {'full scan':>10}  (ms, median)"
+        )
+        for name, radius in QUERIES:
+            lat, lon = CITIES.get(name, (46.0, 30.0))
+            geo = GeoFilter.from_params({"lat": lat, "lon": lon, "radius_km": radius})
+            candidates = events.filter(geo.prefilter()).count()
+            indexed, (queryset, distances) = measure(lambda: geo.apply(events))
+            # Тот же прямоугольник без geohash: индекса по широте и долготе нет
+            box = events.filter(
+                latitude__gte=geo.min_lat, latitude__lte=geo.max_lat,
+                longitude__gte=geo.min_lon, longitude__lte=geo.max_lon,
+            )
+            boxed, box_matches = measure(lambda: within(list(box.values_list("pk", "latitude", "longitude")), lat, lon, radius))
+            scanned, scan_matches = measure(lambda: within(list(events.values_list("pk", "latitude", "longitude")), lat, lon, radius))
+            assert len(distances) == box_matches == scan_matches or len(distances) == MAX_RESULTS
+            label = f"{name} {radius} km"
+            self.stdout.write(
+                f"{label:<16} {len(distances):>8} {candidates:>11} {indexed:>14.1f} {boxed:>12.1f} {scanned:>10.1f}"
+            )
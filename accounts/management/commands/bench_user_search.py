@@ -0,0 +1,108 @@
+import random
+import statistics
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from accounts.models import User, UserLanguage, language_codes
+from accounts.search import LANGUAGE_STATS_KEY, filter_languages, language_frequencies
+
+BATCH = 10000
+# Частые языки эмигрантов и хвост редких, с убывающими весами
+LANGUAGES = [
+    "English", "Russian", "Ukrainian", "German", "Spanish", "French", "Polish", "Turkish", "Arabic", "Italian",
+    "Portuguese", "Romanian", "Georgian", "Armenian", "Kazakh", "Hebrew", "Farsi", "Serbian", "Czech", "Icelandic",
+]
+WEIGHTS = [1 / rank for rank in range(1, len(LANGUAGES) + 1)]
+QUERIES = [
+    (["English"], "any"),
+    (["Icelandic"], "any"),
+    (["Spanish", "Georgian"], "any"),
+    (["English", "Spanish"], "all"),
+    (["Russian", "German", "Hebrew"], "all"),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Замеряет поиск пользователей по языку (индекс UserLanguage и прежний icontains по JSON) "
+        "на --users пользователях. Данные создаются в транзакции и откатываются в конце."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1_000_000)
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run(options["users"], options["repeat"])
+            transaction.set_rollback(True)
+
+    def run(self, count, repeat):
+        rng = random.Random(0)
+        started = time.perf_counter()
+        first_id = (User.objects.order_by("-id").values_list("id", flat=True).first() or 0) + 1
+        for start in range(0, count, BATCH):
+            users = []
+            for i in range(start, min(count, start + BATCH)):
+                spoken = sorted(set(rng.choices(LANGUAGES, weights=WEIGHTS, k=rng.randint(1, 3))))
+                users.append(User(
+                    id=first_id + i, email=f"bench-lang-{i}@example.com", password="!", spoken_languages=spoken,
+                ))
+            # bulk_create не вызывает save(): строки индекса пишутся здесь же
+            User.objects.bulk_create(users)
+            UserLanguage.objects.bulk_create(
+                UserLanguage(user_id=user.id, language=code)
+                for user in users for code in sorted(language_codes(user.spoken_languages))
+            )
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f"inserted {count} users with language index in {elapsed:.0f}s")
+
+        def measure(fn):
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                fn()
+                timings.append(time.perf_counter() - started)
+            return statistics.median(timings) * 1000
+
+        def scan(names, match):
+            # Прежний способ: подстрока в сериализованном JSON, по всей таблице
+            queryset = User.objects.all()
+            if match == "all":
+                for name in names:
+                    queryset = queryset.filter(spoken_languages__icontains=name)
+                return queryset
+            users = User.objects.none()
+            for name in names:
+                users |= User.objects.filter(spoken_languages__icontains=name)
+            return users
+
+        cache.delete(LANGUAGE_STATS_KEY)
+        stats_ms = measure(lambda: (cache.delete(LANGUAGE_STATS_KEY), language_frequencies()))
+        self.stdout.write(f"language frequencies (cached for join order): {stats_ms:.0f} ms per rebuild")
+
+        # ids — все совпадения, как их отдает UserSearchView (без пагинации)
+        self.stdout.write(
+            f"\n{'languages':<32} {'matches':>8} {'index ids':>10} {'index count':>12} "
+            f"{'icontains ids':>14} {'icontains count':>16}  (ms, median)"
+        )
+        for names, match in QUERIES:
+            codes = sorted(language_codes(names))
+            indexed = filter_languages(User.objects.all(), codes, match)
+            legacy = scan(names, match)
+            matches = indexed.count()
+            row = (
+                measure(lambda: list(indexed.values_list("id", flat=True))),
+                measure(indexed.count),
+                measure(lambda: list(legacy.values_list("id", flat=True))),
+                measure(legacy.count),
+            )
+            label = f"{match}: {', '.join(names)}"
+            self.stdout.write(f"{label:<32} {matches:>8} {row[0]:>10.1f} {row[1]:>12.1f} {row[2]:>14.1f} {row[3]:>16.1f}")
+
+        # Ложные срабатывания подстроки: "en" находится в "English", "French", "Armenian"...
+        false_positives = User.objects.filter(spoken_languages__icontains="en").count()
+        self.stdout.write(f"\nicontains 'en': {false_positives} users, index: {filter_languages(User.objects.all(), ['en']).count()}")
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.search import rebuild_trigrams
+
+
+class Command(BaseCommand):
+    help = (
+        "Сверяет триграммный индекс нечеткого поиска (SearchTrigram на SQLite) с колонками поиска "
+        "пользователей и событий, на Postgres перестраивает GIN-индексы pg_trgm"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        total, reindexed = rebuild_trigrams(options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {total} objects, {reindexed} reindexed, in {time.perf_counter() - started:.1f}s"
+        ))
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.search import reindex_users
+
+
+class Command(BaseCommand):
+    help = (
+        "Пересчитывает поисковые колонки пользователей (search_location, age_bucket) и индекс языков "
+        "UserLanguage пачками через bulk_update; нужно после изменений профилей в обход save()"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        total, changed = reindex_users(options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Reindexed {total} users, {changed} changed, in {time.perf_counter() - started:.1f}s"
+        ))
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.21 on 2026-10-18 12:09
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_user_languages(apps, schema_editor):
+    # То же, что User.index_languages для каждого пользователя
+    User = apps.get_model('accounts', 'User')
+    UserLanguage = apps.get_model('accounts', 'UserLanguage')
+    batch = []
+    for user_id, languages in User.objects.values_list('id', 'spoken_languages').iterator(chunk_size=2000):
+        if not isinstance(languages, (list, tuple)):
+            continue
+        codes = {" ".join(str(name).casefold().split())[:50] for name in languages} - {""}
+        batch.extend(UserLanguage(user_id=user_id, language=code) for code in codes)
+        if len(batch) >= 5000:
+            UserLanguage.objects.bulk_create(batch)
+            batch = []
+    UserLanguage.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0009_event_time'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserLanguage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('language', models.CharField(max_length=50)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='language_index', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='userlanguage',
+            constraint=models.UniqueConstraint(fields=('language', 'user'), name='unique_user_language'),
+        ),
+        migrations.RunPython(fill_user_languages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 4.2.21 on 2026-10-18 12:18
+
+import bisect
+import re
+
+from django.db import migrations, models
+
+AGE_BUCKETS = (0, 18, 25, 35, 45, 55, 65)
+
+
+def fill_search_columns(apps, schema_editor):
+    # То же, что manage.py reindex_users
+    User = apps.get_model('accounts', 'User')
+    batch = []
+    for user in User.objects.only('id', 'age', 'location').iterator(chunk_size=2000):
+        user.search_location = " ".join(re.findall(r"\w+", user.location.casefold()))[:100]
+        user.age_bucket = None if user.age is None else AGE_BUCKETS[bisect.bisect_right(AGE_BUCKETS, user.age) - 1]
+        batch.append(user)
+        if len(batch) >= 2000:
+            User.objects.bulk_update(batch, ['search_location', 'age_bucket'])
+            batch = []
+    User.objects.bulk_update(batch, ['search_location', 'age_bucket'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0010_user_language'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='user',
+            name='search_index',
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='age_bucket',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='search_location',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.RunPython(fill_search_columns, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['search_location'], name='user_search_location_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['gender', 'age'], name='user_gender_age_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['age_bucket', 'gender'], name='user_age_bucket_idx'),
+        ),
+    ]
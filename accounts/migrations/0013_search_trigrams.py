@@ -0,0 +1,134 @@
+# Generated by Django 4.2.21 on 2026-10-18 12:41
+
+import re
+import unicodedata
+
+from django.db import migrations, models
+
+BATCH = 2000
+# Копия accounts/text.py на момент миграции: дальнейшие правки свертки ее не меняют
+TRANSLITERATION = str.maketrans({
+    'ä': 'ae', 'ö': 'oe', 'ü': 'ue', 'ß': 'ss', 'æ': 'ae', 'œ': 'oe', 'ø': 'o', 'å': 'a',
+    'ł': 'l', 'đ': 'd', 'ð': 'd', 'þ': 'th', 'ı': 'i',
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
+    'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'shch',
+    'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+    'і': 'i', 'ї': 'yi', 'є': 'ye', 'ґ': 'g', 'ў': 'u',
+})
+WORD_RE = re.compile(r"[^\W_]+")
+# Поля триграммного индекса: User.TRIGRAM_FIELDS и Event.TRIGRAM_FIELDS
+TRIGRAM_FIELDS = {
+    'User': {'user.location': 'search_location'},
+    'Event': {'event.location': 'search_location', 'event.text': 'search_text'},
+}
+
+# Postgres: GIN-индексы pg_trgm по свернутым колонкам, таблица SearchTrigram не заполняется
+POSTGRES_FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX user_location_trgm_idx ON accounts_user USING GIN (search_location gin_trgm_ops)",
+    "CREATE INDEX event_location_trgm_idx ON accounts_event USING GIN (search_location gin_trgm_ops)",
+    "CREATE INDEX event_text_trgm_idx ON accounts_event USING GIN (search_text gin_trgm_ops)",
+]
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS user_location_trgm_idx",
+    "DROP INDEX IF EXISTS event_location_trgm_idx",
+    "DROP INDEX IF EXISTS event_text_trgm_idx",
+]
+
+
+def fold_text(text):
+    text = str(text or "").casefold().translate(TRANSLITERATION)
+    text = "".join(char for char in unicodedata.normalize("NFKD", text) if not unicodedata.combining(char))
+    return " ".join(WORD_RE.findall(text))
+
+
+def trigrams(text):
+    grams = set()
+    for word in WORD_RE.findall(text):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def fill_search_text(apps, schema_editor):
+    # search_location пользователей теперь с транслитерацией (accounts/text.py), у событий — новые колонки;
+    # на SQLite заодно заполняется SearchTrigram (то же, что manage.py rebuild_trigram_index)
+    User = apps.get_model('accounts', 'User')
+    Event = apps.get_model('accounts', 'Event')
+    SearchTrigram = apps.get_model('accounts', 'SearchTrigram')
+    sqlite = schema_editor.connection.vendor == 'sqlite'
+
+    def save(model, objects, columns):
+        model.objects.bulk_update(objects, columns)
+        if sqlite:
+            SearchTrigram.objects.bulk_create([
+                SearchTrigram(field=field, object_id=obj.pk, trigram=trigram)
+                for obj in objects
+                for field, column in TRIGRAM_FIELDS[model.__name__].items()
+                for trigram in trigrams(getattr(obj, column))
+            ], batch_size=BATCH)
+
+    batch = []
+    for user in User.objects.only('id', 'location').iterator(chunk_size=BATCH):
+        user.search_location = fold_text(user.location)[:100]
+        batch.append(user)
+        if len(batch) >= BATCH:
+            save(User, batch, ['search_location'])
+            batch = []
+    save(User, batch, ['search_location'])
+
+    batch = []
+    for event in Event.objects.only('id', 'location', 'title', 'description').iterator(chunk_size=BATCH):
+        event.search_location = fold_text(event.location)
+        event.search_text = fold_text(f"{event.title} {event.description}")
+        batch.append(event)
+        if len(batch) >= BATCH:
+            save(Event, batch, ['search_location', 'search_text'])
+            batch = []
+    save(Event, batch, ['search_location', 'search_text'])
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0012_geo_coordinates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='search_location',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='search_text',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.CreateModel(
+            name='SearchTrigram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(max_length=20)),
+                ('object_id', models.BigIntegerField()),
+                ('trigram', models.CharField(max_length=3)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['field', 'object_id'], name='search_trigram_object_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='searchtrigram',
+            constraint=models.UniqueConstraint(fields=('field', 'trigram', 'object_id'), name='unique_search_trigram'),
+        ),
+        migrations.RunPython(fill_search_text, migrations.RunPython.noop),
+        migrations.RunPython(run({'postgresql': POSTGRES_FORWARD}), run({'postgresql': POSTGRES_BACKWARD})),
+    ]
@@ -1,6 +1,13 @@
+import bisect
+
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, BaseUserManager
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.conf import settings
+from django.core.validators import MaxValueValidator, MinValueValidator
+
+from .text import fold_text
 
 class UserManager(BaseUserManager):
     def create_user(self, email, password=None, **extra_fields):
@@ -30,22 +37,145 @@ class User(AbstractBaseUser, PermissionsMixin):
 
     is_active = models.BooleanField(default=True)
     is_staff = models.BooleanField(default=False)
-    search_index = models.JSONField(default=dict, blank=True)  # Индекс для поиска  
+    # Поисковые колонки, производные от профиля (пересчитываются в save() при изменении источника):
+    # нормализованное местоположение и возрастная группа; языки — в таблице UserLanguage
+    search_location = models.CharField(max_length=100, blank=True, default='')
+    age_bucket = models.PositiveSmallIntegerField(null=True, blank=True)
+    # Необязательные координаты профиля и их geohash для поиска по радиусу (accounts/geo.py)
+    latitude = models.FloatField(null=True, blank=True, validators=[MinValueValidator(-90), MaxValueValidator(90)])
+    longitude = models.FloatField(null=True, blank=True, validators=[MinValueValidator(-180), MaxValueValidator(180)])
+    geohash = models.CharField(max_length=12, blank=True, default='')
     objects = UserManager()
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = []
+    # Поля нечеткого поиска (SearchTrigram.field → колонка со свернутым текстом)
+    TRIGRAM_FIELDS = {'user.location': 'search_location'}
+
+    class Meta:
+        indexes = [
+            # Поиск по началу местоположения — диапазон по индексу
+            models.Index(fields=['search_location'], name='user_search_location_idx'),
+            models.Index(fields=['gender', 'age'], name='user_gender_age_idx'),
+            models.Index(fields=['age_bucket', 'gender'], name='user_age_bucket_idx'),
+            # Координаты в индексе: уточнение по радиусу читает только индекс, без строк таблицы
+            models.Index(fields=['geohash', 'latitude', 'longitude'], name='user_geohash_idx'),
+        ]
 
     def __str__(self):
         return self.email
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        user = super().from_db(db, field_names, values)
+        if all(field in field_names for field in SEARCH_SOURCE_FIELDS):
+            # С чем сравнивает save(): поисковые колонки пересчитываются, только если профиль изменился
+            user._search_source = user.search_source()
+        return user
+
+    def search_source(self):
+        return (
+            self.age, self.gender, self.location, frozenset(language_codes(self.spoken_languages)),
+            self.latitude, self.longitude,
+        )
+
+    def search_columns(self):
+        """Значения SEARCH_COLUMNS для текущего профиля."""
+        return normalize_location(self.location), age_bucket(self.age), point_geohash(self.latitude, self.longitude)
+
     def save(self, *args, **kwargs):
-        self.search_index = {
-            "age": self.age,
-            "gender": self.gender,
-            "location": self.location,
-            "languages": self.spoken_languages,
-        }
+        created = self._state.adding
+        previous = getattr(self, '_search_source', None)
+        update_fields = kwargs.get('update_fields')
+        # save(update_fields=['last_login']) и смена пароля поиск не трогают
+        if update_fields is not None and not set(update_fields) & set(SEARCH_SOURCE_FIELDS):
+            return super().save(*args, **kwargs)
+
+        source = self.search_source()
+        if source != previous:
+            self.search_location, self.age_bucket, self.geohash = self.search_columns()
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, *SEARCH_COLUMNS}
         super().save(*args, **kwargs)
+        if previous is None or source[3] != previous[3]:
+            self.index_languages(set(source[3]), created)
+        if previous is None or source[2] != previous[2]:
+            from .search import index_trigrams
+            index_trigrams([self], created)
+        if source != previous:
+            from .search import invalidate_facets
+            invalidate_facets()
+        self._search_source = source
+
+    def index_languages(self, languages, created=False):
+        """Приводит строки UserLanguage пользователя к набору languages."""
+        current = set() if created else set(self.language_index.values_list('language', flat=True))
+        if current - languages:
+            self.language_index.filter(language__in=current - languages).delete()
+        if languages - current:
+            UserLanguage.objects.bulk_create(
+                [UserLanguage(user=self, language=language) for language in sorted(languages - current)],
+                ignore_conflicts=True,
+            )
+
+
+@receiver(post_delete, sender=User)
+def forget_user_facets(sender, instance, **kwargs):
+    from .search import invalidate_facets
+    invalidate_facets()
+
+
+# Поля профиля, из которых считаются поисковые колонки, и сами колонки
+SEARCH_SOURCE_FIELDS = ('age', 'gender', 'location', 'spoken_languages', 'latitude', 'longitude')
+SEARCH_COLUMNS = ('search_location', 'age_bucket', 'geohash')
+# Нижние границы возрастных групп: 0–17, 18–24, 25–34, ..., 65+
+AGE_BUCKETS = (0, 18, 25, 35, 45, 55, 65)
+
+
+def age_bucket(age):
+    if age is None:
+        return None
+    return AGE_BUCKETS[bisect.bisect_right(AGE_BUCKETS, age) - 1]
+
+
+def point_geohash(latitude, longitude):
+    if latitude is None or longitude is None:
+        return ''
+    from .geo import encode
+    return encode(latitude, longitude)
+
+
+def normalize_location(text):
+    # "New York, NY" → "new york ny", "München" → "muenchen" (accounts/text.py)
+    return fold_text(text)[:100]
+
+
+def normalize_language(name):
+    # "  english", "English" и "ENGLISH" — один язык
+    return " ".join(str(name).casefold().split())[:50]
+
+
+def language_codes(languages):
+    if not isinstance(languages, (list, tuple)):
+        return set()
+    return {code for code in map(normalize_language, languages) if code}
+
+
+class UserLanguage(models.Model):
+    """
+    Обратный индекс языков пользователей: строка на каждый язык из User.spoken_languages
+    (в виде normalize_language). Поиск по языку — точный поиск по индексу (language, user).
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='language_index')
+    language = models.CharField(max_length=50)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['language', 'user'], name='unique_user_language'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}: {self.language}"
 
 class BusinessProfile(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -60,10 +190,62 @@ class Event(models.Model):
     title = models.CharField(max_length=255)
     description = models.TextField(blank=True)
     location = models.CharField(max_length=255)
+    latitude = models.FloatField(null=True, blank=True, validators=[MinValueValidator(-90), MaxValueValidator(90)])
+    longitude = models.FloatField(null=True, blank=True, validators=[MinValueValidator(-180), MaxValueValidator(180)])
+    geohash = models.CharField(max_length=12, blank=True, default='')
+    # Свернутые location и title + description (fold_text) для нечеткого поиска
+    search_location = models.CharField(max_length=255, blank=True, default='')
+    search_text = models.TextField(blank=True, default='')
     creator = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='created_events')
     date = models.DateTimeField()
     time = models.TimeField()
     participants = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name='joined_events', blank=True)
 
+    TRIGRAM_FIELDS = {'event.location': 'search_location', 'event.text': 'search_text'}
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['geohash', 'latitude', 'longitude'], name='event_geohash_idx'),
+        ]
+
     def __str__(self):
-        return self.title
\ No newline at end of file
+        return self.title
+
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        self.geohash = point_geohash(self.latitude, self.longitude)
+        self.search_location = fold_text(self.location)
+        self.search_text = fold_text(f"{self.title} {self.description}")
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'geohash', 'search_location', 'search_text'}
+        super().save(*args, **kwargs)
+        from .search import index_trigrams
+        index_trigrams([self], created)
+
+
+class SearchTrigram(models.Model):
+    """
+    Триграммный индекс для нечеткого поиска на SQLite: строка на каждую триграмму свернутого текста
+    поля объекта (field — ключ из TRIGRAM_FIELDS модели). Ведется в save() и index_trigrams;
+    на Postgres не заполняется — там GIN-индексы pg_trgm по тем же колонкам.
+    """
+    field = models.CharField(max_length=20)
+    object_id = models.BigIntegerField()
+    trigram = models.CharField(max_length=3)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['field', 'trigram', 'object_id'], name='unique_search_trigram'),
+        ]
+        indexes = [
+            models.Index(fields=['field', 'object_id'], name='search_trigram_object_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.field}:{self.object_id}: {self.trigram}"
+
+
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Event)
+def forget_search_trigrams(sender, instance, **kwargs):
+    SearchTrigram.objects.filter(field__in=list(sender.TRIGRAM_FIELDS), object_id=instance.pk).delete()
\ No newline at end of file
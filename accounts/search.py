@@ -0,0 +1,369 @@
+import copy
+import hashlib
+import math
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import BooleanField, Count, F, FloatField, Max, Q
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
+from rest_framework.exceptions import ValidationError
+
+from .models import (
+    AGE_BUCKETS, SEARCH_COLUMNS, SEARCH_SOURCE_FIELDS, Event, SearchTrigram, User, UserLanguage, language_codes,
+    normalize_language, normalize_location,
+)
+from .text import fold_text, trigrams
+
+LANGUAGE_MATCH_MODES = ('any', 'all')
+LANGUAGE_STATS_KEY = "accounts:language-frequencies"
+LANGUAGE_STATS_TTL = 3600  # секунды; нужен только порядок языков по частоте, он меняется медленно
+FACETS_VERSION_KEY = "accounts:facets-version"
+FACETS_TTL = 300  # секунды
+FACETS_TOP = 10  # языков и местоположений в ответе
+SIMILARITY_THRESHOLD = 0.3  # как pg_trgm по умолчанию
+# GIN-индексы pg_trgm на Postgres (миграция 0013_search_trigrams)
+TRIGRAM_INDEXES = ('user_location_trgm_idx', 'event_location_trgm_idx', 'event_text_trgm_idx')
+
+
+def match_mode(params, name, modes):
+    """Значение параметра name из modes, по умолчанию — первое."""
+    mode = params.get(name) or modes[0]
+    if mode not in modes:
+        raise ValidationError({name: f"Expected one of: {', '.join(modes)}"})
+    return mode
+
+
+def parse_languages(values):
+    """?language=English&language=Spanish или ?language=English,Spanish → нормализованные коды."""
+    codes = []
+    for value in values:
+        for name in value.split(','):
+            code = normalize_language(name)
+            if code and code not in codes:
+                codes.append(code)
+    return codes
+
+
+def language_frequencies():
+    """Число пользователей по языкам, из кэша: один проход по индексу UserLanguage раз в LANGUAGE_STATS_TTL."""
+    frequencies = cache.get(LANGUAGE_STATS_KEY)
+    if frequencies is None:
+        frequencies = dict(
+            UserLanguage.objects.values('language').annotate(users=Count('user')).values_list('language', 'users')
+        )
+        cache.set(LANGUAGE_STATS_KEY, frequencies, LANGUAGE_STATS_TTL)
+    return frequencies
+
+
+def filter_languages(queryset, codes, match='any'):
+    """
+    Пользователи, говорящие на любом (match='any') или на всех (match='all') языках codes.
+    Выборка идет по индексу (language, user) таблицы UserLanguage, без чтения JSON профилей.
+    """
+    if match not in LANGUAGE_MATCH_MODES:
+        raise ValidationError({"language_match": f"Expected one of: {', '.join(LANGUAGE_MATCH_MODES)}"})
+    if match == 'any' and len(codes) > 1:
+        return queryset.filter(pk__in=UserLanguage.objects.filter(language__in=codes).values('user'))
+    # По join на каждый язык, от самого редкого: БД начинает с первого join и для остальных
+    # проверяет пары (language, user) точечно по уникальному индексу
+    frequencies = language_frequencies()
+    for code in sorted(codes, key=lambda code: frequencies.get(code, 0)):
+        queryset = queryset.filter(language_index__language=code)
+    return queryset
+
+
+def filter_location(queryset, text):
+    """
+    Пользователи, у которых какое-то слово местоположения начинается с text (без учета регистра
+    и знаков препинания): "York" находит "New York", "Berlin" — "Mitte, Berlin". Несколько слов
+    ищутся подряд. Кандидатов дает триграммный индекс (SearchTrigram на SQLite, GIN pg_trgm
+    на Postgres), а не LIKE по всей таблице.
+    """
+    prefix = normalize_location(text)
+    if not prefix:
+        return queryset
+    # В search_location слова через пробел: слово начинается в начале строки или после пробела
+    queryset = queryset.filter(Q(search_location__startswith=prefix) | Q(search_location__contains=" " + prefix))
+    if connection.vendor == 'postgresql':
+        return queryset
+    # Все триграммы префикса, кроме замыкающей последнего слова: оно может быть недописанным
+    grams = trigrams(prefix) - {f"  {prefix.split()[-1]} "[-3:]}
+    candidates = (
+        SearchTrigram.objects.filter(field='user.location', trigram__in=grams)
+        .values('object_id').annotate(hits=Count('id')).filter(hits=len(grams)).values('object_id')
+    )
+    return queryset.filter(pk__in=candidates)
+
+
+def reindex_users(batch_size=1000):
+    """
+    Пересчитывает поисковые колонки и UserLanguage всех пользователей пачками по batch_size
+    (по возрастанию id). Пишутся только изменившиеся строки. Возвращает (пользователей, изменено).
+    """
+    total = changed = 0
+    last_id = 0
+    while True:
+        users = list(
+            User.objects.filter(id__gt=last_id).order_by('id')
+            .only('id', *SEARCH_SOURCE_FIELDS, *SEARCH_COLUMNS)[:batch_size]
+        )
+        if not users:
+            return total, changed
+        last_id = users[-1].id
+        total += len(users)
+
+        stale = []
+        for user in users:
+            columns = user.search_columns()
+            if columns != (user.search_location, user.age_bucket, user.geohash):
+                user.search_location, user.age_bucket, user.geohash = columns
+                stale.append(user)
+        indexed = set(UserLanguage.objects.filter(user__in=users).values_list('user_id', 'language'))
+        expected = {(user.id, code) for user in users for code in language_codes(user.spoken_languages)}
+
+        with transaction.atomic():
+            if stale:
+                User.objects.bulk_update(stale, SEARCH_COLUMNS)
+            reindexed = index_trigrams(users)
+            removed = {}
+            for user_id, language in indexed - expected:
+                removed.setdefault(language, []).append(user_id)
+            for language, user_ids in removed.items():
+                UserLanguage.objects.filter(language=language, user_id__in=user_ids).delete()
+            UserLanguage.objects.bulk_create(
+                [UserLanguage(user_id=user_id, language=language) for user_id, language in sorted(expected - indexed)]
+            )
+        changed += len({user.id for user in stale} | {user_id for user_id, _ in indexed ^ expected} | reindexed)
+        if stale or indexed != expected:
+            invalidate_facets()
+
+
+def age_label(bucket):
+    upper = AGE_BUCKETS[AGE_BUCKETS.index(bucket) + 1] - 1 if bucket != AGE_BUCKETS[-1] else None
+    return f"{bucket}–{upper}" if upper is not None else f"{bucket}+"
+
+
+def invalidate_facets():
+    """Сбрасывает все закэшированные фасеты: номер версии входит в ключ кэша."""
+    try:
+        cache.incr(FACETS_VERSION_KEY)
+    except ValueError:
+        cache.add(FACETS_VERSION_KEY, 1, None)
+
+
+def user_facets(queryset):
+    """
+    Счетчики по полу, возрастным группам, самым частым языкам и местоположениям для выборки
+    queryset: четыре запроса GROUP BY по поисковым колонкам и UserLanguage. Результат кэшируется
+    по тексту запроса до изменения любого профиля (invalidate_facets) или на FACETS_TTL.
+    """
+    version = cache.get_or_set(FACETS_VERSION_KEY, 1, None)
+    digest = hashlib.sha256(str(queryset.query).encode()).hexdigest()
+    key = f"accounts:facets:{version}:{digest}"
+    facets = cache.get(key)
+    if facets is not None:
+        return facets
+
+    queryset = queryset.order_by()
+    genders = list(queryset.values('gender').annotate(count=Count('id')).order_by('-count', 'gender'))
+    ages = queryset.filter(age_bucket__isnull=False).values('age_bucket').annotate(count=Count('id')).order_by('age_bucket')
+    languages = (
+        UserLanguage.objects.filter(user__in=queryset.values('pk'))
+        .values('language').annotate(count=Count('user')).order_by('-count', 'language')[:FACETS_TOP]
+    )
+    # Группы по нормализованному местоположению, подпись — одно из исходных написаний
+    locations = (
+        queryset.exclude(search_location='').values('search_location')
+        .annotate(count=Count('id'), label=Max('location')).order_by('-count', 'search_location')[:FACETS_TOP]
+    )
+    facets = {
+        "count": sum(row['count'] for row in genders),
+        "gender": [{"value": row['gender'] or None, "count": row['count']} for row in genders],
+        "age": [
+            {"value": row['age_bucket'], "label": age_label(row['age_bucket']), "count": row['count']} for row in ages
+        ],
+        "languages": [{"value": row['language'], "count": row['count']} for row in languages],
+        "locations": [
+            {"value": row['search_location'], "label": row['label'], "count": row['count']} for row in locations
+        ],
+    }
+    cache.set(key, facets, FACETS_TTL)
+    return facets
+
+
+def index_trigrams(objects, created=False):
+    """
+    Приводит строки SearchTrigram объектов одной модели к триграммам их колонок TRIGRAM_FIELDS;
+    переписываются только поля, у которых набор триграмм изменился. На Postgres индекс ведет
+    pg_trgm, и функция ничего не делает. Возвращает id переписанных объектов.
+    """
+    if connection.vendor == 'postgresql' or not objects:
+        return set()
+    reindexed = set()
+    for field, column in type(objects[0]).TRIGRAM_FIELDS.items():
+        expected = {obj.pk: trigrams(getattr(obj, column)) for obj in objects}
+        current = {pk: set() for pk in expected}
+        if not created:
+            rows = SearchTrigram.objects.filter(field=field, object_id__in=list(expected))
+            for pk, trigram in rows.values_list('object_id', 'trigram'):
+                current[pk].add(trigram)
+        stale = [pk for pk in expected if expected[pk] != current[pk]]
+        if not stale:
+            continue
+        with transaction.atomic():
+            SearchTrigram.objects.filter(field=field, object_id__in=[pk for pk in stale if current[pk]]).delete()
+            SearchTrigram.objects.bulk_create(
+                [SearchTrigram(field=field, object_id=pk, trigram=trigram) for pk in stale for trigram in expected[pk]],
+                batch_size=2000,
+            )
+        reindexed.update(stale)
+    return reindexed
+
+
+def rebuild_trigrams(batch_size=1000):
+    """
+    Сверяет триграммный индекс SQLite с колонками поиска всех пользователей и событий пачками
+    и удаляет строки удаленных объектов; на Postgres перестраивает GIN-индексы.
+    Возвращает (объектов, переиндексировано).
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            for index in TRIGRAM_INDEXES:
+                cursor.execute(f"REINDEX INDEX {index}")
+        return 0, 0
+    total = reindexed = 0
+    for model in (User, Event):
+        columns = list(model.TRIGRAM_FIELDS.values())
+        last_id = 0
+        while True:
+            batch = list(model.objects.filter(id__gt=last_id).order_by('id').only('id', *columns)[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            total += len(batch)
+            reindexed += len(index_trigrams(batch))
+        # Объекты, удаленные в обход сигнала post_delete
+        SearchTrigram.objects.filter(field__in=list(model.TRIGRAM_FIELDS)).exclude(
+            object_id__in=model.objects.values('pk')
+        ).delete()
+    return total, reindexed
+
+
+def parse_age_bucket(value):
+    """?age_bucket= — нижняя граница возрастной группы из AGE_BUCKETS: 25 — это 25–34."""
+    try:
+        bucket = int(value)
+    except ValueError:
+        bucket = None
+    if bucket not in AGE_BUCKETS:
+        raise ValidationError({"age_bucket": f"Expected one of: {', '.join(map(str, AGE_BUCKETS))}"})
+    return bucket
+
+
+def parse_similarity(value):
+    """?similarity= — порог сходства в (0, 1], по умолчанию SIMILARITY_THRESHOLD."""
+    if value in (None, ''):
+        return SIMILARITY_THRESHOLD
+    try:
+        threshold = float(value)
+    except ValueError:
+        threshold = None
+    if threshold is None or not 0 < threshold <= 1:
+        raise ValidationError({"similarity": "Expected a number greater than 0 and at most 1"})
+    return threshold
+
+
+class FuzzySearch:
+    """
+    Нечеткий поиск по колонкам TRIGRAM_FIELDS с опечатками, транслитерацией и диакритикой
+    ("Munchen", "Muenchen" и "München"). Сходство — доля триграмм запроса, найденных в тексте
+    поля: на Postgres — word_similarity из pg_trgm по GIN-индексу, на SQLite — по таблице
+    SearchTrigram. Объект подходит, если сходство не ниже threshold по каждому условию.
+
+    Результаты упорядочены по (rank, id), rank = −среднее сходство; fetch(after=(rank, id))
+    продолжает выдачу после строки предыдущей страницы (SearchCursorPagination).
+    """
+
+    def __init__(self, terms, threshold=SIMILARITY_THRESHOLD):
+        # terms — пары (поле TRIGRAM_FIELDS, текст запроса); условия без букв и цифр не учитываются
+        self.terms = [(field, fold_text(text)) for field, text in terms]
+        self.terms = [(field, text) for field, text in self.terms if text]
+        self.threshold = threshold
+        self.queryset = None
+
+    def __bool__(self):
+        return bool(self.terms)
+
+    def column(self, model, field):
+        return f'"{model._meta.db_table}"."{model.TRIGRAM_FIELDS[field]}"'
+
+    def filter(self, queryset):
+        """Объекты queryset, похожие на все условия."""
+        if not self.terms:
+            return queryset
+        if connection.vendor != 'postgresql':
+            return queryset.filter(pk__in=self.matches().values('object'))
+        # Порог оператора <% — настройка сеанса
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT set_config('pg_trgm.word_similarity_threshold', %s, false)", [str(self.threshold)])
+        for field, text in self.terms:
+            column = self.column(queryset.model, field)
+            queryset = queryset.filter(RawSQL(f"%s <%% {column}", (text,), output_field=BooleanField()))
+        return queryset
+
+    def matches(self, queryset=None):
+        """
+        SQLite: один сгруппированный запрос по SearchTrigram — object (id) и rank объектов (из queryset,
+        если он задан), у которых по каждому условию найдено не меньше threshold триграмм запроса.
+        """
+        condition = Q()
+        having = Q()
+        hits = {}
+        scores = []
+        for i, (field, text) in enumerate(self.terms):
+            grams = trigrams(text)
+            term = Q(field=field, trigram__in=grams)
+            condition |= term
+            # Строки условия считаются отдельно, только если условий несколько
+            hits[f'hits{i}'] = Count('id', filter=term if len(self.terms) > 1 else None)
+            having &= Q(**{f'hits{i}__gte': math.ceil(self.threshold * len(grams) - 1e-9)})
+            scores.append(Cast(F(f'hits{i}'), FloatField()) / len(grams))
+        # Группировка по выражению, а не по колонке: иначе SQLite идет по индексу (field, object_id),
+        # чтобы не сортировать, и читает все строки поля вместо строк триграмм запроса.
+        # По тому же выражению — и ограничение queryset: строки проверяются по готовому списку id
+        rows = SearchTrigram.objects.filter(condition).values(object=F('object_id') + 0)
+        if queryset is not None:
+            rows = rows.filter(object__in=queryset.values('pk'))
+        return rows.annotate(**hits).filter(having).annotate(rank=-sum(scores[1:], scores[0]) / len(scores))
+
+    def rank(self, model):
+        # Postgres: word_similarity по GIN-индексу; на SQLite rank считает matches()
+        scores = [
+            Cast(RawSQL(f"word_similarity(%s, {self.column(model, field)})", (text,)), FloatField())
+            for field, text in self.terms
+        ]
+        return -sum(scores[1:], scores[0]) / len(scores)
+
+    def within(self, queryset):
+        """Тот же поиск по уже отфильтрованному (self.filter) queryset."""
+        search = copy.copy(self)
+        search.queryset = queryset
+        return search
+
+    def fetch(self, after=None, limit=20):
+        if connection.vendor == 'postgresql':
+            queryset = self.queryset.annotate(rank=self.rank(self.queryset.model))
+            if after is not None:
+                queryset = queryset.filter(Q(rank__gt=after[0]) | Q(rank=after[0], pk__gt=after[1]))
+            return list(queryset.order_by('rank', 'pk')[:limit])
+        # Сходство, порядок и курсор — в сгруппированном запросе; объекты страницы читаются по pk
+        ranked = self.matches(self.queryset)
+        if after is not None:
+            ranked = ranked.filter(Q(rank__gt=after[0]) | Q(rank=after[0], object__gt=after[1]))
+        page = list(ranked.order_by('rank', 'object').values_list('object', 'rank')[:limit])
+        # Как в GeoFilter.apply: id уже отобраны по queryset, повторять его условия не нужно
+        objects = self.queryset.model.objects.in_bulk([pk for pk, _ in page])
+        for pk, rank in page:
+            objects[pk].rank = rank
+        return [objects[pk] for pk, _ in page]
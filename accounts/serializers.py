@@ -6,7 +6,7 @@ class RegisterSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = User
-        fields = ['email', 'password', 'first_name', 'last_name', 'age', 'gender', 'native_language', 'spoken_languages', 'location', 'is_business']
+        fields = ['email', 'password', 'first_name', 'last_name', 'age', 'gender', 'native_language', 'spoken_languages', 'location', 'latitude', 'longitude', 'is_business']
 
     def create(self, validated_data):
         user = User.objects.create_user(**validated_data)
@@ -15,7 +15,7 @@ class RegisterSerializer(serializers.ModelSerializer):
 class UserProfileSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
-        fields = ['email', 'first_name', 'last_name', 'age', 'gender', 'native_language', 'spoken_languages', 'location']
+        fields = ['email', 'first_name', 'last_name', 'age', 'gender', 'native_language', 'spoken_languages', 'location', 'latitude', 'longitude']
 
 class BusinessProfileSerializer(serializers.ModelSerializer):
     class Meta:
@@ -29,4 +29,4 @@ class EventSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Event
-        fields = ['id', 'title', 'description', 'location', 'date', 'time', 'created_by', 'participants']
\ No newline at end of file
+        fields = ['id', 'title', 'description', 'location', 'latitude', 'longitude', 'date', 'time', 'created_by', 'participants']
\ No newline at end of file
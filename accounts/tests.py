@@ -1,10 +1,15 @@
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
-from .models import User, BusinessProfile, Event
+from .geo import cell_ranges, encode
+from .models import User, BusinessProfile, Event, SearchTrigram
+from .text import fold_text
+from django.core.cache import cache
+from django.core.management import call_command
 from django.urls import reverse
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.utils import timezone
 from datetime import datetime,timedelta
+import io
 
 class BusinessProfileTests(APITestCase):
     def setUp(self):
@@ -149,6 +154,295 @@ class UserSearchTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data), 1)  # user1
 
+    def test_filter_by_language_is_exact(self):
+        url = reverse('user_search')
+        # Подстрока больше не совпадает: "en" нет ни у кого, хотя есть "French" и "English"
+        response = self.client.get(url, {'language': 'en'})
+        self.assertEqual(len(response.data), 0)
+        response = self.client.get(url, {'language': ' english '})
+        self.assertEqual(len(response.data), 3)
+
+    def test_filter_by_several_languages(self):
+        url = reverse('user_search')
+        response = self.client.get(url, {'language': 'Spanish,French'})
+        self.assertEqual(sorted(user['email'] for user in response.data), ['user1@example.com', 'user2@example.com'])
+        response = self.client.get(url, {'language': ['English', 'French'], 'language_match': 'all'})
+        self.assertEqual([user['email'] for user in response.data], ['user2@example.com'])
+        response = self.client.get(url, {'language': 'English', 'language_match': 'some'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_language_index_follows_profile(self):
+        self.client.put(reverse('profile-update'), {'spoken_languages': ['Italian']}, format='json')
+        self.assertEqual(list(self.user1.language_index.values_list('language', flat=True)), ['italian'])
+        response = self.client.get(reverse('user_search'), {'language': 'Spanish'})
+        self.assertEqual(len(response.data), 0)
+
+        # Языки не менялись: индекс не трогается
+        user = User.objects.get(pk=self.user1.pk)
+        with self.assertNumQueries(1):
+            user.save(update_fields=['last_login'])
+
+    def test_location_prefix(self):
+        url = reverse('user_search')
+        response = self.client.get(url, {'location': 'new-york'})
+        self.assertEqual([user['email'] for user in response.data], ['user1@example.com'])
+        response = self.client.get(url, {'location': 'BER'})
+        self.assertEqual([user['email'] for user in response.data], ['user3@example.com'])
+        # Начало любого слова, а не только всей строки
+        response = self.client.get(url, {'location': 'York'})
+        self.assertEqual([user['email'] for user in response.data], ['user1@example.com'])
+        User.objects.create_user(email='mitte@example.com', password='password', location='Mitte, Berlin')
+        response = self.client.get(url, {'location': 'berlin'})
+        self.assertEqual([user['email'] for user in response.data], ['user3@example.com', 'mitte@example.com'])
+        response = self.client.get(url, {'location': 'mitte ber'})
+        self.assertEqual([user['email'] for user in response.data], ['mitte@example.com'])
+        response = self.client.get(url, {'location': 'ork'})
+        self.assertEqual(len(response.data), 0)
+
+    def test_search_columns_follow_profile(self):
+        self.assertEqual((self.user2.search_location, self.user2.age_bucket), ('paris', 25))
+        response = self.client.get(reverse('user_search'), {'age_bucket': 35})
+        self.assertEqual([user['email'] for user in response.data], ['user3@example.com'])
+        for value in ('adult', '30'):
+            response = self.client.get(reverse('user_search'), {'age_bucket': value})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        user = User.objects.get(pk=self.user2.pk)
+        # Профиль не менялся: колонки не пересчитываются, языки не читаются
+        with self.assertNumQueries(1):
+            user.save()
+        user.age = 36
+        with self.assertNumQueries(1):
+            user.save()
+        # Новое местоположение еще переписывает триграммы (SearchTrigram)
+        user.location = 'Lyon, France'
+        user.save()
+        user.refresh_from_db()
+        self.assertEqual((user.search_location, user.age_bucket), ('lyon france', 35))
+
+    def test_reindex_users(self):
+        # Изменения в обход save() колонки не обновляют, их чинит reindex_users
+        User.objects.filter(pk=self.user1.pk).update(location='Madrid', age=70, spoken_languages=['Catalan'])
+        out = io.StringIO()
+        call_command('reindex_users', '--batch-size', '2', stdout=out)
+        self.assertIn('Reindexed 3 users, 1 changed', out.getvalue())
+
+        user = User.objects.get(pk=self.user1.pk)
+        self.assertEqual((user.search_location, user.age_bucket), ('madrid', 65))
+        self.assertEqual(list(user.language_index.values_list('language', flat=True)), ['catalan'])
+        call_command('reindex_users', stdout=out)
+        self.assertIn('Reindexed 3 users, 0 changed', out.getvalue())
+
+class UserFacetsTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        profiles = [
+            (25, 'female', ['Spanish', 'English'], 'Berlin'),
+            (31, 'female', ['Spanish'], 'berlin, Germany'),
+            (33, 'male', ['German', 'English'], 'Berlin'),
+            (52, 'male', ['Spanish'], 'Madrid'),
+            (None, '', [], ''),
+        ]
+        self.users = [
+            User.objects.create_user(
+                email=f'user{i}@example.com', password='password', age=age, gender=gender,
+                spoken_languages=languages, location=location,
+            )
+            for i, (age, gender, languages, location) in enumerate(profiles)
+        ]
+        self.client.force_authenticate(self.users[0])
+        self.url = reverse('user_search')
+
+    def test_facets(self):
+        response = self.client.get(self.url, {'facets': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 5)
+        self.assertEqual(response.data['gender'], [
+            {'value': 'female', 'count': 2}, {'value': 'male', 'count': 2}, {'value': None, 'count': 1},
+        ])
+        self.assertEqual(response.data['age'], [
+            {'value': 25, 'label': '25–34', 'count': 3}, {'value': 45, 'label': '45–54', 'count': 1},
+        ])
+        self.assertEqual(response.data['languages'][:2], [{'value': 'spanish', 'count': 3}, {'value': 'english', 'count': 2}])
+        self.assertEqual(response.data['locations'][0]['count'], 2)
+        self.assertEqual(response.data['locations'][0]['value'], 'berlin')
+
+    def test_facets_follow_filters(self):
+        response = self.client.get(self.url, {'facets': 1, 'language': 'Spanish', 'gender': 'female'})
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(response.data['languages'], [{'value': 'spanish', 'count': 2}, {'value': 'english', 'count': 1}])
+
+    def test_facets_cached_until_profile_changes(self):
+        self.client.get(self.url, {'facets': 1})
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, {'facets': 1})
+        self.assertEqual(response.data['count'], 5)
+
+        # Вход пользователя (last_login) фасеты не меняет и кэш не сбрасывает
+        self.users[1].save(update_fields=['last_login'])
+        with self.assertNumQueries(0):
+            self.client.get(self.url, {'facets': 1})
+
+        self.users[4].gender = 'female'
+        self.users[4].save()
+        response = self.client.get(self.url, {'facets': 1})
+        self.assertEqual(response.data['gender'][0], {'value': 'female', 'count': 3})
+        User.objects.create_user(email='new@example.com', password='password')
+        self.assertEqual(self.client.get(self.url, {'facets': 1}).data['count'], 6)
+
+
+class GeoSearchTests(APITestCase):
+    def setUp(self):
+        points = {'berlin': (52.5200, 13.4050), 'potsdam': (52.3906, 13.0645), 'paris': (48.8566, 2.3522)}
+        self.users = {
+            name: User.objects.create_user(email=f'{name}@example.com', password='password', latitude=lat, longitude=lon)
+            for name, (lat, lon) in points.items()
+        }
+        User.objects.create_user(email='nowhere@example.com', password='password')
+        for name, (lat, lon) in points.items():
+            Event.objects.create(
+                title=f'Meetup {name}', location=name, latitude=lat, longitude=lon,
+                date=timezone.now(), time='18:00', creator=self.users[name],
+            )
+        self.client.force_authenticate(self.users['berlin'])
+
+    def emails(self, params):
+        response = self.client.get(reverse('user_search'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [user['email'] for user in response.data]
+
+    def test_geohash(self):
+        self.assertEqual(encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertEqual(self.users['berlin'].geohash, encode(52.52, 13.405))
+        self.assertEqual(cell_ranges(['u33d', 'u33e', 'u33g', 'u33z']), [['u33d', 'u33f'], ['u33g', 'u33h'], ['u33z', 'u33z~']])
+
+    def test_radius(self):
+        alexanderplatz = {'lat': 52.5219, 'lon': 13.4132}
+        self.assertEqual(self.emails({**alexanderplatz, 'radius_km': 5}), ['berlin@example.com'])
+        # Ближайшие сначала; Потсдам в ~27 км
+        self.assertEqual(self.emails({**alexanderplatz, 'radius_km': 40}), ['berlin@example.com', 'potsdam@example.com'])
+        self.assertEqual(self.emails({**alexanderplatz, 'radius_km': 20}), ['berlin@example.com'])
+
+        response = self.client.get(reverse('event_search'), {'lat': 48.86, 'lon': 2.35, 'radius_km': 3})
+        self.assertEqual([event['title'] for event in response.data], ['Meetup paris'])
+
+    def test_radius_across_antimeridian(self):
+        for name, lon in (('taveuni', 179.95), ('rabi', -179.95), ('suva', 178.44)):
+            User.objects.create_user(email=f'{name}@example.com', password='password', latitude=-16.8, longitude=lon)
+        # С lon=179.9 круг в 50 км заходит за 180 — на западные долготы
+        self.assertEqual(
+            self.emails({'lat': -16.8, 'lon': 179.9, 'radius_km': 50}), ['taveuni@example.com', 'rabi@example.com']
+        )
+        self.assertEqual(
+            self.emails({'lat': -16.8, 'lon': -179.9, 'radius_km': 50}), ['rabi@example.com', 'taveuni@example.com']
+        )
+
+    def test_radius_at_high_latitude(self):
+        # ~494 км от центра, у восточного края круга: dlat / cos(lat) дал бы только ±25.9°
+        User.objects.create_user(email='edge@example.com', password='password', latitude=80.95, longitude=26.5)
+        User.objects.create_user(email='outside@example.com', password='password', latitude=80.95, longitude=28)
+        self.assertEqual(self.emails({'lat': 80, 'lon': 0, 'radius_km': 500}), ['edge@example.com'])
+        # Круг с полюсом внутри покрывает все долготы
+        User.objects.create_user(email='pole@example.com', password='password', latitude=89.5, longitude=180)
+        self.assertEqual(self.emails({'lat': 89, 'lon': 0, 'radius_km': 300}), ['pole@example.com'])
+
+    def test_bbox_and_facets(self):
+        self.assertEqual(sorted(self.emails({'bbox': '12.5,52,14,53'})), ['berlin@example.com', 'potsdam@example.com'])
+        response = self.client.get(reverse('user_search'), {'bbox': '-10,40,20,60', 'facets': 1})
+        self.assertEqual(response.data['count'], 3)
+
+    def test_invalid_geo_params(self):
+        for params in ({'lat': 52.5}, {'lat': 95, 'lon': 0}, {'lat': 0, 'lon': 0, 'radius_km': -1}, {'bbox': '14,52,12,53'}):
+            response = self.client.get(reverse('user_search'), params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, params)
+
+    def test_coordinates_follow_profile(self):
+        self.client.put(reverse('profile-update'), {'latitude': 48.8566, 'longitude': 2.3522}, format='json')
+        self.assertEqual(User.objects.get(pk=self.users['berlin'].pk).geohash, encode(48.8566, 2.3522))
+        self.assertEqual(len(self.emails({'lat': 48.8566, 'lon': 2.3522, 'radius_km': 1})), 2)
+
+
+class FuzzySearchTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='munich@example.com', password='password', location='München, Germany')
+        User.objects.create_user(email='berlin@example.com', password='password', location='Berlin')
+        User.objects.create_user(email='kyiv@example.com', password='password', location='Київ')
+        for title, description, location in (
+            ('Board games night', 'Настольные игры и знакомства', 'Muenchen'),
+            ('Встреча эмигрантов', 'Discussing residence permits', 'Berlin Mitte'),
+            ('Language exchange', 'Deutsch und Englisch, gaming', 'Köln'),
+        ):
+            Event.objects.create(
+                title=title, description=description, location=location,
+                date=timezone.now(), time='18:00', creator=self.user,
+            )
+        self.client.force_authenticate(self.user)
+
+    def search(self, name, params):
+        response = self.client.get(reverse(name), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_fold_text(self):
+        self.assertEqual(fold_text('München, Bayern'), 'muenchen bayern')
+        self.assertEqual(fold_text('Київ'), 'kiyiv')
+        self.assertEqual(fold_text('São Paulo'), 'sao paulo')
+
+    def test_fuzzy_location(self):
+        for query in ('Muenchen', 'Munchen', 'münchen', 'Muenchn'):
+            data = self.search('user_search', {'location': query, 'location_match': 'fuzzy'})
+            self.assertEqual([user['email'] for user in data['results']], ['munich@example.com'], query)
+        data = self.search('user_search', {'location': 'Kyiv', 'location_match': 'fuzzy'})
+        self.assertEqual([user['email'] for user in data['results']], ['kyiv@example.com'])
+        # Без location_match — прежний поиск по началу, но тоже со сворачиванием
+        self.assertEqual(len(self.search('user_search', {'location': 'Muench'})), 1)
+        self.assertEqual(self.search('user_search', {'location': 'Muenchen', 'location_match': 'fuzzy', 'facets': 1})['count'], 1)
+
+        data = self.search('event_search', {'location': 'Munchen', 'location_match': 'fuzzy'})
+        self.assertEqual([event['title'] for event in data['results']], ['Board games night'])
+
+    def test_event_text_ranking_and_cursor(self):
+        data = self.search('event_search', {'q': 'vstrecha'})
+        self.assertEqual([event['title'] for event in data['results']], ['Встреча эмигрантов'])
+        # Точное совпадение выше неточного; страница из одного результата продолжается по курсору
+        data = self.search('event_search', {'q': 'games', 'similarity': 0.2, 'page_size': 1})
+        titles = [event['title'] for event in data['results']]
+        self.assertEqual(titles, ['Board games night'])
+        response = self.client.get(data['next'])
+        self.assertEqual([event['title'] for event in response.data['results']], ['Language exchange'])
+        self.assertEqual(self.search('event_search', {'q': 'games', 'similarity': 1})['next'], None)
+
+        for params in ({'q': 'games', 'similarity': 0}, {'q': 'games', 'similarity': 'x'}, {'location': 'a', 'location_match': 'any'}):
+            response = self.client.get(reverse('event_search'), params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, params)
+
+    def test_similarity_threshold(self):
+        for title, location in (('Yoga in the park', 'München'), ('Park run', 'Berlin'), ('Pagan rituals', 'Berlin')):
+            Event.objects.create(title=title, description='', location=location, date=timezone.now(), time='18:00', creator=self.user)
+        # "Park run" — 5 из 10 триграмм "yoga park", "Pagan rituals" — только 2: ниже порога 0.3
+        data = self.search('event_search', {'q': 'yoga park'})
+        self.assertEqual([event['title'] for event in data['results']], ['Yoga in the park', 'Park run'])
+        data = self.search('event_search', {'q': 'yoga park', 'similarity': 0.2})
+        self.assertEqual([event['title'] for event in data['results']], ['Yoga in the park', 'Park run', 'Pagan rituals'])
+        # Каждое условие со своим порогом
+        data = self.search('event_search', {'q': 'yoga park', 'location': 'Muenchen', 'location_match': 'fuzzy'})
+        self.assertEqual([event['title'] for event in data['results']], ['Yoga in the park'])
+
+    def test_index_follows_changes(self):
+        event = Event.objects.get(title='Language exchange')
+        event.location = 'Düsseldorf'
+        event.save()
+        data = self.search('event_search', {'location': 'Dusseldorf', 'location_match': 'fuzzy'})
+        self.assertEqual([item['title'] for item in data['results']], ['Language exchange'])
+
+        event.delete()
+        self.assertFalse(SearchTrigram.objects.filter(field__startswith='event.', object_id=event.pk).exists())
+        SearchTrigram.objects.filter(field='user.location').delete()
+        call_command('rebuild_trigram_index', stdout=io.StringIO())
+        data = self.search('user_search', {'location': 'Munchen', 'location_match': 'fuzzy'})
+        self.assertEqual(len(data['results']), 1)
+
+
 class EventTests(APITestCase):
     def setUp(self):
         self.creator = User.objects.create_user(email='creator@example.com', password='pass', is_business=True)
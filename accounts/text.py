@@ -0,0 +1,38 @@
+import re
+import unicodedata
+
+# Буквы, которые не сводятся к латинице снятием диакритики. Умлауты — по немецким правилам
+# (München → muenchen, как пишут без немецкой раскладки), кириллица — упрощенная транслитерация
+# (Берлин → berlin, Київ → kiyiv).
+TRANSLITERATION = str.maketrans({
+    'ä': 'ae', 'ö': 'oe', 'ü': 'ue', 'ß': 'ss', 'æ': 'ae', 'œ': 'oe', 'ø': 'o', 'å': 'a',
+    'ł': 'l', 'đ': 'd', 'ð': 'd', 'þ': 'th', 'ı': 'i',
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
+    'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'shch',
+    'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+    'і': 'i', 'ї': 'yi', 'є': 'ye', 'ґ': 'g', 'ў': 'u',
+})
+WORD_RE = re.compile(r"[^\W_]+")
+
+
+def fold_text(text):
+    """
+    Текст для поиска: нижний регистр, транслитерация, без диакритики и знаков препинания,
+    слова через пробел. "München, Bayern" и "Muenchen bayern" дают одно и то же.
+    """
+    text = str(text or "").casefold().translate(TRANSLITERATION)
+    text = "".join(char for char in unicodedata.normalize("NFKD", text) if not unicodedata.combining(char))
+    return " ".join(WORD_RE.findall(text))
+
+
+def trigrams(text):
+    """
+    Триграммы уже свернутого текста, как в pg_trgm: каждое слово дополняется двумя пробелами
+    слева и одним справа ("  ab", " ab", "ab ").
+    """
+    grams = set()
+    for word in WORD_RE.findall(text):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
@@ -1,6 +1,12 @@
 from rest_framework import generics, serializers, status, permissions
 from rest_framework.permissions import AllowAny, IsAuthenticated
+from chatbot.pagination import SearchCursorPagination
+from .geo import GeoFilter
 from .models import User, BusinessProfile, Event
+from .search import (
+    FuzzySearch, filter_languages, filter_location, match_mode, parse_age_bucket, parse_languages, parse_similarity,
+    user_facets,
+)
 from .serializers import RegisterSerializer, UserProfileSerializer, BusinessProfileSerializer, EventSerializer
 from rest_framework.response import Response
 from rest_framework.views import APIView
@@ -58,17 +64,76 @@ class RegisterView(generics.CreateAPIView):
     serializer_class = RegisterSerializer
     permission_classes = [AllowAny]
 
-class UserSearchView(generics.ListAPIView):
+class GeoSearchMixin:
+    """
+    Поиск по месту: ?lat=&lon=&radius_km= (ближайшие сначала) или ?bbox=min_lon,min_lat,max_lon,max_lat.
+    Объекты без координат в такой поиск не попадают.
+    """
+    distances = None
+
+    def filter_geo(self, queryset):
+        geo = GeoFilter.from_params(self.request.query_params)
+        if geo is None:
+            return queryset
+        queryset, self.distances = geo.apply(queryset)
+        return queryset
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.distances:
+            return sorted(queryset, key=lambda obj: self.distances[obj.pk])
+        return queryset
+
+class FuzzySearchMixin:
+    """
+    Нечеткий поиск (FuzzySearch) с порогом сходства ?similarity= от 0 до 1 (по умолчанию 0.3).
+    С нечеткими условиями результаты идут по убыванию сходства, страницы — по курсору.
+    """
+    search = None
+
+    def filter_fuzzy(self, queryset, terms):
+        self.search = FuzzySearch(terms, parse_similarity(self.request.query_params.get('similarity')))
+        return self.search.filter(queryset) if self.search else queryset
+
+    @property
+    def paginator(self):
+        if not self.search:
+            return super().paginator
+        if not hasattr(self, '_search_paginator'):
+            self._search_paginator = SearchCursorPagination()
+        return self._search_paginator
+
+    def filter_queryset(self, queryset):
+        # Порядок по сходству вместо порядка по расстоянию (GeoSearchMixin)
+        if self.search:
+            return self.search.within(queryset)
+        return super().filter_queryset(queryset)
+
+class UserSearchView(FuzzySearchMixin, GeoSearchMixin, generics.ListAPIView):
+    """
+    Поиск пользователей: ?age_min, ?age_max, ?age_bucket, ?gender, ?language (?language_match=all|any),
+    ?location (по началу или ?location_match=fuzzy — нечетко, FuzzySearchMixin),
+    ?lat/?lon/?radius_km или ?bbox (GeoSearchMixin).
+    ?facets=1 — вместо списка счетчики по полу, возрасту, языкам и местоположениям для тех же фильтров.
+    """
     permission_classes = [IsAuthenticated]
     serializer_class = UserProfileSerializer
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get('facets') in ('1', 'true'):
+            return Response(user_facets(self.get_queryset()))
+        return super().list(request, *args, **kwargs)
     
     def get_queryset(self):
         queryset = User.objects.all()
         age_min = self.request.query_params.get('age_min', None)
         age_max = self.request.query_params.get('age_max', None)
         gender = self.request.query_params.get('gender', None)
-        language = self.request.query_params.get('language', None)
+        languages = parse_languages(self.request.query_params.getlist('language'))
         location = self.request.query_params.get('location', None)
+        location_match = match_mode(self.request.query_params, 'location_match', ('prefix', 'fuzzy'))
+        age_group = self.request.query_params.get('age_bucket', None)
+        fuzzy = []
         
         if age_min:
             queryset = queryset.filter(age__gte=int(age_min))
@@ -76,12 +141,18 @@ class UserSearchView(generics.ListAPIView):
             queryset = queryset.filter(age__lte=int(age_max))
         if gender:
             queryset = queryset.filter(gender=gender)
-        if language:
-            queryset = queryset.filter(spoken_languages__icontains=language)
-        if location:
-            queryset = queryset.filter(location__icontains=location)
+        if age_group:
+            queryset = queryset.filter(age_bucket=parse_age_bucket(age_group))
+        if languages:
+            # ?language_match=all — только те, кто говорит на всех перечисленных языках
+            queryset = filter_languages(queryset, languages, self.request.query_params.get('language_match', 'any'))
+        if location and location_match == 'fuzzy':
+            fuzzy.append(('user.location', location))
+        elif location:
+            queryset = filter_location(queryset, location)
         
-        return queryset
+        queryset = self.filter_fuzzy(queryset, fuzzy)
+        return self.filter_geo(queryset)
 
 class EventListCreateView(generics.ListCreateAPIView):
     queryset = Event.objects.all()
@@ -138,7 +209,11 @@ class LeaveEventView(APIView):
             return Response({"detail": "You have left the event."}, status=status.HTTP_200_OK)
         return Response({"detail": "You are not a participant of this event."}, status=status.HTTP_400_BAD_REQUEST)
 
-class EventSearchView(generics.ListAPIView):
+class EventSearchView(FuzzySearchMixin, GeoSearchMixin, generics.ListAPIView):
+    """
+    Поиск событий: ?start_date, ?end_date, ?location (подстрока или ?location_match=fuzzy),
+    ?q — нечетко по названию и описанию (FuzzySearchMixin), ?lat/?lon/?radius_km или ?bbox (GeoSearchMixin).
+    """
     permission_classes = [IsAuthenticated]
     serializer_class = EventSerializer
     
@@ -156,8 +231,17 @@ class EventSearchView(generics.ListAPIView):
         
         # Фильтрация по местоположению
         location = self.request.query_params.get('location', None)
-        if location:
+        location_match = match_mode(self.request.query_params, 'location_match', ('contains', 'fuzzy'))
+        fuzzy = []
+        if location and location_match == 'fuzzy':
+            fuzzy.append(('event.location', location))
+        elif location:
             queryset = queryset.filter(location__icontains=location)
-        
 
-        return queryset
\ No newline at end of file
+        # Нечеткий поиск по названию и описанию
+        if self.request.query_params.get('q'):
+            fuzzy.append(('event.text', self.request.query_params['q']))
+        queryset = self.filter_fuzzy(queryset, fuzzy)
+
+        # Поиск по радиусу или прямоугольнику
+        return self.filter_geo(queryset)
\ No newline at end of file
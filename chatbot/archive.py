@@ -0,0 +1,168 @@
+import datetime
+import json
+import time
+import zlib
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import ChatMessage, Conversation, ConversationArchive, TurnMetrics
+from .prompt import forget_prompt
+from .routing import active_conversations
+
+# Поля сообщения в архиве; TurnMetrics и ключи идемпотентности не архивируются
+ARCHIVE_FIELDS = ('id', 'user_id', 'message', 'response', 'sentiment', 'status', 'file', 'created_at')
+ARCHIVE_VERSION = 1
+FILE_INDEX = ARCHIVE_FIELDS.index('file')
+COMPRESSION_LEVEL = 6
+
+
+def pack(rows):
+    """rows — кортежи значений ARCHIVE_FIELDS. Возвращает (сжатые данные, размер до сжатия)."""
+    raw = json.dumps(
+        {"v": ARCHIVE_VERSION, "fields": ARCHIVE_FIELDS, "rows": rows},
+        ensure_ascii=False, separators=(",", ":"), default=str,
+    ).encode("utf-8")
+    return zlib.compress(raw, COMPRESSION_LEVEL), len(raw)
+
+
+def unpack(archive):
+    """Несохраненные ChatMessage из архива беседы, по порядку (created_at, id)."""
+    payload = json.loads(zlib.decompress(bytes(archive.data)))
+    messages = []
+    for row in payload["rows"]:
+        values = dict(zip(payload["fields"], row))
+        values["created_at"] = parse_datetime(values["created_at"])
+        values["file"] = values["file"] or None
+        messages.append(ChatMessage(conversation_id=archive.conversation_id, **values))
+    return messages
+
+
+def archived_messages(conversation):
+    archive = ConversationArchive.objects.filter(conversation=conversation).first()
+    return unpack(archive) if archive is not None else []
+
+
+def inactive_conversations(days=None):
+    days = settings.CHATBOT_ARCHIVE_AFTER_DAYS if days is None else days
+    cutoff = timezone.now() - datetime.timedelta(days=days)
+    return Conversation.objects.filter(archived_at__isnull=True, last_message_at__lt=cutoff, message_count__gt=0)
+
+
+def message_stats(conversation_ids):
+    rows = (
+        ChatMessage.objects.filter(conversation_id__in=conversation_ids)
+        .values('conversation_id').annotate(count=Count('id'), last=Max('id'))
+        .values_list('conversation_id', 'count', 'last')
+    )
+    return {conversation_id: (count, last) for conversation_id, count, last in rows}
+
+
+def delete_rows(model, column, values):
+    # DELETE без сигналов и каскадов ORM
+    with connection.cursor() as cursor:
+        placeholders = ", ".join(["%s"] * len(values))
+        cursor.execute(f"DELETE FROM {model._meta.db_table} WHERE {column} IN ({placeholders})", values)
+
+
+def archive_batch(conversation_ids):
+    """
+    Переносит сообщения бесед в архив. Чтение и сжатие — до транзакции; в транзакции только
+    вставка архивов и удаление строк, поэтому блокировка на запись короткая. Беседа, в которую
+    после чтения пришло сообщение, пропускается. Возвращает (бесед, сообщений) в архиве.
+    """
+    rows = {}
+    for values in (
+        ChatMessage.objects.filter(conversation_id__in=conversation_ids)
+        .order_by('conversation_id', 'created_at', 'id').values_list('conversation_id', *ARCHIVE_FIELDS)
+    ):
+        rows.setdefault(values[0], []).append(values[1:])
+    snapshot = message_stats(conversation_ids)
+    packed = {conversation_id: pack(messages) for conversation_id, messages in rows.items()}
+
+    with transaction.atomic():
+        # Блокировка бесед: на Postgres новое сообщение в них ждет конца транзакции
+        candidates = set(
+            Conversation.objects.select_for_update()
+            .filter(pk__in=list(packed), archived_at__isnull=True).values_list('pk', flat=True)
+        )
+        current = message_stats(list(candidates))
+        ready = [pk for pk in candidates if current.get(pk) == snapshot.get(pk)]
+        if not ready:
+            return 0, 0
+
+        ConversationArchive.objects.bulk_create([
+            ConversationArchive(
+                conversation_id=pk, data=packed[pk][0], raw_size=packed[pk][1], message_count=len(rows[pk]),
+                files=sorted({row[FILE_INDEX] for row in rows[pk] if row[FILE_INDEX]}),
+            )
+            for pk in ready
+        ])
+        TurnMetrics.objects.filter(message__conversation_id__in=ready).delete()
+        # В обход сигналов post_delete: счетчики беседы и ссылки на файлы остаются за архивом
+        delete_rows(ChatMessage, 'conversation_id', ready)
+        Conversation.objects.filter(pk__in=ready).update(archived_at=timezone.now())
+        users = set(Conversation.objects.filter(pk__in=ready, is_active=True).values_list('user_id', flat=True))
+    for user_id in users:
+        active_conversations.forget(user_id)
+    forget_prompt(*ready)
+    return len(ready), sum(len(rows[pk]) for pk in ready)
+
+
+def archive_inactive(days=None, batch_size=None, max_messages=None, max_batches=None, pause=0.0):
+    """
+    Архивирует беседы без активности дольше days дней пачками: не больше batch_size бесед
+    и примерно max_messages сообщений в пачке, между пачками пауза pause секунд.
+    Возвращает (бесед, сообщений) в архиве.
+    """
+    batch_size = batch_size or settings.CHATBOT_ARCHIVE_BATCH_SIZE
+    max_messages = max_messages or settings.CHATBOT_ARCHIVE_BATCH_MESSAGES
+    candidates = inactive_conversations(days).order_by('id')
+    archived = messages = batches = 0
+    last_id = 0
+    while max_batches is None or batches < max_batches:
+        page = list(candidates.filter(id__gt=last_id).values_list('id', 'message_count')[:batch_size])
+        if not page:
+            break
+        batch, total = [], 0
+        for pk, count in page:
+            if batch and total + count > max_messages:
+                break
+            batch.append(pk)
+            total += count
+        last_id = batch[-1]
+
+        done, moved = archive_batch(batch)
+        archived += done
+        messages += moved
+        batches += 1
+        if pause:
+            time.sleep(pause)
+    return archived, messages
+
+
+@transaction.atomic
+def rehydrate(conversation):
+    """Возвращает сообщения беседы из архива в ChatMessage (с прежними id). Возвращает их число."""
+    archive = ConversationArchive.objects.select_for_update().filter(conversation=conversation).first()
+    restored = 0
+    if archive is not None:
+        messages = unpack(archive)
+        created = [msg.created_at for msg in messages]
+        # bulk_create не вызывает save(): счетчики беседы уже учитывают эти сообщения
+        ChatMessage.objects.bulk_create(messages, batch_size=500)
+        # auto_now_add при вставке ставит текущее время, прежнее возвращается отдельно
+        for msg, created_at in zip(messages, created):
+            msg.created_at = created_at
+        ChatMessage.objects.bulk_update(messages, ['created_at'], batch_size=500)
+        # Архив удаляется без сигнала: файлы снова принадлежат восстановленным сообщениям
+        delete_rows(ConversationArchive, 'conversation_id', [archive.pk])
+        restored = len(messages)
+    Conversation.objects.filter(pk=conversation.pk).update(archived_at=None)
+    conversation.archived_at = None
+    active_conversations.forget(conversation.user_id)
+    forget_prompt(conversation.pk)
+    return restored
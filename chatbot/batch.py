@@ -0,0 +1,176 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.db import transaction
+
+from .context import build_context
+from .llm import LLMError, LLMTimeout, LLMUnavailable
+from .metrics import TurnStats
+from .models import ChatMessage, Conversation, count_new_messages
+from .sentiment import analyze_sentiment_many
+from .pubsub import notify_message
+from .routing import active_conversations
+from .serializers import ChatMessageSerializer
+from .singleflight import SingleFlightError, SingleFlightTimeout
+from .tasks import index_chat_messages
+from .utils import lookup_response, request_response
+
+
+def upstream_error(exc):
+    """Статус и текст ошибки модели — как у ChatBotView."""
+    if isinstance(exc, (SingleFlightTimeout, LLMTimeout)):
+        return 504, "Response generation timed out"
+    if isinstance(exc, LLMUnavailable):
+        return 503, "Response generation is temporarily unavailable"
+    if isinstance(exc, (SingleFlightError, LLMError)):
+        return 502, "Response generation failed"
+    raise exc
+
+
+@dataclass
+class BatchItem:
+    index: int
+    message: str = ""
+    conversation_id: int = None
+    conversation: Conversation = None
+    context: object = None
+    cache_key: str = None
+    response: str = None
+    sentiment: str = ""
+    chat: ChatMessage = None
+    error: tuple = None  # (статус, текст)
+    stats: TurnStats = field(default_factory=TurnStats)
+
+    def fail(self, status, text):
+        self.error = (status, text)
+
+    def result(self):
+        if self.error:
+            status, text = self.error
+            return {"index": self.index, "status": status, "error": text}
+        return {"index": self.index, "status": 201, "message": ChatMessageSerializer(self.chat).data}
+
+
+class ChatBatch:
+    """
+    Пакет независимых сообщений одного пользователя, возможно в разные беседы.
+    Тональность считается одним вызовом на весь пакет, модель вызывается параллельно
+    (не больше CHATBOT_BATCH_CONCURRENCY запросов), ответы сохраняются одним bulk_create.
+    Ошибка одного элемента не мешает остальным: результат у каждого свой.
+
+    В потоках пула выполняются только вызовы модели: контекст, ключи кэша и запись в БД —
+    в потоке запроса, у потоков пула нет его соединения с БД и транзакции.
+    """
+
+    def __init__(self, user, items, use_cache=True):
+        self.user = user
+        self.use_cache = use_cache
+        self.items = [self.parse(index, raw) for index, raw in enumerate(items)]
+
+    def parse(self, index, raw):
+        item = BatchItem(index)
+        if not isinstance(raw, dict):
+            item.fail(400, "Item must be an object")
+            return item
+        message = raw.get("message")
+        if not isinstance(message, str) or not message.strip():
+            item.fail(400, "Message is required")
+            return item
+        conversation_id = raw.get("conversation_id")
+        if conversation_id is not None and (isinstance(conversation_id, bool) or not isinstance(conversation_id, int)):
+            item.fail(400, "conversation_id must be an integer")
+            return item
+        item.message = message
+        item.conversation_id = conversation_id
+        return item
+
+    @property
+    def pending(self):
+        return [item for item in self.items if item.error is None]
+
+    def run(self):
+        shared = TurnStats()
+        with shared.track_db():
+            self.resolve_conversations()
+            self.analyze_sentiment(shared)
+            for item in self.pending:
+                item.context = build_context(item.message, item.conversation)
+                item.cache_key, item.response = lookup_response(
+                    item.message, item.context, self.user.pk, self.use_cache, item.stats
+                )
+        self.request_responses()
+        with shared.track_db():
+            self.save()
+        # Время SQL и тональности общее на пакет, делится поровну между сохраненными ходами
+        saved = [item for item in self.items if item.chat is not None]
+        for item in saved:
+            item.stats.db_ms = shared.db_ms / len(saved)
+            item.stats.sentiment_ms = shared.sentiment_ms / len(saved)
+            item.stats.record(item.chat)
+        return [item.result() for item in self.items]
+
+    def resolve_conversations(self):
+        # Элементы без conversation_id пишутся в активную беседу пользователя
+        ids = {item.conversation_id for item in self.pending if item.conversation_id is not None}
+        conversations = Conversation.objects.filter(user=self.user, pk__in=ids).in_bulk() if ids else {}
+        default = None
+        for item in self.pending:
+            if item.conversation_id is None:
+                if default is None:
+                    default = active_conversations.get(self.user)
+                item.conversation = default
+            elif item.conversation_id in conversations:
+                item.conversation = conversations[item.conversation_id]
+            else:
+                item.fail(404, "Conversation not found")
+
+    def analyze_sentiment(self, shared):
+        items = self.pending
+        with shared.timer('sentiment_ms'):
+            sentiments = analyze_sentiment_many([item.message for item in items])
+        for item, sentiment in zip(items, sentiments):
+            item.sentiment = sentiment
+
+    def request_responses(self):
+        misses = [item for item in self.pending if item.response is None]
+        if not misses:
+            return
+
+        def request(item):
+            try:
+                item.response = request_response(item.context, item.cache_key, item.stats)
+            except Exception as exc:
+                item.fail(*upstream_error(exc))
+
+        workers = min(settings.CHATBOT_BATCH_CONCURRENCY, len(misses))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chat-batch") as pool:
+            # list() дожидается всех и пробрасывает непредвиденные ошибки
+            list(pool.map(request, misses))
+
+    def save(self):
+        items = self.pending
+        if not items:
+            return
+        with transaction.atomic():
+            chats = ChatMessage.objects.bulk_create([
+                ChatMessage(
+                    user=self.user, conversation=item.conversation, message=item.message,
+                    response=item.response, sentiment=item.sentiment,
+                )
+                for item in items
+            ])
+            for item, chat in zip(items, chats):
+                item.chat = chat
+                notify_message(chat)
+            # bulk_create не вызывает save(): счетчики бесед одним UPDATE на беседу
+            by_conversation = {}
+            for chat in chats:
+                by_conversation.setdefault(chat.conversation_id, []).append(chat)
+            for conversation_id, messages in by_conversation.items():
+                count_new_messages(conversation_id, messages)
+            # ...и не отправляет post_save: ходы рассылаются подключениям выше, в долговременную память
+            # добавляются одной задачей
+            if settings.CHATBOT_MEMORY_ENABLED:
+                ids = [chat.pk for chat in chats]
+                transaction.on_commit(lambda: index_chat_messages.delay(ids))
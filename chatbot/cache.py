@@ -0,0 +1,96 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .models import UserSettings
+
+
+class ResponseCache:
+    """
+    Кэш ответов модели в памяти процесса: LRU с ограничением размера и TTL.
+    Потокобезопасен, считает попадания и промахи.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] <= time.monotonic():
+                del self._data[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+DEFAULT_LANGUAGE = UserSettings._meta.get_field("preferred_language").default
+DEFAULT_TONE = UserSettings._meta.get_field("tone_of_voice").default
+
+response_cache = ResponseCache(settings.CHATBOT_RESPONSE_CACHE_SIZE, settings.CHATBOT_RESPONSE_CACHE_TTL)
+
+
+def normalize_message(text):
+    # "  Where do I get a Tax ID? " и "where do i get a tax id" дают один ключ
+    return " ".join(text.casefold().split()).rstrip("?!. ")
+
+
+def context_fingerprint(context):
+    # Все, что модель видит кроме нового сообщения: system prompt, summary, последние ходы
+    payload = json.dumps(context.messages[:-1], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def response_cache_key(message_text, context, user_id):
+    preferences = (
+        UserSettings.objects.filter(user_id=user_id).values_list("preferred_language", "tone_of_voice").first()
+        or (DEFAULT_LANGUAGE, DEFAULT_TONE)
+    )
+    payload = json.dumps([normalize_message(message_text), context_fingerprint(context), *preferences], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
@@ -0,0 +1,143 @@
+import logging
+from dataclasses import dataclass, field
+
+from django.conf import settings
+
+from .archive import rehydrate
+from .llm import LLMError
+from .memory import recall
+from .models import ChatMessage, Conversation
+from .prompt import prompt_prefix
+from .routing import active_conversations
+from .tokens import estimate_tokens, turn_tokens
+
+SYSTEM_PROMPT = "You are a helpful assistant."
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+MEMORY_PREFIX = "Relevant messages from earlier conversations with this user:"
+# Сколько старых ходов сворачиваем в summary за один вызов модели
+SUMMARY_BATCH = 50
+# Доля бюджета и окна CHATBOT_CONTEXT_MAX_TURNS, которую ходы занимают после свертки: следующие
+# ходы помещаются в запас, и summary пересчитывается раз в несколько ходов, а не на каждом
+FOLD_KEEP_RATIO = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ContextWindow:
+    messages: list
+    prompt_tokens: int
+    full_tokens: int  # сколько было бы, если отправить всю историю целиком
+    turns: list = field(default_factory=list)  # ходы, попавшие в контекст дословно
+    memories: list = field(default_factory=list)  # найденные по смыслу прошлые ходы
+
+    @property
+    def tokens_saved(self):
+        return max(0, self.full_tokens - self.prompt_tokens)
+
+
+def build_context(message_text, conversation, budget=None):
+    """
+    Собирает сообщения для модели в пределах бюджета токенов:
+    последние ходы дословно, более старые заменены сохраненным summary беседы.
+    Берутся только ходы после summary, не больше CHATBOT_CONTEXT_MAX_TURNS, из кэша
+    беседы (chatbot/prompt.py); сообщения, ответ на которые еще не получен, пропускаются.
+    """
+    if budget is None:
+        budget = settings.CHATBOT_CONTEXT_TOKEN_BUDGET
+    if conversation.archived_at is not None:
+        # Новое сообщение в архивной беседе: она снова активна, история возвращается в основную таблицу
+        rehydrate(conversation)
+
+    fixed_tokens = estimate_tokens(SYSTEM_PROMPT) + estimate_tokens(message_text)
+    available = budget - fixed_tokens - estimate_tokens(conversation.summary)
+
+    # Ходы после summary из кэша беседы: из БД дочитываются только новые
+    prefix = prompt_prefix(conversation)
+    kept, turn_messages, used, total = prefix.tail(available)
+
+    if len(kept) < total or total >= settings.CHATBOT_CONTEXT_MAX_TURNS:
+        # Старые ходы не влезли (или лежат за окном чтения): дописываем их в summary с запасом —
+        # дословно остается не больше FOLD_KEEP_RATIO бюджета и окна — и пересчитываем бюджет
+        keep = prefix.tail(available * FOLD_KEEP_RATIO)[0]
+        keep = keep[-max(1, int(settings.CHATBOT_CONTEXT_MAX_TURNS * FOLD_KEEP_RATIO)):]
+        fold_into_summary(conversation, before_id=(keep[0].id if keep else prefix.last_id + 1))
+        prefix.fold(conversation.summarized_until)
+        available = budget - fixed_tokens - estimate_tokens(conversation.summary)
+        kept, turn_messages, used, total = prefix.tail(available)
+
+    # Остаток бюджета — прошлым ходам, близким к новому сообщению и не попавшим в контекст дословно
+    memories = []
+    memory_tokens = 0
+    if settings.CHATBOT_MEMORY_ENABLED and available - used > 0:
+        memory_tokens = estimate_tokens(MEMORY_PREFIX)
+        for msg in recall(conversation.user_id, message_text, exclude=[msg.id for msg in kept]):
+            cost = turn_tokens(msg.message, msg.response)
+            if used + memory_tokens + cost > available:
+                break
+            memories.append(msg)
+            memory_tokens += cost
+        if not memories:
+            memory_tokens = 0
+
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if conversation.summary:
+        messages.append({"role": "system", "content": SUMMARY_PREFIX + conversation.summary})
+    if memories:
+        messages.append({"role": "system", "content": format_memories(memories)})
+    messages.extend(turn_messages)
+    messages.append({"role": "user", "content": message_text})
+
+    return ContextWindow(
+        messages=messages,
+        prompt_tokens=fixed_tokens + estimate_tokens(conversation.summary) + used + memory_tokens,
+        full_tokens=fixed_tokens + conversation.history_tokens,
+        turns=kept,
+        memories=memories,
+    )
+
+
+def format_memories(memories):
+    # В хронологическом порядке, как их видел пользователь
+    lines = [MEMORY_PREFIX]
+    for msg in sorted(memories, key=lambda msg: (msg.created_at, msg.id)):
+        lines.append(f"User: {msg.message}\nAssistant: {msg.response}")
+    return "\n\n".join(lines)
+
+
+def fold_into_summary(conversation, before_id):
+    """
+    Дописывает в summary беседы все еще не свернутые ходы с id < before_id. Свертка не обязательна
+    для ответа: если модель недоступна, сохраняется то, что успели свернуть, а остальные ходы
+    остаются в истории — build_context урежет их по бюджету и попробует свернуть на следующем ходу.
+    """
+    # Импорт здесь, чтобы не было циклического импорта с utils
+    from .utils import summarize_turns
+
+    summary = conversation.summary
+    summarized_until = conversation.summarized_until
+    pending = conversation.chatmessage_set.filter(
+        id__gt=summarized_until, id__lt=before_id, status=ChatMessage.DONE
+    ).order_by('id')
+    while True:
+        batch = list(pending.filter(id__gt=summarized_until).only('id', 'conversation', 'message', 'response')[:SUMMARY_BATCH])
+        if not batch:
+            break
+        try:
+            summary = summarize_turns(summary, [(msg.message, msg.response) for msg in batch])
+        except LLMError as exc:
+            logger.warning("conversation %s: summary not updated: %s", conversation.pk, exc)
+            break
+        summarized_until = batch[-1].id
+
+    if summarized_until == conversation.summarized_until:
+        return
+
+    # Если другой запрос уже обновил summary, его версия не перезаписывается
+    Conversation.objects.filter(pk=conversation.pk, summarized_until=conversation.summarized_until).update(
+        summary=summary, summarized_until=summarized_until
+    )
+    conversation.summary = summary
+    conversation.summarized_until = summarized_until
+    # Активная беседа кэшируется вместе с summary (chatbot/routing.py)
+    active_conversations.forget(conversation.user_id)
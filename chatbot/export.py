@@ -0,0 +1,130 @@
+import datetime
+import heapq
+import json
+import zlib
+from itertools import islice
+from operator import attrgetter, itemgetter
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+
+from .archive import unpack
+from .models import ChatMessage, ConversationArchive
+
+EXPORT_FIELDS = ('id', 'conversation_id', 'message', 'response', 'sentiment', 'status', 'file', 'created_at')
+EXPORT_CHUNK_SIZE = 2000
+# Строки склеиваются в блоки такого размера перед отправкой (и сжатием)
+BLOCK_SIZE = 64 * 1024
+
+
+def parse_time(value, name):
+    """ISO-дата или дата со временем; дата без времени означает начало дня (UTC)."""
+    if not value:
+        return None
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            day = parse_date(value)
+            parsed = day and datetime.datetime.combine(day, datetime.time())
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise ValidationError({name: "Expected an ISO 8601 date or datetime."})
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, datetime.timezone.utc)
+    return parsed
+
+
+def export_queryset(user, conversation_id=None, since=None, until=None, after=None):
+    """
+    Сообщения пользователя в порядке id. after — id последней полученной строки:
+    с ним выгрузка продолжается с места обрыва. since включительно, until не включительно.
+    """
+    queryset = ChatMessage.objects.filter(user=user)
+    if conversation_id:
+        queryset = queryset.filter(conversation_id=conversation_id)
+    if since:
+        queryset = queryset.filter(created_at__gte=since)
+    if until:
+        queryset = queryset.filter(created_at__lt=until)
+    if after:
+        queryset = queryset.filter(id__gt=after)
+    return queryset.order_by('id').values(*EXPORT_FIELDS)
+
+
+def archive_rows(archive, user, since=None, until=None, after=None):
+    """Строки EXPORT_FIELDS одного архива в порядке id, с фильтрами export_queryset."""
+    messages = sorted(unpack(archive), key=attrgetter('id'))
+    for message in messages:
+        if message.user_id != user.pk or (after and message.id <= after):
+            continue
+        if (since and message.created_at < since) or (until and message.created_at >= until):
+            continue
+        yield {
+            'id': message.id,
+            'conversation_id': archive.conversation_id,
+            'message': message.message,
+            'response': message.response,
+            'sentiment': message.sentiment,
+            'status': message.status,
+            'file': message.file.name or '',
+            'created_at': message.created_at,
+        }
+
+
+def archived_rows(user, conversation_id=None, **filters):
+    """
+    Строки EXPORT_FIELDS из архивов бесед пользователя (chatbot/archive.py) в порядке id,
+    с теми же фильтрами, что export_queryset. Архивы сливаются лениво, по генератору на архив:
+    общий список архивных строк не собирается и не сортируется.
+    """
+    archives = ConversationArchive.objects.filter(conversation__user=user)
+    if conversation_id:
+        archives = archives.filter(conversation_id=conversation_id)
+    return heapq.merge(
+        *(archive_rows(archive, user, **filters) for archive in archives.only('conversation_id', 'data')),
+        key=itemgetter('id'),
+    )
+
+
+def export_rows(user, limit=None, chunk_size=EXPORT_CHUNK_SIZE, **filters):
+    """Живые и архивные сообщения пользователя одним потоком в порядке id; filters — как у export_queryset."""
+    # iterator(): строки читаются из БД порциями (server-side cursor), queryset их не кэширует
+    live = export_queryset(user, **filters).iterator(chunk_size=chunk_size)
+    rows = heapq.merge(live, archived_rows(user, **filters), key=itemgetter('id'))
+    return islice(rows, limit) if limit else rows
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        row['created_at'] = row['created_at'].isoformat()
+        yield json.dumps(row, ensure_ascii=False) + "\n"
+
+
+def encode_blocks(lines, compress=False):
+    """Байтовые блоки по ~BLOCK_SIZE; при compress — один непрерывный gzip-поток."""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+    buffer = []
+    size = 0
+
+    def flush(final=False):
+        block = b"".join(buffer)
+        buffer.clear()
+        if compressor is not None:
+            block = compressor.compress(block) + (compressor.flush() if final else b"")
+        return block
+
+    for line in lines:
+        data = line.encode('utf-8')
+        buffer.append(data)
+        size += len(data)
+        if size >= BLOCK_SIZE:
+            size = 0
+            block = flush()
+            if block:
+                yield block
+
+    block = flush(final=True)
+    if block:
+        yield block
@@ -0,0 +1,84 @@
+import asyncio
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+from .llm import BaseBackend, Completion, LLMTimeout, LLMUnavailable
+
+
+class FakeBackend(BaseBackend):
+    """
+    Локальный бэкенд без сети для тестов и нагрузочных прогонов (CHATBOT_LLM_BACKEND=fake).
+    Ответ фиксированный и отдается кусочками с настраиваемыми задержками.
+    errors — исключения, которые по очереди выбрасывают первые вызовы;
+    error_rate — доля вызовов, завершающихся LLMUnavailable, последовательность воспроизводима при том же seed.
+    """
+
+    def __init__(self, reply="Hello! How can I help you today?", first_token_delay=0.0, token_delay=0.0,
+                 errors=(), error_rate=0.0, seed=0, **kwargs):
+        kwargs.setdefault("name", "fake")
+        super().__init__(**kwargs)
+        self.reply = reply
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        self.errors = list(errors)
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = []
+        self.streams = []
+        self._lock = threading.Lock()
+
+    def tokens(self):
+        # Разбиваем ответ на "токены", сохраняя пробелы перед словами
+        return re.findall(r"\s*\S+", self.reply)
+
+    @property
+    def latency(self):
+        return self.first_token_delay + self.token_delay * len(self.tokens())
+
+    def record(self, messages, temperature, stream):
+        with self._lock:
+            self.calls.append({"model": self.model, "messages": messages, "temperature": temperature, "stream": stream})
+            if self.errors:
+                raise self.errors.pop(0)
+            if self.error_rate and self.random.random() < self.error_rate:
+                raise LLMUnavailable(f"{self.name}: simulated failure")
+
+    def completion(self, messages):
+        prompt_tokens, completion_tokens = self.estimate_usage(messages, self.reply)
+        return Completion(
+            text=self.reply, model=self.model, backend=self.name,
+            prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+        )
+
+    def complete(self, messages, temperature=None, timeout=None):
+        self.record(messages, temperature, stream=False)
+        if timeout is not None and self.latency > timeout:
+            time.sleep(timeout)
+            raise LLMTimeout(f"{self.name}: deadline exceeded")
+        time.sleep(self.latency)
+        return self.completion(messages)
+
+    async def acomplete(self, messages, temperature=None, timeout=None):
+        self.record(messages, temperature, stream=False)
+        await asyncio.sleep(self.latency)
+        return self.completion(messages)
+
+    def stream(self, messages, temperature=None, timeout=None):
+        self.record(messages, temperature, stream=True)
+        state = SimpleNamespace(sent=0, closed=False)
+        self.streams.append(state)
+        return self.iterate(state)
+
+    def iterate(self, state):
+        try:
+            time.sleep(self.first_token_delay)
+            for token in self.tokens():
+                if state.sent:
+                    time.sleep(self.token_delay)
+                state.sent += 1
+                yield token
+        finally:
+            state.closed = True
@@ -0,0 +1,429 @@
+import abc
+import asyncio
+import threading
+import time
+import weakref
+from dataclasses import dataclass
+
+import httpx
+import openai
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .tokens import estimate_tokens
+
+
+class LLMError(Exception):
+    """Ошибка запроса к модели, которую не исправят ни повтор, ни другой бэкенд (например, 400)."""
+
+
+class LLMUnavailable(LLMError):
+    """Бэкенд недоступен: сеть, 5xx, rate limit, открыт circuit breaker или заняты все слоты."""
+
+
+class LLMTimeout(LLMUnavailable):
+    """Вызов не уложился в дедлайн."""
+
+
+@dataclass
+class Completion:
+    text: str
+    model: str
+    backend: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class BaseBackend(abc.ABC):
+    """
+    Бэкенд модели: complete/acomplete возвращают Completion, stream — генератор кусочков текста.
+    timeout — сколько осталось до дедлайна вызова, в секундах.
+    """
+
+    def __init__(self, name=None, model="gpt-3.5-turbo", temperature=0.9):
+        self.name = name or type(self).__name__
+        self.model = model
+        self.temperature = temperature
+
+    @abc.abstractmethod
+    def complete(self, messages, temperature=None, timeout=None):
+        """Completion на messages."""
+
+    @abc.abstractmethod
+    async def acomplete(self, messages, temperature=None, timeout=None):
+        """То же без блокировки event loop."""
+
+    @abc.abstractmethod
+    def stream(self, messages, temperature=None, timeout=None):
+        """Генератор кусочков текста ответа."""
+
+    def estimate_usage(self, messages, text):
+        return sum(estimate_tokens(message["content"]) for message in messages), estimate_tokens(text)
+
+
+class OpenAIBackend(BaseBackend):
+    """
+    OpenAI Chat Completions через общий пул HTTP-соединений (httpx) на процесс.
+    Клиенты создаются при первом вызове; повторы делает вызывающий код (fallback, Celery), не SDK.
+    """
+
+    def __init__(self, api_key=None, base_url=None, max_connections=64, connect_timeout=5.0, **kwargs):
+        super().__init__(**kwargs)
+        self.api_key = api_key or settings.OPENAI_API_KEY
+        self.base_url = base_url or settings.OPENAI_BASE_URL
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self._client = None
+        self._client_lock = threading.Lock()
+        # httpx.AsyncClient привязан к event loop: по клиенту на loop
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def limits(self):
+        return httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+
+    def timeout(self, seconds):
+        if seconds is None:
+            return httpx.Timeout(None, connect=self.connect_timeout)
+        return httpx.Timeout(seconds, connect=min(self.connect_timeout, seconds))
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = openai.OpenAI(
+                        api_key=self.api_key, base_url=self.base_url, max_retries=0,
+                        http_client=httpx.Client(limits=self.limits()),
+                    )
+        return self._client
+
+    @property
+    def async_client(self):
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = self._async_clients[loop] = openai.AsyncOpenAI(
+                api_key=self.api_key, base_url=self.base_url, max_retries=0,
+                http_client=httpx.AsyncClient(limits=self.limits()),
+            )
+        return client
+
+    def translate(self, exc):
+        if isinstance(exc, openai.APITimeoutError):
+            return LLMTimeout(f"{self.name}: {exc}")
+        if isinstance(exc, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+            return LLMUnavailable(f"{self.name}: {exc}")
+        if isinstance(exc, openai.APIStatusError) and exc.status_code >= 500:
+            return LLMUnavailable(f"{self.name}: {exc}")
+        return LLMError(f"{self.name}: {exc}")
+
+    def request(self, messages, temperature, timeout, **kwargs):
+        return dict(
+            model=self.model,
+            messages=messages,
+            temperature=self.temperature if temperature is None else temperature,
+            timeout=self.timeout(timeout),
+            **kwargs,
+        )
+
+    def completion(self, response):
+        usage = response.usage
+        return Completion(
+            text=response.choices[0].message.content or "",
+            model=response.model or self.model,
+            backend=self.name,
+            prompt_tokens=usage.prompt_tokens if usage else 0,
+            completion_tokens=usage.completion_tokens if usage else 0,
+        )
+
+    def complete(self, messages, temperature=None, timeout=None):
+        try:
+            response = self.client.chat.completions.create(**self.request(messages, temperature, timeout))
+        except openai.OpenAIError as exc:
+            raise self.translate(exc) from exc
+        return self.completion(response)
+
+    async def acomplete(self, messages, temperature=None, timeout=None):
+        try:
+            response = await self.async_client.chat.completions.create(**self.request(messages, temperature, timeout))
+        except openai.OpenAIError as exc:
+            raise self.translate(exc) from exc
+        return self.completion(response)
+
+    def stream(self, messages, temperature=None, timeout=None):
+        try:
+            stream = self.client.chat.completions.create(**self.request(messages, temperature, timeout, stream=True))
+        except openai.OpenAIError as exc:
+            raise self.translate(exc) from exc
+        try:
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+        except openai.OpenAIError as exc:
+            raise self.translate(exc) from exc
+        finally:
+            stream.close()
+
+
+class CircuitBreaker:
+    """
+    После failure_threshold ошибок подряд бэкенд считается недоступным (open) и вызовы сразу отклоняются.
+    Через reset_timeout пропускается один пробный вызов (half-open): успех закрывает breaker, ошибка снова открывает.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self.probing and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.probing = False
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        # Пробный вызов не состоялся (например, не хватило слота): пропускаем следующий
+        with self._lock:
+            self.probing = False
+
+
+class GuardedBackend:
+    """Бэкенд с ограничением числа одновременных вызовов в процессе и circuit breaker."""
+
+    def __init__(self, backend, max_concurrency, breaker):
+        self.backend = backend
+        self.breaker = breaker
+        self.max_concurrency = max_concurrency
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._async_semaphores = weakref.WeakKeyDictionary()
+
+    @property
+    def name(self):
+        return self.backend.name
+
+    def acquire(self, deadline):
+        if not self.breaker.allow():
+            raise LLMUnavailable(f"{self.name}: circuit open")
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not self.semaphore.acquire(timeout=remaining):
+            self.breaker.release()
+            raise LLMTimeout(f"{self.name}: no free slot before deadline")
+        return deadline - time.monotonic()
+
+    def call(self, fn, deadline):
+        remaining = self.acquire(deadline)
+        try:
+            result = fn(remaining)
+        except LLMUnavailable:
+            self.breaker.record_failure()
+            raise
+        except LLMError:
+            # Бэкенд ответил (например, 400): он доступен
+            self.breaker.record_success()
+            raise
+        except BaseException:
+            self.breaker.release()
+            raise
+        finally:
+            self.semaphore.release()
+        self.breaker.record_success()
+        return result
+
+    async def acall(self, fn, deadline):
+        if not self.breaker.allow():
+            raise LLMUnavailable(f"{self.name}: circuit open")
+        loop = asyncio.get_running_loop()
+        semaphore = self._async_semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._async_semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        try:
+            await asyncio.wait_for(semaphore.acquire(), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            self.breaker.release()
+            raise LLMTimeout(f"{self.name}: no free slot before deadline") from None
+        try:
+            remaining = deadline - time.monotonic()
+            result = await asyncio.wait_for(fn(remaining), remaining)
+        except asyncio.TimeoutError:
+            self.breaker.record_failure()
+            raise LLMTimeout(f"{self.name}: deadline exceeded") from None
+        except LLMUnavailable:
+            self.breaker.record_failure()
+            raise
+        except LLMError:
+            self.breaker.record_success()
+            raise
+        except BaseException:
+            self.breaker.release()
+            raise
+        finally:
+            semaphore.release()
+        self.breaker.record_success()
+        return result
+
+    def stream(self, messages, temperature, deadline):
+        remaining = self.acquire(deadline)
+        deltas = None
+        try:
+            deltas = self.backend.stream(messages, temperature=temperature, timeout=remaining)
+            for delta in deltas:
+                yield delta
+                if time.monotonic() > deadline:
+                    raise LLMTimeout(f"{self.name}: deadline exceeded")
+        except LLMUnavailable:
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            # В том числе GeneratorExit: клиент закрыл поток, бэкенд тут ни при чем
+            self.breaker.release()
+            raise
+        else:
+            self.breaker.record_success()
+        finally:
+            if deltas is not None:
+                deltas.close()
+            self.semaphore.release()
+
+
+class LLMRouter:
+    """
+    Вызывает бэкенды по порядку: основной, затем запасные. К следующему переходит, если текущий
+    недоступен (ошибка, дедлайн, открытый breaker — в последнем случае без ожидания).
+    Дедлайн общий на весь вызов, включая запасные бэкенды.
+    """
+
+    def __init__(self, backends, timeout=30.0, max_concurrency=32, failure_threshold=5, reset_timeout=30.0):
+        self.timeout = timeout
+        self.guards = [
+            GuardedBackend(backend, max_concurrency, CircuitBreaker(failure_threshold, reset_timeout))
+            for backend in backends
+        ]
+
+    @property
+    def primary(self):
+        return self.guards[0].backend
+
+    def deadline(self, timeout):
+        return time.monotonic() + (self.timeout if timeout is None else timeout)
+
+    def complete(self, messages, temperature=None, timeout=None):
+        deadline = self.deadline(timeout)
+        error = None
+        for guard in self.guards:
+            try:
+                return guard.call(
+                    lambda remaining: guard.backend.complete(messages, temperature=temperature, timeout=remaining),
+                    deadline,
+                )
+            except LLMUnavailable as exc:
+                error = exc
+        raise error
+
+    async def acomplete(self, messages, temperature=None, timeout=None):
+        deadline = self.deadline(timeout)
+        error = None
+        for guard in self.guards:
+            try:
+                return await guard.acall(
+                    lambda remaining: guard.backend.acomplete(messages, temperature=temperature, timeout=remaining),
+                    deadline,
+                )
+            except LLMUnavailable as exc:
+                error = exc
+        raise error
+
+    def stream(self, messages, temperature=None, timeout=None):
+        # На запасной бэкенд переходим, только пока клиенту ничего не отправлено
+        deadline = self.deadline(timeout)
+        error = None
+        for guard in self.guards:
+            deltas = guard.stream(messages, temperature, deadline)
+            started = False
+            try:
+                for delta in deltas:
+                    started = True
+                    yield delta
+                return
+            except LLMUnavailable as exc:
+                if started:
+                    raise
+                error = exc
+            finally:
+                deltas.close()
+        raise error
+
+    def status(self):
+        return [
+            {"backend": guard.name, "model": guard.backend.model, "circuit": guard.breaker.state,
+             "failures": guard.breaker.failures}
+            for guard in self.guards
+        ]
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def build_router():
+    backends = []
+    for config in settings.CHATBOT_LLM_BACKENDS:
+        backend_class = import_string(config["BACKEND"])
+        backends.append(backend_class(**config.get("OPTIONS", {})))
+    return LLMRouter(
+        backends,
+        timeout=settings.CHATBOT_LLM_TIMEOUT,
+        max_concurrency=settings.CHATBOT_LLM_MAX_CONCURRENCY,
+        failure_threshold=settings.CHATBOT_LLM_BREAKER_THRESHOLD,
+        reset_timeout=settings.CHATBOT_LLM_BREAKER_RESET,
+    )
+
+
+def get_llm():
+    """Роутер бэкендов из CHATBOT_LLM_BACKENDS, один на процесс."""
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = build_router()
+    return _router
+
+
+@receiver(setting_changed)
+def reset_llm(setting, **kwargs):
+    # override_settings в тестах подменяет бэкенды
+    global _router
+    if setting.startswith("CHATBOT_LLM"):
+        _router = None
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chatbot.archive import archive_inactive, inactive_conversations
+
+
+class Command(BaseCommand):
+    help = (
+        "Переносит сообщения бесед без активности дольше --days дней в сжатый архив "
+        "(то же делает задача archive_inactive_conversations по расписанию)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=settings.CHATBOT_ARCHIVE_AFTER_DAYS)
+        parser.add_argument("--batch-size", type=int, default=settings.CHATBOT_ARCHIVE_BATCH_SIZE,
+                            help="Бесед в одной транзакции")
+        parser.add_argument("--max-messages", type=int, default=settings.CHATBOT_ARCHIVE_BATCH_MESSAGES,
+                            help="Примерно сообщений в одной транзакции")
+        parser.add_argument("--max-batches", type=int, help="Остановиться после стольких пачек")
+        parser.add_argument("--pause", type=float, default=0.0, help="Пауза между пачками, сек")
+        parser.add_argument("--dry-run", action="store_true", help="Только посчитать кандидатов")
+
+    def handle(self, *args, **options):
+        if options["dry_run"]:
+            count = inactive_conversations(options["days"]).count()
+            self.stdout.write(f"{count} conversations inactive for more than {options['days']} days")
+            return
+        conversations, messages = archive_inactive(
+            days=options["days"], batch_size=options["batch_size"], max_messages=options["max_messages"],
+            max_batches=options["max_batches"], pause=options["pause"],
+        )
+        self.stdout.write(self.style.SUCCESS(f"Archived {conversations} conversations ({messages} messages)"))
@@ -0,0 +1,179 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from accounts.models import User
+from chatbot import utils
+from chatbot.llm import get_llm
+from chatbot.models import Conversation
+
+
+class StubOpenAIServer:
+    """
+    Минимальный HTTP-сервер, отвечающий как /v1/chat/completions с фиксированной задержкой.
+    Доля error_rate ответов — 503, как у перегруженного upstream. Работает в отдельном потоке со своим event loop.
+    """
+
+    def __init__(self, latency, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.served = self.failed = 0
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.port = None
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                length = 0
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header.decode().partition(":")
+                    if name.lower() == "content-length":
+                        length = int(value)
+                if length:
+                    await reader.readexactly(length)
+
+                await asyncio.sleep(self.latency)
+                if self.error_rate and self.random.random() < self.error_rate:
+                    self.failed += 1
+                    body = json.dumps({"error": {"message": "overloaded", "type": "server_error"}}).encode()
+                    writer.write(
+                        b"HTTP/1.1 503 Service Unavailable\r\nContent-Type: application/json\r\n"
+                        b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+                    )
+                    await writer.drain()
+                    continue
+                self.served += 1
+                body = json.dumps({
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": "gpt-3.5-turbo",
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "Stub answer."},
+                        "finish_reason": "stop",
+                    }],
+                }).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    def start(self):
+        self.thread.start()
+        self.ready.wait()
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        server = self.loop.run_until_complete(asyncio.start_server(self.handle, "127.0.0.1", 0, backlog=4096))
+        self.port = server.sockets[0].getsockname()[1]
+        self.ready.set()
+        self.loop.run_forever()
+
+        # Закрываем keep-alive соединения клиентов перед остановкой loop
+        server.close()
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class Command(BaseCommand):
+    help = "Сравнивает requests/sec синхронного и асинхронного ask_openai на локальной заглушке OpenAI"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=1000)
+        parser.add_argument("--workers", type=int, default=8, help="Число потоков для синхронного пути")
+        parser.add_argument("--concurrency", type=int, default=500, help="Одновременных запросов в асинхронном пути")
+        parser.add_argument("--latency", type=float, default=0.2, help="Задержка ответа заглушки, сек")
+        parser.add_argument(
+            "--error-rate", type=float, default=0.0,
+            help="Доля 503 от основной заглушки; больше 0 — добавляется запасной бэкенд (failover и breaker)",
+        )
+
+    def handle(self, *args, **options):
+        total = options["requests"]
+        servers = [StubOpenAIServer(options["latency"], options["error_rate"])]
+        if options["error_rate"]:
+            servers.append(StubOpenAIServer(options["latency"]))
+        base_urls = [server.start() for server in servers]
+
+        user = User.objects.create_user(email=f"bench-{time.time_ns()}@example.com")
+        conversation = Conversation.objects.create(user=user)
+        # Настоящий OpenAIBackend (пул соединений, breaker, лимит) против локальной заглушки
+        override = override_settings(
+            CHATBOT_LLM_BACKENDS=[
+                {
+                    "BACKEND": "chatbot.llm.OpenAIBackend",
+                    "OPTIONS": {
+                        "name": f"stub-{i}", "api_key": "bench", "base_url": base_url,
+                        "max_connections": options["concurrency"],
+                    },
+                }
+                for i, base_url in enumerate(base_urls)
+            ],
+            CHATBOT_LLM_MAX_CONCURRENCY=options["concurrency"],
+        )
+        override.enable()
+        try:
+            # Без ResponseCache: иначе после первого запроса заглушка не вызывается и замеряются попадания в кэш
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options["workers"]) as pool:
+                list(pool.map(lambda i: utils.ask_openai("Hello", conversation, use_cache=False), range(total)))
+            sync_rps = total / (time.perf_counter() - started)
+            sync_status = get_llm().status()
+
+            async def run_async():
+                semaphore = asyncio.Semaphore(options["concurrency"])
+
+                async def one():
+                    async with semaphore:
+                        await utils.ask_openai_async("Hello", conversation, use_cache=False)
+
+                await asyncio.gather(*(one() for _ in range(total)))
+
+            started = time.perf_counter()
+            asyncio.run(run_async())
+            async_rps = total / (time.perf_counter() - started)
+            async_status = get_llm().status()
+        finally:
+            override.disable()
+            user.delete()
+            for server in servers:
+                server.stop()
+
+        self.stdout.write(f"upstream latency: {options['latency'] * 1000:.0f} ms, requests: {total}")
+        self.stdout.write(f"sync  ({options['workers']} threads):   {sync_rps:8.1f} req/s")
+        self.stdout.write(f"async (1 thread, {options['concurrency']} in flight): {async_rps:8.1f} req/s")
+        if options["error_rate"]:
+            for server, label in zip(servers, ("primary", "fallback")):
+                self.stdout.write(f"{label}: {server.served} served, {server.failed} failed (both runs)")
+            for label, status in (("sync", sync_status), ("async", async_status)):
+                circuits = ", ".join(f"{item['backend']} {item['circuit']} ({item['failures']} failures)" for item in status)
+                self.stdout.write(f"{label} breakers: {circuits}")
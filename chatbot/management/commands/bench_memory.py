@@ -0,0 +1,82 @@
+import random
+import statistics
+import tempfile
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from chatbot.memory import HashEmbedder, MemoryIndex
+
+WORDS = (
+    "anmeldung visa residence permit tax id bank account insurance apartment rent contract deposit "
+    "landlord appointment office form document passport health doctor school kindergarten job salary "
+    "language course integration citizenship driving license car registration mobile internet electricity "
+    "pension child benefit family doctor pharmacy emergency police city hall translation certificate"
+).split()
+
+
+class Command(BaseCommand):
+    help = "Замеряет поиск по векторному индексу памяти одного пользователя на --rows сообщениях (во временной папке)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=100_000)
+        parser.add_argument("--dim", type=int, default=256)
+        parser.add_argument("--k", type=int, default=4)
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--queries", type=int, default=200)
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        embedder = HashEmbedder(dim=options["dim"])
+
+        def text():
+            return " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 30)))
+
+        with tempfile.TemporaryDirectory() as root:
+            index = MemoryIndex(root, embedder.key, embedder.dim)
+            rows, batch_size = options["rows"], options["batch_size"]
+
+            started = time.perf_counter()
+            embed_time = 0.0
+            for start in range(0, rows, batch_size):
+                texts = [text() for _ in range(min(batch_size, rows - start))]
+                embedded = time.perf_counter()
+                vectors = embedder.embed_many(texts)
+                embed_time += time.perf_counter() - embedded
+                index.add(np.arange(start + 1, start + len(texts) + 1), vectors)
+            total = time.perf_counter() - started
+            size_mb = (index.vectors_path.stat().st_size + index.ids_path.stat().st_size) / 2 ** 20
+            self.stdout.write(
+                f"indexed {len(index)} messages in {total:.1f}s (embedding {embed_time:.1f}s), "
+                f"{size_mb:.1f} MiB on disk"
+            )
+
+            # Добавление одного хода в полный индекс (то, что делает index_chat_message)
+            appends = []
+            for i in range(20):
+                vector = embedder.embed_many([text()])
+                started = time.perf_counter()
+                index.add([rows + i + 1], vector)
+                appends.append(time.perf_counter() - started)
+            self.stdout.write(f"incremental add: {statistics.median(appends) * 1000:.2f} ms (median)")
+
+            queries = [text() for _ in range(options["queries"])]
+            self.report("search (top-k only)", [
+                self.timed(index.search, embedder.embed_many([query])[0], options["k"]) for query in queries
+            ])
+            self.report("embed + search", [
+                self.timed(lambda q: index.search(embedder.embed_many([q])[0], options["k"]), query)
+                for query in queries
+            ])
+
+    def timed(self, fn, *args):
+        started = time.perf_counter()
+        fn(*args)
+        return time.perf_counter() - started
+
+    def report(self, name, timings):
+        timings = sorted(timings)
+        p50 = timings[len(timings) // 2] * 1000
+        p95 = timings[int(len(timings) * 0.95)] * 1000
+        self.stdout.write(f"{name:<22} p50 {p50:7.2f} ms   p95 {p95:7.2f} ms")
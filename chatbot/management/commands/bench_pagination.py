@@ -0,0 +1,83 @@
+import base64
+import statistics
+import time
+from urllib.parse import urlencode
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from chatbot.models import ChatMessage, Conversation
+from chatbot.pagination import KeysetCursorPagination
+from chatbot.views import ChatHistoryView
+
+BATCH = 10000
+
+
+class Command(BaseCommand):
+    help = (
+        "Замеряет время страницы истории чата (курсор и OFFSET) по мере роста истории до --rows сообщений. "
+        "Данные создаются в транзакции и откатываются в конце."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1_000_000)
+        parser.add_argument("--page-size", type=int, default=50)
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        rows = options["rows"]
+        checkpoints = sorted({n for n in (1_000, 10_000, 100_000, 1_000_000) if n < rows} | {rows})
+
+        with transaction.atomic():
+            self.run(checkpoints, options["page_size"], options["repeat"])
+            transaction.set_rollback(True)
+
+    def run(self, checkpoints, page_size, repeat):
+        user = get_user_model().objects.create_user(email="bench-pagination@example.com", password="bench")
+        conversation = Conversation.objects.create(user=user)
+        view = ChatHistoryView.as_view()
+        factory = APIRequestFactory(HTTP_HOST="localhost")
+        url = f"/api/chatbot/conversations/{conversation.id}/messages/"
+
+        def page(**params):
+            request = factory.get(url, {"page_size": page_size, **params})
+            force_authenticate(request, user=user)
+            view(request, conversation_id=conversation.id).render()
+
+        def measure(fn):
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                fn()
+                timings.append(time.perf_counter() - started)
+            return statistics.median(timings) * 1000
+
+        self.stdout.write(f"{'rows':>10} {'first page':>12} {'cursor 90%':>12} {'offset 90%':>12}  (ms, median)")
+        inserted = 0
+        for checkpoint in checkpoints:
+            while inserted < checkpoint:
+                size = min(BATCH, checkpoint - inserted)
+                ChatMessage.objects.bulk_create(
+                    ChatMessage(user=user, conversation=conversation, message=f"question {inserted + i}",
+                                response=f"answer {inserted + i}")
+                    for i in range(size)
+                )
+                inserted += size
+
+            history = ChatMessage.objects.filter(conversation=conversation, user=user).order_by("created_at", "id")
+            depth = int(checkpoint * 0.9)
+            row = history[depth]
+            cursor = base64.b64encode(urlencode({"p": KeysetCursorPagination().position(row)}).encode()).decode()
+
+            first = measure(page)
+            deep = measure(lambda: page(cursor=cursor))
+            offset = measure(lambda: list(history[depth:depth + page_size]))
+            self.stdout.write(f"{checkpoint:>10} {first:>12.2f} {deep:>12.2f} {offset:>12.2f}")
+
+        deep_page = history.filter(KeysetCursorPagination().after_position(
+            KeysetCursorPagination().position(row), ["created_at", "id"]
+        ))[:page_size + 1]
+        self.stdout.write("\nquery plan for a deep cursor page:")
+        self.stdout.write(deep_page.explain())
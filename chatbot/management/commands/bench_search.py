@@ -0,0 +1,115 @@
+import itertools
+import random
+import statistics
+import time
+from urllib.parse import parse_qs, urlparse
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from chatbot.models import ChatMessage, Conversation
+from chatbot.search import MessageSearch
+from chatbot.views import ChatSearchView
+
+BATCH = 10000
+TOPIC_WORDS = (
+    "anmeldung visa residence permit tax id bank account insurance apartment rent contract deposit "
+    "landlord appointment office form document passport health doctor school kindergarten job salary "
+    "language course integration citizenship driving license car registration mobile internet electricity "
+    "pension child benefit family pharmacy emergency police city hall translation certificate"
+).split()
+STOP_WORDS = "the a to of and in for on with how where when do i my you your need can is are it".split()
+# Словарь с распределением Ципфа, как в живом тексте: частые служебные слова, редкие термины
+VOCABULARY = STOP_WORDS + TOPIC_WORDS + [f"w{i}" for i in range(20000)]
+CUM_WEIGHTS = list(itertools.accumulate(1 / rank for rank in range(1, len(VOCABULARY) + 1)))
+QUERIES = ["residence permit", "bank account", '"city hall" appointment', "kinder*", "driving license translation"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Замеряет поиск по истории чата (полнотекстовый индекс и LIKE по тексту) на --rows сообщениях "
+        "--users пользователей. Данные создаются в транзакции и откатываются в конце."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1_000_000)
+        parser.add_argument("--users", type=int, default=20)
+        parser.add_argument("--repeat", type=int, default=10)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run(options["rows"], options["users"], options["repeat"])
+            transaction.set_rollback(True)
+
+    def run(self, rows, user_count, repeat):
+        rng = random.Random(0)
+        User = get_user_model()
+        users = [User.objects.create_user(email=f"bench-search-{i}@example.com") for i in range(user_count)]
+        conversations = [Conversation.objects.create(user=user) for user in users]
+
+        def text(low, high):
+            # Темы разговора перемешаны со словарем, чтобы каждый термин встречался в части сообщений
+            words = rng.choices(VOCABULARY, cum_weights=CUM_WEIGHTS, k=rng.randint(low, high))
+            words[rng.randrange(len(words))] = rng.choice(TOPIC_WORDS)
+            return " ".join(words)
+
+        started = time.perf_counter()
+        for start in range(0, rows, BATCH):
+            ChatMessage.objects.bulk_create(
+                ChatMessage(user_id=conversation.user_id, conversation=conversation,
+                            message=text(5, 15), response=text(20, 60))
+                for conversation in (rng.choice(conversations) for _ in range(min(BATCH, rows - start)))
+            )
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f"inserted {rows} messages ({rows // user_count} per user) in {elapsed:.0f}s, "
+                          f"{rows / elapsed:.0f} rows/s with index triggers")
+
+        user = users[0]
+        view = ChatSearchView.as_view()
+        factory = APIRequestFactory(HTTP_HOST="localhost")
+
+        def search(query, **params):
+            request = factory.get("/api/chatbot/search/", {"q": query, **params})
+            force_authenticate(request, user=user)
+            return view(request).render()
+
+        def measure(fn):
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                fn()
+                timings.append(time.perf_counter() - started)
+            return statistics.median(timings) * 1000
+
+        def like(query):
+            # Без индекса: подстрока в вопросе или ответе по всем сообщениям пользователя
+            words = [word.strip('"*') for word in query.split()]
+            condition = Q()
+            for word in words:
+                condition &= Q(message__icontains=word) | Q(response__icontains=word)
+            return ChatMessage.objects.filter(condition, user=user)
+
+        # LIKE latest 20 — последние совпадения без ранжирования; LIKE all — все совпадения,
+        # без которых ранжировать нельзя
+        self.stdout.write(
+            f"\n{'query':<30} {'matches':>8} {'fts page 1':>11} {'fts page 5':>11} "
+            f"{'LIKE latest 20':>15} {'LIKE all':>9}  (ms, median)"
+        )
+        for query in QUERIES:
+            response = search(query, page_size=20)
+            cursor = None
+            for _ in range(4):
+                next_link = response.data["next"]
+                if not next_link:
+                    break
+                cursor = parse_qs(urlparse(next_link).query)["cursor"][0]
+                response = search(query, page_size=20, cursor=cursor)
+            matches = len(MessageSearch(user, query).fetch(limit=rows))
+            first = measure(lambda: search(query, page_size=20))
+            deep = measure(lambda: search(query, page_size=20, cursor=cursor)) if cursor else float("nan")
+            latest = measure(lambda: list(like(query).order_by("-id")[:20]))
+            scan = measure(lambda: list(like(query).values_list("id", flat=True)))
+            self.stdout.write(f"{query:<30} {matches:>8} {first:>11.1f} {deep:>11.1f} {latest:>15.1f} {scan:>9.1f}")
@@ -0,0 +1,77 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from chatbot.sentiment import LexiconSentiment, TextBlobSentiment, label, lexicon_paths
+
+FILLERS = [
+    "i", "am", "the", "it", "is", "this", "a", "my", "we", "today", "office", "visa", "appointment",
+    "address", "tax", "id", "bank", "account", "and", "but", "with", "for", "at", "registration",
+]
+EXTRAS = ["!", ",", ".", "?", ":)", ":(", "(!)", "not", "never", "no", "very", "really", "don't"]
+
+
+def make_corpus(size, seed=42):
+    """Синтетические сообщения: слова словаря вперемешку с нейтральными словами, отрицаниями и смайликами."""
+    rng = random.Random(seed)
+    lexicon = []
+    with open(lexicon_paths()[0], encoding="utf-8") as f:
+        for line in f:
+            word, _, _, flags = line.rstrip("\n").split("\t") if not line.startswith("#") else ("", "", "", "e")
+            if word and not flags:
+                lexicon.append(word)
+    corpus = []
+    for _ in range(size):
+        words = []
+        for _ in range(rng.randint(3, 25)):
+            roll = rng.random()
+            if roll < 0.2:
+                words.append(rng.choice(lexicon))
+            elif roll < 0.3:
+                words.append(rng.choice(EXTRAS))
+            else:
+                words.append(rng.choice(FILLERS))
+        text = " ".join(words)
+        corpus.append(text[0].upper() + text[1:])
+    return corpus
+
+
+class Command(BaseCommand):
+    help = "Сравнивает скорость и совпадение меток словарного движка тональности с TextBlob"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=20000)
+
+    def handle(self, *args, **options):
+        corpus = make_corpus(options["messages"])
+
+        started = time.perf_counter()
+        textblob = TextBlobSentiment()
+        textblob.score("warm up")
+        textblob_load = time.perf_counter() - started
+
+        started = time.perf_counter()
+        lexicon = LexiconSentiment(lexicon_paths())
+        lexicon_load = time.perf_counter() - started
+
+        started = time.perf_counter()
+        expected = [textblob.score(text) for text in corpus]
+        textblob_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        single = [lexicon.score(text) for text in corpus]
+        single_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        lexicon.score_many(corpus)
+        batch_time = time.perf_counter() - started
+
+        agree = sum(label(a) == label(b) for a, b in zip(expected, single))
+        total = len(corpus)
+        self.stdout.write(f"messages: {total}")
+        self.stdout.write(f"load:  textblob {textblob_load * 1000:7.1f} ms, lexicon {lexicon_load * 1000:7.1f} ms")
+        self.stdout.write(f"textblob:        {total / textblob_time:10.0f} msg/s")
+        self.stdout.write(f"lexicon:         {total / single_time:10.0f} msg/s")
+        self.stdout.write(f"lexicon (batch): {total / batch_time:10.0f} msg/s")
+        self.stdout.write(f"label agreement with textblob: {agree / total:.2%}")
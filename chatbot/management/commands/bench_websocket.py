@@ -0,0 +1,81 @@
+import asyncio
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from accounts.models import User
+from chatbot.pubsub import get_broker, user_channel
+from chatbot.websocket import WEBSOCKET_PATH, websocket_application
+
+
+class Command(BaseCommand):
+    help = "Открывает --connections простаивающих WebSocket-соединений в процессе: память на соединение и время рассылки"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--connections", type=int, default=5000)
+        parser.add_argument("--broadcasts", type=int, default=20, help="Событий, разосланных всем соединениям")
+
+    def handle(self, *args, **options):
+        user = User.objects.create_user(email=f"bench-{time.time_ns()}@example.com")
+        token = str(RefreshToken.for_user(user).access_token)
+        try:
+            report = asyncio.run(self.run(user, token, options["connections"], options["broadcasts"]))
+        finally:
+            user.delete()
+        for line in report:
+            self.stdout.write(line)
+
+    async def run(self, user, token, count, broadcasts):
+        scope = {"type": "websocket", "path": WEBSOCKET_PATH, "query_string": f"token={token}".encode(), "headers": []}
+        received = [0]
+        delivered = asyncio.Event()
+        target = [0]
+
+        async def send(message):
+            # Клиенты читают мгновенно: считаем только доставленные события
+            if message["type"] == "websocket.send":
+                received[0] += 1
+                if received[0] == target[0]:
+                    delivered.set()
+
+        inboxes = []
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        tasks = []
+        for _ in range(count):
+            inbox = asyncio.Queue()
+            inbox.put_nowait({"type": "websocket.connect"})
+            inboxes.append(inbox)
+            tasks.append(asyncio.create_task(websocket_application(scope, inbox.get, send)))
+        # Все соединения приняты и получили ready
+        target[0] = count
+        await delivered.wait()
+        connect_s = time.perf_counter() - started
+        await asyncio.sleep(0.1)
+        per_connection = (tracemalloc.get_traced_memory()[0] - baseline) / count
+        tracemalloc.stop()
+
+        latencies = []
+        broker = get_broker()
+        for i in range(broadcasts):
+            delivered.clear()
+            target[0] = received[0] + count
+            started = time.perf_counter()
+            broker.publish(user_channel(user.pk), {"type": "message", "message": {"id": i}})
+            await delivered.wait()
+            latencies.append((time.perf_counter() - started) * 1000)
+
+        for inbox in inboxes:
+            inbox.put_nowait({"type": "websocket.disconnect", "code": 1000})
+        await asyncio.gather(*tasks)
+
+        latencies.sort()
+        return [
+            f"connections: {count}, connect + auth: {connect_s:.2f} s ({count / connect_s:.0f}/s)",
+            f"memory per idle connection: {per_connection / 1024:.1f} KiB (tracemalloc)",
+            f"fan-out of one event to all connections: p50 {latencies[len(latencies) // 2]:.1f} ms, "
+            f"max {latencies[-1]:.1f} ms",
+        ]
@@ -0,0 +1,42 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from chatbot.sentiment import LEXICON_DIR
+
+
+class Command(BaseCommand):
+    help = "Собирает lexicons/en.tsv из лексикона TextBlob (pattern, PDDL) для движка chatbot.sentiment"
+
+    def handle(self, *args, **options):
+        from textblob._text import EMOTICONS
+        from textblob.en import sentiment
+
+        if not dict.__len__(sentiment):
+            sentiment.load()
+
+        rows = []
+        for word, senses in dict.items(sentiment):
+            # Многословные записи TextBlob никогда не совпадают с одиночным токеном
+            if " " in word:
+                continue
+            polarity, subjectivity, intensity = senses[None]
+            flags = "m" if any(pos in senses for pos in sentiment.modifiers) else ""
+            rows.append((word, polarity, intensity, flags))
+        for (mood, polarity), emoticons in EMOTICONS.items():
+            for emoticon in emoticons:
+                rows.append((emoticon.lower(), polarity, 1.0, "e"))
+        for word in sentiment.negations:
+            rows.append((word, None, None, "n"))
+
+        path = os.path.join(LEXICON_DIR, "en.tsv")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("# Generated by manage.py compile_sentiment_lexicon from the TextBlob/pattern lexicon (PDDL).\n")
+            f.write("# word\tpolarity\tintensity\tflags (m: modifier, n: negation, e: emoticon)\n")
+            for word, polarity, intensity, flags in sorted(rows, key=lambda row: (row[0], row[3])):
+                if polarity is None:
+                    f.write(f"{word}\t-\t-\t{flags}\n")
+                else:
+                    f.write(f"{word}\t{polarity!r}\t{intensity!r}\t{flags}\n")
+
+        self.stdout.write(f"Wrote {len(rows)} entries to {path}")
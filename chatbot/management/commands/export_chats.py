@@ -0,0 +1,53 @@
+import sys
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.exceptions import ValidationError
+
+from chatbot.export import EXPORT_CHUNK_SIZE, encode_blocks, export_rows, ndjson_lines, parse_time
+
+
+class Command(BaseCommand):
+    help = "Выгружает сообщения чата пользователя в NDJSON (по строке на сообщение), опционально в gzip"
+
+    def add_arguments(self, parser):
+        parser.add_argument("user", help="email или id пользователя")
+        parser.add_argument("--conversation", type=int)
+        parser.add_argument("--since", help="ISO дата/время, включительно")
+        parser.add_argument("--until", help="ISO дата/время, не включительно")
+        parser.add_argument("--after", type=int, help="продолжить после сообщения с этим id")
+        parser.add_argument("--limit", type=int)
+        parser.add_argument("--output", "-o", default="-", help="файл или - для stdout")
+        parser.add_argument("--gzip", action="store_true")
+        parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        lookup = {"pk": options["user"]} if options["user"].isdigit() else {"email": options["user"]}
+        try:
+            user = User.objects.get(**lookup)
+        except User.DoesNotExist:
+            raise CommandError(f"User {options['user']} not found")
+
+        try:
+            rows = export_rows(
+                user,
+                limit=options["limit"],
+                chunk_size=options["chunk_size"],
+                conversation_id=options["conversation"],
+                since=parse_time(options["since"], "since"),
+                until=parse_time(options["until"], "until"),
+                after=options["after"],
+            )
+        except ValidationError as exc:
+            raise CommandError(exc.detail)
+
+        blocks = encode_blocks(ndjson_lines(rows), compress=options["gzip"])
+        if options["output"] == "-":
+            for block in blocks:
+                sys.stdout.buffer.write(block)
+            sys.stdout.buffer.flush()
+        else:
+            with open(options["output"], "wb") as f:
+                for block in blocks:
+                    f.write(block)
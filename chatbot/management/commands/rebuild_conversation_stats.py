@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, Max, Min, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, NullIf, Substr
+
+from chatbot.models import PREVIEW_LENGTH, ChatMessage, Conversation
+
+
+def rebuild_stats(queryset):
+    """Пересчитывает счетчики и превью разговоров одним UPDATE с подзапросами по ChatMessage."""
+    messages = ChatMessage.objects.filter(conversation=OuterRef('pk'))
+    latest = messages.order_by('-created_at', '-id')
+    count = messages.order_by().values('conversation').annotate(count=Count('id')).values('count')
+    preview = latest.annotate(
+        preview=Substr(Coalesce(NullIf('response', Value('')), 'message'), 1, PREVIEW_LENGTH)
+    ).values('preview')[:1]
+    return queryset.update(
+        message_count=Coalesce(Subquery(count), 0),
+        last_message_at=Coalesce(Subquery(latest.values('created_at')[:1]), F('created_at')),
+        last_message_preview=Coalesce(Subquery(preview), Value('')),
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        "Пересчитывает message_count, last_message_at и last_message_preview разговоров "
+        "(после bulk-операций или ручных правок в БД)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--user", type=int, help="только разговоры пользователя с этим id")
+
+    def handle(self, *args, **options):
+        # У архивных бесед сообщений в ChatMessage нет, их счетчики не пересчитываются
+        conversations = Conversation.objects.filter(archived_at__isnull=True)
+        if options["user"]:
+            conversations = conversations.filter(user_id=options["user"])
+
+        bounds = conversations.aggregate(first=Min('id'), last=Max('id'))
+        if bounds['first'] is None:
+            self.stdout.write("No conversations")
+            return
+
+        # Пачками по диапазону id: каждый UPDATE короткий и не держит блокировку на всю таблицу
+        batch_size = options["batch_size"]
+        updated = 0
+        for start in range(bounds['first'], bounds['last'] + 1, batch_size):
+            updated += rebuild_stats(conversations.filter(id__gte=start, id__lt=start + batch_size))
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt stats for {updated} conversations"))
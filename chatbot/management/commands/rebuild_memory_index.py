@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from chatbot.memory import get_embedder, index_messages, user_index
+from chatbot.models import ChatMessage
+
+
+class Command(BaseCommand):
+    help = (
+        "Пересобирает векторные индексы долговременной памяти из ChatMessage: после смены модели "
+        "эмбеддингов, удаления сообщений или для истории, записанной до включения памяти"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--user", type=int, help="только индекс пользователя с этим id")
+
+    def handle(self, *args, **options):
+        messages = ChatMessage.objects.filter(status=ChatMessage.DONE)
+        if options["user"]:
+            messages = messages.filter(user_id=options["user"])
+        user_ids = messages.order_by().values_list('user_id', flat=True).distinct()
+
+        embedder = get_embedder()
+        batch_size = options["batch_size"]
+        total = 0
+        for user_id in user_ids.iterator():
+            user_index(user_id, embedder).clear()
+            # Пачками по id: одна пачка — один вызов модели эмбеддингов и одна запись в файлы
+            last_id = 0
+            while True:
+                batch = list(
+                    messages.filter(user_id=user_id, id__gt=last_id).order_by('id')
+                    .only('id', 'user', 'message', 'response', 'status')[:batch_size]
+                )
+                if not batch:
+                    break
+                total += index_messages(batch)
+                last_id = batch[-1].id
+        self.stdout.write(self.style.SUCCESS(f"Indexed {total} messages ({embedder.key})"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from chatbot.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Перестраивает полнотекстовый индекс сообщений чата (FTS5 на SQLite, GIN на Postgres) "
+        "из таблицы ChatMessage"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--optimize", action="store_true", help="SQLite: слить сегменты индекса в один")
+
+    def handle(self, *args, **options):
+        rebuild_index(optimize=options["optimize"])
+        self.stdout.write(self.style.SUCCESS("Search index rebuilt"))
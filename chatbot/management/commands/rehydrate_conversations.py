@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.archive import rehydrate
+from chatbot.models import Conversation
+
+
+class Command(BaseCommand):
+    help = "Возвращает сообщения архивных бесед в основную таблицу"
+
+    def add_arguments(self, parser):
+        parser.add_argument("conversation_ids", nargs="*", type=int)
+        parser.add_argument("--user", type=int, help="все архивные беседы пользователя с этим id")
+
+    def handle(self, *args, **options):
+        conversations = Conversation.objects.filter(archived_at__isnull=False)
+        if options["conversation_ids"]:
+            conversations = conversations.filter(pk__in=options["conversation_ids"])
+        elif options["user"]:
+            conversations = conversations.filter(user_id=options["user"])
+        else:
+            raise CommandError("Pass conversation ids or --user")
+
+        restored = 0
+        for conversation in conversations.iterator():
+            # По беседе в транзакции: блокировки короткие
+            restored += rehydrate(conversation)
+        self.stdout.write(self.style.SUCCESS(f"Restored {restored} messages"))
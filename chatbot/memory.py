@@ -0,0 +1,242 @@
+import fcntl
+import functools
+import hashlib
+import os
+import re
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import openai
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .models import ChatMessage
+
+TOKEN_RE = re.compile(r"\w+")
+ID_DTYPE = np.dtype("<i8")
+VECTOR_DTYPE = np.dtype("<f4")
+
+
+def normalize(vectors):
+    # Векторы единичной длины: косинусная близость сводится к скалярному произведению
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return (vectors / norms).astype(VECTOR_DTYPE, copy=False)
+
+
+@functools.lru_cache(maxsize=65536)
+def feature_slot(feature, dim):
+    digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+    return digest % dim, 1.0 if digest >> 63 else -1.0
+
+
+class HashEmbedder:
+    """
+    Эмбеддинги без модели и сети: слова и пары соседних слов хэшируются в dim координат со знаком
+    (feature hashing). Результат одинаков во всех процессах; близкими считаются тексты с общей лексикой.
+    """
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    @property
+    def key(self):
+        return f"hash-{self.dim}"
+
+    def features(self, text):
+        words = TOKEN_RE.findall((text or "").lower())
+        return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    def embed_many(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=VECTOR_DTYPE)
+        for row, text in enumerate(texts):
+            for feature in self.features(text):
+                slot, sign = feature_slot(feature, self.dim)
+                vectors[row, slot] += sign
+        return normalize(vectors)
+
+
+class OpenAIEmbedder:
+    """Эмбеддинги OpenAI (text-embedding-3-*), укороченные до dim координат."""
+
+    def __init__(self, model="text-embedding-3-small", dim=256, api_key=None, base_url=None, timeout=10.0):
+        self.model = model
+        self.dim = dim
+        self.timeout = timeout
+        self.client = openai.OpenAI(
+            api_key=api_key or settings.OPENAI_API_KEY, base_url=base_url or settings.OPENAI_BASE_URL
+        )
+
+    @property
+    def key(self):
+        return f"openai-{self.model}-{self.dim}"
+
+    def embed_many(self, texts):
+        response = self.client.embeddings.create(
+            model=self.model, input=[text or " " for text in texts], dimensions=self.dim, timeout=self.timeout
+        )
+        return normalize(np.array([item.embedding for item in response.data], dtype=VECTOR_DTYPE))
+
+
+class MemoryIndex:
+    """
+    Векторы ходов одного пользователя в двух файлах: <name>.f32 — строки float32 по dim координат,
+    <name>.ids — id сообщений (int64) в том же порядке. Файлы только дописываются, поиск читает их
+    через memmap, поэтому индекс не загружается в память процесса и сразу виден другим процессам.
+    """
+
+    def __init__(self, directory, name, dim):
+        self.directory = Path(directory)
+        self.dim = dim
+        self.vectors_path = self.directory / f"{name}.f32"
+        self.ids_path = self.directory / f"{name}.ids"
+        self.lock_path = self.directory / f"{name}.lock"
+
+    @property
+    def row_bytes(self):
+        return self.dim * VECTOR_DTYPE.itemsize
+
+    def __len__(self):
+        # Векторы пишутся раньше id: строка без id (запись не завершена) не учитывается
+        try:
+            vectors = self.vectors_path.stat().st_size // self.row_bytes
+            ids = self.ids_path.stat().st_size // ID_DTYPE.itemsize
+        except FileNotFoundError:
+            return 0
+        return min(vectors, ids)
+
+    def load(self):
+        count = len(self)
+        if not count:
+            return np.empty((0, self.dim), dtype=VECTOR_DTYPE), np.empty(0, dtype=ID_DTYPE)
+        vectors = np.memmap(self.vectors_path, dtype=VECTOR_DTYPE, mode="r", shape=(count, self.dim))
+        ids = np.memmap(self.ids_path, dtype=ID_DTYPE, mode="r", shape=(count,))
+        return vectors, ids
+
+    @contextmanager
+    def locked(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def add(self, ids, vectors):
+        """Дописывает векторы сообщений, которых еще нет в индексе. Возвращает число добавленных."""
+        ids = np.asarray(ids, dtype=ID_DTYPE)
+        vectors = np.asarray(vectors, dtype=VECTOR_DTYPE).reshape(len(ids), self.dim)
+        with self.locked():
+            count = self.repair()
+            if count:
+                fresh = ~np.isin(ids, self.load()[1])
+                ids, vectors = ids[fresh], vectors[fresh]
+            if not len(ids):
+                return 0
+            with open(self.vectors_path, "ab") as file:
+                file.write(vectors.tobytes())
+            with open(self.ids_path, "ab") as file:
+                file.write(ids.tobytes())
+        return len(ids)
+
+    def repair(self):
+        # Прерванная запись оставляет хвост без пары: обрезаем оба файла до целого числа строк
+        count = len(self)
+        for path, size in ((self.vectors_path, count * self.row_bytes), (self.ids_path, count * ID_DTYPE.itemsize)):
+            if path.exists() and path.stat().st_size != size:
+                os.truncate(path, size)
+        return count
+
+    def search(self, query, k, exclude=()):
+        """k ближайших по косинусу: список (id сообщения, близость) по убыванию близости."""
+        vectors, ids = self.load()
+        if not len(ids) or k <= 0:
+            return []
+        scores = vectors @ np.asarray(query, dtype=VECTOR_DTYPE)
+        if len(exclude):
+            scores[np.isin(ids, np.fromiter(exclude, dtype=ID_DTYPE))] = -np.inf
+        k = min(k, len(ids))
+        # argpartition выбирает k лучших за O(n), сортируются только они
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[i]), float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+    def clear(self):
+        with self.locked():
+            for path in (self.vectors_path, self.ids_path):
+                path.unlink(missing_ok=True)
+
+
+_embedder = None
+_embedder_lock = threading.Lock()
+
+
+def get_embedder():
+    """Модель эмбеддингов из CHATBOT_MEMORY_EMBEDDER, одна на процесс."""
+    global _embedder
+    if _embedder is None:
+        with _embedder_lock:
+            if _embedder is None:
+                config = settings.CHATBOT_MEMORY_EMBEDDER
+                _embedder = import_string(config["BACKEND"])(**config.get("OPTIONS", {}))
+    return _embedder
+
+
+@receiver(setting_changed)
+def reset_embedder(setting, **kwargs):
+    global _embedder
+    if setting == "CHATBOT_MEMORY_EMBEDDER":
+        _embedder = None
+
+
+def user_index(user_id, embedder=None):
+    # Файлы разных моделей эмбеддингов лежат рядом и не смешиваются
+    embedder = embedder or get_embedder()
+    return MemoryIndex(Path(settings.CHATBOT_MEMORY_ROOT) / str(user_id), embedder.key, embedder.dim)
+
+
+def turn_text(message, response):
+    return f"{message}\n{response}"
+
+
+def index_messages(messages):
+    """Добавляет ходы в индексы их пользователей (одним вызовом модели эмбеддингов)."""
+    messages = [msg for msg in messages if msg.status == ChatMessage.DONE]
+    if not messages:
+        return 0
+    embedder = get_embedder()
+    vectors = embedder.embed_many([turn_text(msg.message, msg.response) for msg in messages])
+    added = 0
+    for user_id in {msg.user_id for msg in messages}:
+        rows = [i for i, msg in enumerate(messages) if msg.user_id == user_id]
+        added += user_index(user_id, embedder).add([messages[i].id for i in rows], vectors[rows])
+    return added
+
+
+def recall(user_id, text, k=None, exclude=(), min_score=None):
+    """
+    Прошлые ходы пользователя (из всех его бесед), ближайшие к тексту. Удаленные и неготовые
+    сообщения пропускаются: индекс не чистится при удалении, его пересобирает rebuild_memory_index.
+    """
+    k = settings.CHATBOT_MEMORY_TOP_K if k is None else k
+    min_score = settings.CHATBOT_MEMORY_MIN_SCORE if min_score is None else min_score
+    embedder = get_embedder()
+    query = embedder.embed_many([text])[0]
+    # С запасом на удаленные сообщения
+    hits = [(pk, score) for pk, score in user_index(user_id, embedder).search(query, k * 2, exclude) if score >= min_score]
+    if not hits:
+        return []
+    found = ChatMessage.objects.filter(pk__in=[pk for pk, _ in hits], user_id=user_id, status=ChatMessage.DONE).only(
+        'id', 'conversation', 'message', 'response', 'created_at'
+    ).in_bulk()
+    memories = []
+    for pk, score in hits:
+        if pk in found:
+            found[pk].score = score
+            memories.append(found[pk])
+    return memories[:k]
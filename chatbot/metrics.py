@@ -0,0 +1,207 @@
+import datetime
+import math
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from rest_framework.exceptions import ValidationError
+
+from .models import DailyUsage, LatencyHistogram, TurnMetrics
+
+# Корзины гистограммы: 4 на каждое удвоение задержки, погрешность перцентиля ~19%
+BUCKETS_PER_DOUBLING = 4
+PERCENTILES = (50, 95, 99)
+USAGE_FIELDS = ('prompt_tokens', 'completion_tokens', 'upstream_ms', 'sentiment_ms', 'db_ms', 'total_ms')
+DEFAULT_DAYS = 7
+
+
+def latency_bucket(ms):
+    return math.ceil(BUCKETS_PER_DOUBLING * math.log2(ms + 1))
+
+
+def bucket_upper_ms(bucket):
+    return round(2 ** (bucket / BUCKETS_PER_DOUBLING) - 1)
+
+
+@dataclass
+class TurnStats:
+    """Замеры хода, которые собираются по ходу запроса и сохраняются в TurnMetrics после коммита."""
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    upstream_ms: int = 0
+    sentiment_ms: int = 0
+    db_ms: int = 0
+    total_ms: int = 0
+    cache_hit: bool = False
+    model: str = ""
+    started: float = field(default_factory=time.perf_counter, repr=False)
+
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            setattr(self, name, getattr(self, name) + (time.perf_counter() - started) * 1000)
+
+    @contextmanager
+    def track_db(self):
+        # Время всех SQL-запросов внутри блока (в текущем потоке)
+        def wrapper(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                self.db_ms += (time.perf_counter() - started) * 1000
+
+        with connection.execute_wrapper(wrapper):
+            yield
+
+    def values(self):
+        # Время копится в дробных мс (запросы к БД бывают короче миллисекунды), сохраняется целым
+        values = asdict(self)
+        del values['started']
+        values['total_ms'] = (time.perf_counter() - self.started) * 1000
+        for name in USAGE_FIELDS[2:]:
+            values[name] = round(values[name])
+        return values
+
+    def record(self, message):
+        # Запись в побочную таблицу и сводки — фоновой задачей после коммита, вне времени ответа
+        from .tasks import record_turn_metrics
+        values = self.values()
+        transaction.on_commit(lambda: record_turn_metrics.delay(message.pk, values))
+
+
+def bump(model, keys, **increments):
+    """Прибавляет значения к строке сводки, создавая ее при первом обращении."""
+    updates = {name: F(name) + value for name, value in increments.items()}
+    if model.objects.filter(**keys).update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**keys, **increments)
+    except IntegrityError:
+        # Строку одновременно создал другой ход
+        model.objects.filter(**keys).update(**updates)
+
+
+@transaction.atomic
+def save_turn_metrics(message, values):
+    """Сохраняет замеры хода и добавляет их в дневные сводки. Повторный вызов для хода ничего не меняет."""
+    metrics, created = TurnMetrics.objects.get_or_create(message_id=message.pk, defaults=values)
+    if not created:
+        return metrics
+
+    day = timezone.localdate(message.created_at, timezone=datetime.timezone.utc)
+    increments = {name: values[name] for name in USAGE_FIELDS}
+    latencies = {LatencyHistogram.TOTAL: values['total_ms'], LatencyHistogram.UPSTREAM: values['upstream_ms']}
+    for user_id in (message.user_id, None):
+        bump(DailyUsage, {'day': day, 'user_id': user_id}, turns=1, cache_hits=int(values['cache_hit']), **increments)
+        for metric, ms in latencies.items():
+            if metric == LatencyHistogram.UPSTREAM and values['cache_hit']:
+                continue  # ответ из кэша модель не ждал
+            bump(LatencyHistogram, {'day': day, 'user_id': user_id, 'metric': metric, 'bucket': latency_bucket(ms)},
+                 count=1)
+    return metrics
+
+
+def parse_day(value, name, default):
+    if not value:
+        return default
+    try:
+        day = parse_date(value)
+    except ValueError:
+        day = None
+    if day is None:
+        raise ValidationError({name: "Expected an ISO 8601 date."})
+    return day
+
+
+def day_range(params):
+    """since/until (включительно) из query-параметров, по умолчанию последние DEFAULT_DAYS дней."""
+    until = parse_day(params.get("until"), "until", timezone.now().date())
+    since = parse_day(params.get("since"), "since", until - datetime.timedelta(days=DEFAULT_DAYS - 1))
+    if since > until:
+        raise ValidationError({"since": "Must not be later than until."})
+    return since, until
+
+
+def percentiles(histogram):
+    """p50/p95/p99 в мс по парам (корзина, число ходов) — верхняя граница корзины."""
+    histogram = sorted(histogram)
+    total = sum(count for _, count in histogram)
+    result = {}
+    for p in PERCENTILES:
+        if not total:
+            result[f"p{p}"] = None
+            continue
+        rank = math.ceil(p / 100 * total)
+        seen = 0
+        for bucket, count in histogram:
+            seen += count
+            if seen >= rank:
+                result[f"p{p}"] = bucket_upper_ms(bucket)
+                break
+    return result
+
+
+def summarize(usage, histograms):
+    turns = usage['turns'] or 0
+    return {
+        "turns": turns,
+        "prompt_tokens": usage['prompt_tokens'] or 0,
+        "completion_tokens": usage['completion_tokens'] or 0,
+        "cache_hit_rate": round(usage['cache_hits'] / turns, 4) if turns else 0.0,
+        "avg_ms": {name[:-3]: round(usage[name] / turns, 1) if turns else None for name in USAGE_FIELDS[2:]},
+        "latency_ms": {metric: percentiles(histograms.get(metric, [])) for metric, _ in LatencyHistogram.METRIC_CHOICES},
+    }
+
+
+def histograms_by(rows, key):
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(key(row), {}).setdefault(row['metric'], []).append((row['bucket'], row['count']))
+    return grouped
+
+
+def daily_report(since, until, user_id=None):
+    """По дням: суммы, средние и перцентили задержки; user_id=None — по всем пользователям."""
+    days = {'day__gte': since, 'day__lte': until, 'user_id': user_id}
+    usage = DailyUsage.objects.filter(**days).order_by('day').values('day', 'turns', 'cache_hits', *USAGE_FIELDS)
+    histograms = histograms_by(
+        LatencyHistogram.objects.filter(**days).values('day', 'metric', 'bucket', 'count'), lambda row: row['day']
+    )
+    return [{"day": row['day'], **summarize(row, histograms.get(row['day'], {}))} for row in usage]
+
+
+def user_report(user_id, since, until):
+    """Итог пользователя за период: корзины гистограмм складываются по дням."""
+    days = {'day__gte': since, 'day__lte': until, 'user_id': user_id}
+    usage = DailyUsage.objects.filter(**days).aggregate(
+        turns=Sum('turns'), cache_hits=Sum('cache_hits'), **{name: Sum(name) for name in USAGE_FIELDS}
+    )
+    rows = (
+        LatencyHistogram.objects.filter(**days).values('metric', 'bucket')
+        .annotate(count=Sum('count')).values('metric', 'bucket', 'count')
+    )
+    histograms = histograms_by(rows, lambda row: None).get(None, {})
+    return {"user": user_id, "since": since, "until": until, **summarize(usage, histograms)}
+
+
+def top_consumers(since, until, limit=10):
+    """Пользователи с наибольшим расходом токенов за период."""
+    return list(
+        DailyUsage.objects.filter(day__gte=since, day__lte=until, user__isnull=False)
+        .values('user_id', 'user__email')
+        .annotate(
+            # total_tokens первым: дальше имена полей заняты суммами
+            total_tokens=Sum(F('prompt_tokens') + F('completion_tokens')),
+            turns=Sum('turns'), prompt_tokens=Sum('prompt_tokens'), completion_tokens=Sum('completion_tokens'),
+        )
+        .order_by('-total_tokens', 'user_id')[:limit]
+    )
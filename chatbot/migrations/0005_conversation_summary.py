@@ -0,0 +1,43 @@
+# Generated by Django 4.2.21 on 2026-10-18 10:51
+
+from django.db import migrations, models
+
+
+def fill_history_tokens(apps, schema_editor):
+    # Та же оценка, что в chatbot.tokens.turn_tokens
+    def tokens(text):
+        return len(text.encode('utf-8')) // 4 + 1 if text else 0
+
+    Conversation = apps.get_model('chatbot', 'Conversation')
+    ChatMessage = apps.get_model('chatbot', 'ChatMessage')
+    for conversation in Conversation.objects.only('id').iterator():
+        total = 0
+        for message, response in ChatMessage.objects.filter(conversation=conversation).values_list('message', 'response').iterator():
+            total += tokens(message) + tokens(response) + 8
+        Conversation.objects.filter(pk=conversation.pk).update(history_tokens=total)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0004_chatmessage_file_chatmessage_sentiment_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='history_tokens',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='summarized_until',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='summary',
+            field=models.TextField(blank=True),
+        ),
+        migrations.RunPython(fill_history_tokens, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.21 on 2026-10-18 11:12
+
+from django.db import migrations, models
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, NullIf, Substr
+import django.utils.timezone
+
+
+def fill_conversation_stats(apps, schema_editor):
+    # То же, что manage.py rebuild_conversation_stats
+    Conversation = apps.get_model('chatbot', 'Conversation')
+    ChatMessage = apps.get_model('chatbot', 'ChatMessage')
+    messages = ChatMessage.objects.filter(conversation=OuterRef('pk'))
+    latest = messages.order_by('-created_at', '-id')
+    count = messages.order_by().values('conversation').annotate(count=Count('id')).values('count')
+    preview = latest.annotate(
+        preview=Substr(Coalesce(NullIf('response', Value('')), 'message'), 1, 100)
+    ).values('preview')[:1]
+    Conversation.objects.update(
+        message_count=Coalesce(Subquery(count), 0),
+        last_message_at=Coalesce(Subquery(latest.values('created_at')[:1]), F('created_at')),
+        last_message_preview=Coalesce(Subquery(preview), Value('')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0008_history_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_preview',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user', 'last_message_at'], name='conversation_user_activity_idx'),
+        ),
+        migrations.RunPython(fill_conversation_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 4.2.21 on 2026-10-18 12:05
+
+from django.db import migrations
+
+# SQLite: FTS5-таблица с внешним содержимым (текст хранится только в chatbot_chatmessage),
+# триггеры обновляют индекс при вставке, изменении и удалении сообщения.
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE chatbot_chatmessage_fts USING fts5(
+        message, response, user_id,
+        content='chatbot_chatmessage', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER chatbot_chatmessage_fts_insert AFTER INSERT ON chatbot_chatmessage BEGIN
+        INSERT INTO chatbot_chatmessage_fts(rowid, message, response, user_id)
+        VALUES (new.id, new.message, new.response, new.user_id);
+    END
+    """,
+    """
+    CREATE TRIGGER chatbot_chatmessage_fts_delete AFTER DELETE ON chatbot_chatmessage BEGIN
+        INSERT INTO chatbot_chatmessage_fts(chatbot_chatmessage_fts, rowid, message, response, user_id)
+        VALUES ('delete', old.id, old.message, old.response, old.user_id);
+    END
+    """,
+    """
+    CREATE TRIGGER chatbot_chatmessage_fts_update AFTER UPDATE OF message, response, user_id ON chatbot_chatmessage BEGIN
+        INSERT INTO chatbot_chatmessage_fts(chatbot_chatmessage_fts, rowid, message, response, user_id)
+        VALUES ('delete', old.id, old.message, old.response, old.user_id);
+        INSERT INTO chatbot_chatmessage_fts(rowid, message, response, user_id)
+        VALUES (new.id, new.message, new.response, new.user_id);
+    END
+    """,
+    "INSERT INTO chatbot_chatmessage_fts(chatbot_chatmessage_fts) VALUES ('rebuild')",
+]
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS chatbot_chatmessage_fts_insert",
+    "DROP TRIGGER IF EXISTS chatbot_chatmessage_fts_delete",
+    "DROP TRIGGER IF EXISTS chatbot_chatmessage_fts_update",
+    "DROP TABLE IF EXISTS chatbot_chatmessage_fts",
+]
+
+# Postgres: GIN по tsvector вычисляется из строки, Postgres обновляет его сам.
+# Конфигурация 'simple' без стемминга: сообщения на разных языках.
+POSTGRES_FORWARD = [
+    "CREATE INDEX chatmessage_search_idx ON chatbot_chatmessage "
+    "USING GIN (to_tsvector('simple', message || ' ' || response))",
+]
+POSTGRES_BACKWARD = ["DROP INDEX IF EXISTS chatmessage_search_idx"]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        sql = statements.get(schema_editor.connection.vendor, [])
+        for statement in sql:
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0009_conversation_activity'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRES_FORWARD}),
+            run({'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRES_BACKWARD}),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 4.2.21 on 2026-10-18 12:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chatbot', '0010_chatmessage_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TurnMetrics',
+            fields=[
+                ('message', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='metrics', serialize=False, to='chatbot.chatmessage')),
+                ('prompt_tokens', models.PositiveIntegerField(default=0)),
+                ('completion_tokens', models.PositiveIntegerField(default=0)),
+                ('upstream_ms', models.PositiveIntegerField(default=0)),
+                ('sentiment_ms', models.PositiveIntegerField(default=0)),
+                ('db_ms', models.PositiveIntegerField(default=0)),
+                ('total_ms', models.PositiveIntegerField(default=0)),
+                ('cache_hit', models.BooleanField(default=False)),
+                ('model', models.CharField(blank=True, max_length=64)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LatencyHistogram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('metric', models.CharField(choices=[('total', 'Total'), ('upstream', 'Upstream')], max_length=10)),
+                ('bucket', models.PositiveSmallIntegerField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DailyUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('turns', models.PositiveIntegerField(default=0)),
+                ('cache_hits', models.PositiveIntegerField(default=0)),
+                ('prompt_tokens', models.PositiveBigIntegerField(default=0)),
+                ('completion_tokens', models.PositiveBigIntegerField(default=0)),
+                ('upstream_ms', models.PositiveBigIntegerField(default=0)),
+                ('sentiment_ms', models.PositiveBigIntegerField(default=0)),
+                ('db_ms', models.PositiveBigIntegerField(default=0)),
+                ('total_ms', models.PositiveBigIntegerField(default=0)),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='latencyhistogram',
+            constraint=models.UniqueConstraint(fields=('day', 'user', 'metric', 'bucket'), name='latency_histogram_user_bucket'),
+        ),
+        migrations.AddConstraint(
+            model_name='latencyhistogram',
+            constraint=models.UniqueConstraint(condition=models.Q(('user', None)), fields=('day', 'metric', 'bucket'), name='latency_histogram_total_bucket'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailyusage',
+            constraint=models.UniqueConstraint(fields=('day', 'user'), name='daily_usage_day_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailyusage',
+            constraint=models.UniqueConstraint(condition=models.Q(('user', None)), fields=('day',), name='daily_usage_day_total'),
+        ),
+    ]
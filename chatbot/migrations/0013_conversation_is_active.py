@@ -0,0 +1,31 @@
+# Generated by Django 4.2.21 on 2026-10-18 11:59
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def mark_latest_active(apps, schema_editor):
+    # Активной становится последняя беседа каждого пользователя — туда же раньше шли сообщения
+    Conversation = apps.get_model('chatbot', 'Conversation')
+    latest = Conversation.objects.filter(user=OuterRef('user')).order_by('-last_message_at', '-id').values('id')[:1]
+    Conversation.objects.filter(id=Subquery(latest)).update(is_active=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0012_conversation_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='is_active',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_latest_active, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_active', True)), fields=('user',), name='unique_active_conversation'),
+        ),
+    ]
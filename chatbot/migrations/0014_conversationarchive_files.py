@@ -0,0 +1,33 @@
+# Generated by Django 4.2.21 on 2026-10-18 14:25
+
+import json
+import zlib
+
+from django.db import migrations, models
+
+
+def fill_archive_files(apps, schema_editor):
+    # Формат архива — chatbot/archive.py: zlib-сжатый JSON {"v", "fields", "rows"}
+    ConversationArchive = apps.get_model('chatbot', 'ConversationArchive')
+    for archive in ConversationArchive.objects.iterator(chunk_size=100):
+        payload = json.loads(zlib.decompress(bytes(archive.data)))
+        index = payload["fields"].index("file")
+        archive.files = sorted({row[index] for row in payload["rows"] if row[index]})
+        if archive.files:
+            archive.save(update_fields=['files'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0013_conversation_is_active'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationarchive',
+            name='files',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.RunPython(fill_archive_files, migrations.RunPython.noop),
+    ]
@@ -1,17 +1,60 @@
 from django.db import models
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from .tokens import turn_tokens
 import uuid
 
+# Длина превью последнего сообщения в списке разговоров
+PREVIEW_LENGTH = 100
+
+
+def message_preview(message, response):
+    # В списке показывается ответ бота, а пока его нет — вопрос пользователя
+    return (response or message or "")[:PREVIEW_LENGTH]
+
 
 class Conversation(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='conversations')
     title = models.CharField(max_length=255, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Сжатое содержание старых ходов, которые не влезают в контекст целиком
+    summary = models.TextField(blank=True)
+    summarized_until = models.PositiveBigIntegerField(default=0)  # id последнего сообщения, вошедшего в summary
+    history_tokens = models.PositiveIntegerField(default=0)  # оценка токенов всей истории
+    # Денормализованные данные для списка разговоров, обновляются при записи ChatMessage
+    last_message_at = models.DateTimeField(default=timezone.now)  # для нового разговора — время создания
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True)
+    # Сообщения неактивной беседы перенесены в ConversationArchive (manage.py archive_conversations)
+    archived_at = models.DateTimeField(null=True, blank=True)
+    # Беседа, в которую идут сообщения без conversation_id (chatbot/routing.py); у пользователя не больше одной
+    is_active = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user'], condition=Q(is_active=True), name='unique_active_conversation'),
+        ]
+        indexes = [
+            # Список разговоров пользователя по дате (курсорная пагинация)
+            models.Index(fields=['user', 'created_at'], name='conversation_user_created_idx'),
+            # Список разговоров по последней активности
+            models.Index(fields=['user', 'last_message_at'], name='conversation_user_activity_idx'),
+        ]
 
     def __str__(self):
         return f"Conversation #{self.id} for {self.user.email}"
 
 class ChatMessage(models.Model):
+    # Статус ответа: в фоновом режиме (?async=1) сообщение сохраняется до ответа модели
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (DONE, 'Done'), (FAILED, 'Failed')]
+
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='chat_messages')
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE)
     message = models.TextField()
@@ -19,14 +62,220 @@ class ChatMessage(models.Model):
     sentiment = models.CharField(max_length=10, blank=True)  # Поле для хранения настроения
     created_at = models.DateTimeField(auto_now_add=True)
     file = models.FileField(upload_to='chat_files/', null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=DONE)
+    # Ключ из заголовка Idempotency-Key: повтор запроса не создает второе сообщение
+    idempotency_key = models.CharField(max_length=255, null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'idempotency_key'], name='unique_chat_idempotency_key'),
+        ]
+        indexes = [
+            # История разговора по дате (курсорная пагинация, контекст для модели)
+            models.Index(fields=['conversation', 'created_at'], name='chatmessage_conv_created_idx'),
+        ]
 
     def __str__(self):
         return f"Chat from {self.user.email} at {self.created_at}"
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+        # Вставка и счетчики беседы — одна транзакция: сбой между ними не рассинхронизирует счетчики
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            count_new_messages(self.conversation_id, [self])
     
+
+def count_new_messages(conversation_id, messages):
+    """
+    Учитывает новые сообщения беседы в ее счетчиках (save() и bulk_create из пакетного чата).
+    Одним UPDATE: одновременные сообщения не теряют приращения счетчиков.
+    Сообщения могут сохраниться не по порядку, поэтому последнее определяется по created_at.
+    """
+    latest = max(messages, key=lambda msg: msg.created_at)
+    is_latest = Q(last_message_at__lte=latest.created_at)
+    Conversation.objects.filter(pk=conversation_id).update(
+        history_tokens=F('history_tokens') + sum(turn_tokens(msg.message, msg.response) for msg in messages),
+        message_count=F('message_count') + len(messages),
+        last_message_at=Case(When(is_latest, then=Value(latest.created_at)), default=F('last_message_at')),
+        last_message_preview=Case(
+            When(is_latest, then=Value(message_preview(latest.message, latest.response))),
+            default=F('last_message_preview'),
+        ),
+    )
+
+
+@receiver(post_delete, sender=ChatMessage)
+def update_conversation_stats(sender, instance, **kwargs):
+    Conversation.objects.filter(pk=instance.conversation_id, message_count__gt=0).update(
+        message_count=F('message_count') - 1
+    )
+    # Удалено последнее сообщение: превью и время берутся у предыдущего
+    if Conversation.objects.filter(pk=instance.conversation_id, last_message_at__lte=instance.created_at).exists():
+        latest = (
+            ChatMessage.objects.filter(conversation_id=instance.conversation_id)
+            .order_by('-created_at', '-id')
+            .values('created_at', 'message', 'response')
+            .first()
+        )
+        if latest is not None:
+            Conversation.objects.filter(pk=instance.conversation_id).update(
+                last_message_at=latest['created_at'],
+                last_message_preview=message_preview(latest['message'], latest['response']),
+            )
+        else:
+            # Сообщений не осталось: беседа выглядит как новая
+            Conversation.objects.filter(pk=instance.conversation_id).update(
+                last_message_at=F('created_at'), last_message_preview='', message_count=0, history_tokens=0,
+            )
+
+
+@receiver(post_save, sender=ChatMessage)
+@receiver(post_delete, sender=ChatMessage)
+def forget_chat_prompt(sender, instance, created=False, **kwargs):
+    # Правка или удаление хода: кэш ходов беседы собирается заново (новые ходы дочитываются сами)
+    if not created:
+        from .prompt import forget_prompt
+        forget_prompt(instance.conversation_id)
+
+
+@receiver(post_save, sender=ChatMessage)
+def remember_chat_message(sender, instance, created, **kwargs):
+    # Готовый ход добавляется в долговременную память после коммита, фоновой задачей
+    if created and instance.status == ChatMessage.DONE and settings.CHATBOT_MEMORY_ENABLED:
+        from .tasks import index_chat_message
+        transaction.on_commit(lambda: index_chat_message.delay(instance.pk))
+
+
+@receiver(post_save, sender=ChatMessage)
+def push_chat_message(sender, instance, created, **kwargs):
+    # Готовый ход рассылается WebSocket-подключениям пользователя (origin — соединение-отправитель)
+    if created and instance.status == ChatMessage.DONE:
+        from .pubsub import notify_message
+        notify_message(instance, getattr(instance, 'origin', None))
+
+
+@receiver(post_delete, sender=ChatMessage)
+def release_chat_file(sender, instance, **kwargs):
+    # Файл удаляется из хранилища, когда на него не ссылается ни одно сообщение
+    if instance.file:
+        from .uploads import release
+        release(instance.file.name)
+
+
+@receiver(post_delete, sender=Conversation)
+def forget_deleted_conversation(sender, instance, **kwargs):
+    from .prompt import forget_prompt
+    forget_prompt(instance.pk)
+    # Удалена активная беседа: следующее сообщение без conversation_id назначит новую
+    if instance.is_active:
+        from .routing import active_conversations
+        active_conversations.forget(instance.user_id)
+
+
+class ConversationArchive(models.Model):
+    """
+    Сообщения неактивной беседы одной сжатой записью (zlib, JSON), вне основной таблицы ChatMessage.
+    Формат и чтение — chatbot/archive.py.
+    """
+    conversation = models.OneToOneField(Conversation, on_delete=models.CASCADE, primary_key=True, related_name='archive')
+    data = models.BinaryField()
+    message_count = models.PositiveIntegerField()
+    raw_size = models.PositiveIntegerField()  # байт до сжатия
+    files = models.JSONField(default=list, blank=True)  # пути файлов сообщений: квота (chatbot/uploads.py) без распаковки
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Archive of conversation #{self.conversation_id}"
+
+
+@receiver(post_delete, sender=ConversationArchive)
+def release_archived_files(sender, instance, **kwargs):
+    # Архивные сообщения тоже ссылаются на файлы: удаление архива (вместе с беседой) их освобождает
+    from .archive import unpack
+    from .uploads import release
+    for msg in unpack(instance):
+        if msg.file:
+            release(msg.file.name)
+
+
+class StoredFile(models.Model):
+    """Загруженный файл: одинаковое содержимое хранится один раз, сообщения ссылаются на него по пути."""
+    sha256 = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255, unique=True)  # путь в хранилище, он же ChatMessage.file
+    size = models.PositiveBigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)  # сколько сообщений ссылается на файл
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+
 class UserSettings(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     preferred_language = models.CharField(max_length=10, default='en')
     tone_of_voice = models.CharField(max_length=50, default='formal')
 
     def __str__(self):
-        return f"{self.user.email}'s settings"
\ No newline at end of file
+        return f"{self.user.email}'s settings"
+
+class TurnMetrics(models.Model):
+    """Замеры одного хода: токены и время по этапам. Побочная таблица, ChatMessage не расширяется."""
+    message = models.OneToOneField(ChatMessage, on_delete=models.CASCADE, primary_key=True, related_name='metrics')
+    prompt_tokens = models.PositiveIntegerField(default=0)
+    completion_tokens = models.PositiveIntegerField(default=0)
+    upstream_ms = models.PositiveIntegerField(default=0)  # ожидание модели (0 при ответе из кэша)
+    sentiment_ms = models.PositiveIntegerField(default=0)
+    db_ms = models.PositiveIntegerField(default=0)  # сумма времени SQL-запросов хода
+    total_ms = models.PositiveIntegerField(default=0)
+    cache_hit = models.BooleanField(default=False)
+    model = models.CharField(max_length=64, blank=True)
+
+    def __str__(self):
+        return f"Metrics for chat message #{self.message_id}"
+
+
+class DailyUsage(models.Model):
+    """
+    Суммы TurnMetrics за день по пользователю и по всем пользователям (user=None).
+    Обновляются приращениями при записи каждого хода, отчеты читают только эти строки.
+    """
+    day = models.DateField()
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, related_name='+')
+    turns = models.PositiveIntegerField(default=0)
+    cache_hits = models.PositiveIntegerField(default=0)
+    prompt_tokens = models.PositiveBigIntegerField(default=0)
+    completion_tokens = models.PositiveBigIntegerField(default=0)
+    upstream_ms = models.PositiveBigIntegerField(default=0)
+    sentiment_ms = models.PositiveBigIntegerField(default=0)
+    db_ms = models.PositiveBigIntegerField(default=0)
+    total_ms = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'user'], name='daily_usage_day_user'),
+            # NULL не равен NULL: для строк по всем пользователям отдельное условие
+            models.UniqueConstraint(fields=['day'], condition=Q(user=None), name='daily_usage_day_total'),
+        ]
+
+
+class LatencyHistogram(models.Model):
+    """Гистограмма задержек за день в логарифмических корзинах: из нее считаются p50/p95/p99."""
+    TOTAL = 'total'
+    UPSTREAM = 'upstream'
+    METRIC_CHOICES = [(TOTAL, 'Total'), (UPSTREAM, 'Upstream')]
+
+    day = models.DateField()
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, related_name='+')
+    metric = models.CharField(max_length=10, choices=METRIC_CHOICES)
+    bucket = models.PositiveSmallIntegerField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'user', 'metric', 'bucket'], name='latency_histogram_user_bucket'),
+            models.UniqueConstraint(
+                fields=['day', 'metric', 'bucket'], condition=Q(user=None), name='latency_histogram_total_bucket'
+            ),
+        ]
@@ -0,0 +1,146 @@
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination
+
+
+class KeysetCursorPagination(CursorPagination):
+    """
+    Курсорная пагинация по паре (время, id) в обе стороны, по умолчанию (created_at, id).
+    Курсор хранит значения крайней строки страницы, следующая страница читается по индексу
+    условием (created_at, id) > (c, i) — без OFFSET, за одно время на любой глубине истории.
+    """
+    ordering = ('created_at', 'id')
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+
+        reverse = self.cursor is not None and self.cursor.reverse
+        ordering = [flip(field) for field in self.ordering] if reverse else list(self.ordering)
+        position = None
+        if self.cursor is not None and self.cursor.position is not None:
+            position = self.parse_position(self.cursor.position)
+
+        # Одна лишняя строка показывает, есть ли что-то дальше
+        if isinstance(queryset, list):
+            results = self.slice_list(queryset, position, ordering)
+        else:
+            queryset = queryset.order_by(*ordering)
+            if position is not None:
+                queryset = queryset.filter(self.after_position(position, ordering))
+            results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.cursor is not None
+        return self.page
+
+    def parse_position(self, position):
+        try:
+            created_at, pk = position.rsplit('|', 1)
+            created_at, pk = parse_datetime(created_at), int(pk)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if created_at is None:
+            raise NotFound(self.invalid_cursor_message)
+        return created_at, pk
+
+    def after_position(self, position, ordering):
+        created_at, pk = position
+        time_field, id_field = (field.lstrip('-') for field in ordering)
+        op = 'lt' if ordering[0].startswith('-') else 'gt'
+        # Нестрогое условие по created_at дает индексу диапазон, строгое по паре отсекает уже показанные строки
+        return Q(**{f'{time_field}__{op}e': created_at}) & (
+            Q(**{f'{time_field}__{op}': created_at}) | Q(**{time_field: created_at, f'{id_field}__{op}': pk})
+        )
+
+    def slice_list(self, rows, position, ordering):
+        # Строки уже в памяти (архивная беседа): тот же порядок и то же условие после курсора
+        fields = [field.lstrip('-') for field in ordering]
+        descending = ordering[0].startswith('-')
+
+        def key(row):
+            return tuple(getattr(row, field) for field in fields)
+
+        rows = sorted(rows, key=key, reverse=descending)
+        if position is not None:
+            rows = [row for row in rows if (key(row) < position if descending else key(row) > position)]
+        return rows[:self.page_size + 1]
+
+    def position(self, instance):
+        time_field, id_field = (field.lstrip('-') for field in self.ordering)
+        return f'{getattr(instance, time_field).isoformat()}|{getattr(instance, id_field)}'
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        position = self.position(self.page[-1]) if self.page else self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        position = self.position(self.page[0]) if self.page else self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=position))
+
+
+class RecentActivityPagination(KeysetCursorPagination):
+    ordering = ('-last_message_at', '-id')
+
+
+class SearchCursorPagination(CursorPagination):
+    """
+    Страницы результатов поиска по (rank, id), только вперед. Курсор хранит rank и id последнего
+    результата, следующая страница — результаты строго после них, без OFFSET.
+    Пагинирует не queryset, а объект поиска с методом fetch(after, limit).
+    """
+    ordering = ('rank', 'id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    def paginate_queryset(self, search, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+        self.cursor = self.decode_cursor(request)
+
+        after = None
+        if self.cursor is not None and self.cursor.position is not None:
+            try:
+                rank, pk = self.cursor.position.rsplit('|', 1)
+                after = (float(rank), int(pk))
+            except ValueError:
+                raise NotFound(self.invalid_cursor_message)
+
+        results = search.fetch(after=after, limit=self.page_size + 1)
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        # repr сохраняет float без потерь: сравнение на следующей странице точное
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=f'{last.rank!r}|{last.id}'))
+
+    def get_previous_link(self):
+        return None
+
+
+def flip(field):
+    return field[1:] if field.startswith('-') else f'-{field}'
@@ -0,0 +1,137 @@
+import threading
+from array import array
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .cache import ResponseCache
+from .models import ChatMessage
+from .tokens import turn_tokens
+
+Turn = namedtuple('Turn', 'id message response')
+
+# Номер версии ходов беседы в общем кэше: forget_prompt увеличивает его во всех процессах
+VERSION_KEY = "chatbot:prompt-version"
+
+
+class PromptPrefix:
+    """
+    Ходы беседы после summary в виде, готовом для модели: сообщения user/assistant и стоимость
+    каждого хода в токенах. id и токены — в массивах array (8 байт на ход вместо объекта int),
+    сообщения — плоский список словарей, по два на ход. Не больше CHATBOT_CONTEXT_MAX_TURNS
+    последних ходов, как и при чтении истории из БД.
+    """
+
+    def __init__(self, summarized_until, version=0):
+        self.summarized_until = summarized_until
+        self.version = version  # версия ходов беседы (prompt_version), с которой собран префикс
+        self.last_id = summarized_until  # новые ходы читаются из БД начиная после него
+        self.ids = array('q')
+        self.tokens = array('l')
+        self.messages = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def extend(self, rows):
+        """Дописывает ходы (id, message, response) в хронологическом порядке."""
+        with self._lock:
+            for pk, message, response in rows:
+                # Тот же ход мог дописать параллельный запрос
+                if pk <= self.last_id:
+                    continue
+                self.ids.append(pk)
+                self.tokens.append(turn_tokens(message, response))
+                self.messages.append({"role": "user", "content": message})
+                self.messages.append({"role": "assistant", "content": response})
+                self.last_id = pk
+            self._drop(len(self.ids) - settings.CHATBOT_CONTEXT_MAX_TURNS)
+
+    def fold(self, summarized_until):
+        """Ходы до summarized_until включительно свернуты в summary."""
+        with self._lock:
+            count = 0
+            while count < len(self.ids) and self.ids[count] <= summarized_until:
+                count += 1
+            self._drop(count)
+            self.summarized_until = summarized_until
+            self.last_id = max(self.last_id, summarized_until)
+
+    def _drop(self, count):
+        if count > 0:
+            del self.ids[:count]
+            del self.tokens[:count]
+            del self.messages[:2 * count]
+
+    def tail(self, available):
+        """Последние ходы, которые помещаются в available токенов: (ходы, их сообщения, токены, всего ходов)."""
+        with self._lock:
+            used = 0
+            start = len(self.ids)
+            while start > 0 and used + self.tokens[start - 1] <= available:
+                start -= 1
+                used += self.tokens[start]
+            messages = self.messages[2 * start:]
+            turns = [
+                Turn(pk, messages[2 * i]["content"], messages[2 * i + 1]["content"])
+                for i, pk in enumerate(self.ids[start:])
+            ]
+            return turns, messages, used, len(self.ids)
+
+
+# Кэш ходов по id беседы в памяти процесса. Запись сбрасывается (forget_prompt), когда меняются
+# уже учтенные ходы: правка, удаление, ответ фоновой обработки, архивирование. Другие процессы
+# видят сброс по номеру версии беседы в общем кэше; новые сообщения читаются на следующем ходу.
+prompt_cache = ResponseCache(settings.CHATBOT_PROMPT_CACHE_SIZE, settings.CHATBOT_PROMPT_CACHE_TTL)
+
+
+def new_turns(conversation, after_id):
+    """Готовые ходы беседы с id > after_id, не больше CHATBOT_CONTEXT_MAX_TURNS последних, по порядку."""
+    rows = list(
+        conversation.chatmessage_set.filter(id__gt=after_id, status=ChatMessage.DONE)
+        .order_by('-created_at', '-id')
+        .values_list('id', 'message', 'response')[:settings.CHATBOT_CONTEXT_MAX_TURNS]
+    )
+    rows.reverse()
+    return rows
+
+
+def version_key(conversation_id):
+    return f"{VERSION_KEY}:{conversation_id}"
+
+
+def prompt_version(conversation_id):
+    """Номер версии ходов беседы в общем кэше; 0, пока ходы не сбрасывались (или ключ вытеснен)."""
+    return caches[settings.CHATBOT_CONVERSATION_CACHE].get(version_key(conversation_id), 0)
+
+
+def prompt_prefix(conversation):
+    """
+    Ходы беседы после summary. Из БД читаются только ходы, которых еще нет в кэше, —
+    обычно один последний; вся история — при первом обращении или после сброса в любом процессе.
+    """
+    version = prompt_version(conversation.pk)
+    prefix = prompt_cache.get(conversation.pk)
+    if prefix is not None and prefix.version != version:
+        prefix = None
+    if prefix is not None and prefix.summarized_until < conversation.summarized_until:
+        # Summary обновил другой запрос: свернутые ходы просто отбрасываются
+        prefix.fold(conversation.summarized_until)
+    if prefix is None or prefix.summarized_until != conversation.summarized_until:
+        prefix = PromptPrefix(conversation.summarized_until, version)
+        prompt_cache.set(conversation.pk, prefix)
+    prefix.extend(new_turns(conversation, prefix.last_id))
+    return prefix
+
+
+def forget_prompt(*conversation_ids):
+    """Сбрасывает кэш ходов бесед в этом процессе и, через номер версии в общем кэше, в остальных."""
+    shared = caches[settings.CHATBOT_CONVERSATION_CACHE]
+    for conversation_id in conversation_ids:
+        prompt_cache.delete(conversation_id)
+        try:
+            shared.incr(version_key(conversation_id))
+        except ValueError:
+            shared.add(version_key(conversation_id), 1, None)
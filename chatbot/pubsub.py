@@ -0,0 +1,93 @@
+import logging
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+def user_channel(user_id):
+    return f"user:{user_id}"
+
+
+class InMemoryBroker:
+    """
+    Pub/sub в памяти процесса: события доходят только до подписчиков этого процесса.
+    При нескольких процессах (воркеры ASGI, Celery) заменяется общим брокером с тем же
+    интерфейсом через CHATBOT_PUBSUB_BACKEND — например, поверх Redis PUBLISH/SUBSCRIBE.
+
+    publish не блокирует и может вызываться из любого потока; callback подписчика тоже
+    должен быть потокобезопасным и не блокировать (WebSocket-соединение кладет событие в свою очередь).
+    """
+
+    def __init__(self):
+        self.subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel, callback):
+        """Подписывает callback(event) на канал. Возвращает функцию отписки."""
+        with self._lock:
+            self.subscribers.setdefault(channel, set()).add(callback)
+
+        def unsubscribe():
+            with self._lock:
+                callbacks = self.subscribers.get(channel)
+                if callbacks is not None:
+                    callbacks.discard(callback)
+                    if not callbacks:
+                        del self.subscribers[channel]
+
+        return unsubscribe
+
+    def publish(self, channel, event):
+        """Отправляет событие подписчикам канала. Возвращает число подписчиков."""
+        with self._lock:
+            callbacks = list(self.subscribers.get(channel, ()))
+        for callback in callbacks:
+            try:
+                callback(event)
+            except Exception:
+                logger.exception("pubsub subscriber failed on %s", channel)
+        return len(callbacks)
+
+    def channel_count(self):
+        with self._lock:
+            return len(self.subscribers)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """Брокер из CHATBOT_PUBSUB_BACKEND, один на процесс."""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                config = settings.CHATBOT_PUBSUB_BACKEND
+                _broker = import_string(config["BACKEND"])(**config.get("OPTIONS", {}))
+    return _broker
+
+
+@receiver(setting_changed)
+def reset_broker(setting, **kwargs):
+    global _broker
+    if setting == "CHATBOT_PUBSUB_BACKEND":
+        _broker = None
+
+
+def notify_message(chat, origin=None):
+    """
+    После коммита рассылает готовое сообщение всем подключениям пользователя
+    (другие вкладки, ответы фоновой обработки). origin — id WebSocket-соединения,
+    отправившего сообщение: оно уже получило ответ и событие пропускает.
+    """
+    from .serializers import ChatMessageSerializer
+    event = {"type": "message", "message": ChatMessageSerializer(chat).data, "origin": origin}
+    channel = user_channel(chat.user_id)
+    transaction.on_commit(lambda: get_broker().publish(channel, event))
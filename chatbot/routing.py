@@ -0,0 +1,121 @@
+import copy
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from rest_framework.exceptions import NotFound, ValidationError
+
+from .cache import ResponseCache
+from .models import Conversation
+
+CACHE_PREFIX = "chatbot:active-conversation"
+# Попыток переключить активную беседу при одновременном переключении из другого запроса
+SWITCH_ATTEMPTS = 3
+
+
+class ActiveConversations:
+    """
+    Указатель пользователя на активную беседу (Conversation.is_active) с кэшем в два уровня:
+    в памяти процесса (короткий TTL) и в общем кэше Django. При попадании в кэш беседа не читается
+    из БД; при промахе — один запрос по частичному уникальному индексу (user) WHERE is_active.
+
+    В кэше лежит сама беседа. Поля, которые читает чат (summary, archived_at), меняются редко
+    и сбрасывают кэш (forget); счетчики в снимке могут отставать на несколько ходов.
+    Другие процессы видят сброс в общем кэше сразу, а свой кэш в памяти — через его TTL.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.local = ResponseCache(max_size, ttl)
+
+    @property
+    def shared(self):
+        return caches[settings.CHATBOT_CONVERSATION_CACHE]
+
+    def key(self, user_id):
+        return f"{CACHE_PREFIX}:{user_id}"
+
+    def get(self, user):
+        key = self.key(user.pk)
+        conversation = self.local.get(key)
+        if conversation is None:
+            conversation = self.shared.get(key)
+            if conversation is None:
+                conversation = Conversation.objects.filter(user=user, is_active=True).first() or claim(user)
+                self.shared.set(key, conversation, settings.CHATBOT_CONVERSATION_CACHE_TTL)
+            self.local.set(key, conversation)
+        # Копия: запрос меняет свой экземпляр (summary, archived_at), кэш — нет
+        return copy.copy(conversation)
+
+    def forget(self, user_id):
+        key = self.key(user_id)
+        self.local.delete(key)
+        self.shared.delete(key)
+
+    def clear(self):
+        self.local.clear()
+
+
+active_conversations = ActiveConversations(
+    settings.CHATBOT_CONVERSATION_LOCAL_CACHE_SIZE, settings.CHATBOT_CONVERSATION_LOCAL_CACHE_TTL
+)
+
+
+def claim(user):
+    """
+    Назначает активной последнюю беседу пользователя, а если бесед нет — создает новую.
+    Одновременный запрос, проигравший на уникальном ограничении, берет беседу победителя.
+    """
+    latest = Conversation.objects.filter(user=user).order_by('-last_message_at', '-id').first()
+    try:
+        with transaction.atomic():
+            if latest is None:
+                return Conversation.objects.create(user=user, is_active=True)
+            Conversation.objects.filter(pk=latest.pk).update(is_active=True)
+            latest.is_active = True
+            return latest
+    except IntegrityError:
+        return Conversation.objects.get(user=user, is_active=True)
+
+
+def activate(conversation):
+    """Делает беседу активной для ее пользователя."""
+    switch(conversation.user_id, lambda: Conversation.objects.filter(pk=conversation.pk).update(is_active=True))
+    conversation.is_active = True
+    return conversation
+
+
+def start_conversation(user, title=""):
+    """Новая беседа, сразу активная."""
+    return switch(user.pk, lambda: Conversation.objects.create(user=user, title=title, is_active=True))
+
+
+def switch(user_id, make_active):
+    for attempt in range(SWITCH_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                Conversation.objects.filter(user_id=user_id, is_active=True).update(is_active=False)
+                result = make_active()
+            break
+        except IntegrityError:
+            # Другой запрос одновременно назначил свою беседу: снимаем и ее
+            if attempt == SWITCH_ATTEMPTS - 1:
+                raise
+    active_conversations.forget(user_id)
+    return result
+
+
+def resolve_conversation(user, conversation_id=None):
+    """
+    Беседа для нового сообщения: явная conversation_id (одним запросом по первичному ключу)
+    или активная беседа пользователя.
+    """
+    if conversation_id in (None, ""):
+        return active_conversations.get(user)
+    try:
+        conversation_id = int(conversation_id)
+    except (TypeError, ValueError):
+        raise ValidationError({"conversation_id": "A valid integer is required."})
+    conversation = Conversation.objects.filter(pk=conversation_id, user=user).first()
+    if conversation is None:
+        raise NotFound("Conversation not found")
+    return conversation
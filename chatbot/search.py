@@ -0,0 +1,142 @@
+import html
+import re
+
+from django.db import connection
+
+from .models import ChatMessage
+
+# Индексы создает миграция 0010_chatmessage_search:
+# SQLite — FTS5-таблица с внешним содержимым, которую ведут триггеры на chatbot_chatmessage;
+# Postgres — GIN по выражению SEARCH_DOCUMENT, его Postgres обновляет сам.
+FTS_TABLE = "chatbot_chatmessage_fts"
+SEARCH_DOCUMENT = "to_tsvector('simple', message || ' ' || response)"
+
+# Границы подсветки: служебные символы, чтобы экранировать текст сообщения до вставки <mark>
+MARK_START, MARK_END = "\x02", "\x03"
+SNIPPET_WORDS = 24
+TERM_RE = re.compile(r'"([^"]*)"|(\w+\*?)')
+
+
+def fts5_query(query):
+    """
+    Запрос пользователя в синтаксисе FTS5: слова и "фразы в кавычках" через AND, слово* — по префиксу.
+    Операторы FTS5 из ввода не передаются, поэтому запрос не может быть синтаксически неверным.
+    """
+    terms = []
+    for phrase, word in TERM_RE.findall(query):
+        if phrase:
+            words = re.findall(r"\w+", phrase)
+            if words:
+                terms.append('"' + " ".join(words) + '"')
+        elif word.endswith("*"):
+            terms.append(f'"{word[:-1]}"*')
+        else:
+            terms.append(f'"{word}"')
+    return " AND ".join(terms)
+
+
+def mark(text):
+    return html.escape(text or "").replace(MARK_START, "<mark>").replace(MARK_END, "</mark>")
+
+
+class MessageSearch:
+    """
+    Полнотекстовый поиск по сообщениям пользователя (вопрос и ответ бота).
+    Результаты упорядочены по (rank, id), rank меньше — релевантнее; fetch(after=(rank, id))
+    продолжает выдачу после строки предыдущей страницы.
+    """
+
+    def __init__(self, user, query, conversation_id=None):
+        self.user = user
+        self.query = query
+        self.conversation_id = conversation_id
+
+    def fetch(self, after=None, limit=20):
+        if connection.vendor == "postgresql":
+            rows = self.postgres_rows(after, limit)
+        else:
+            rows = self.sqlite_rows(after, limit)
+        if not rows:
+            return []
+
+        messages = ChatMessage.objects.only("id", "conversation", "created_at", "status").in_bulk(
+            [row[0] for row in rows]
+        )
+        results = []
+        for pk, rank, message, response in rows:
+            if pk in messages:
+                msg = messages[pk]
+                msg.rank = rank
+                msg.message_highlight = mark(message)
+                msg.response_highlight = mark(response)
+                results.append(msg)
+        return results
+
+    def sqlite_rows(self, after, limit):
+        match = fts5_query(self.query)
+        if not match:
+            return []
+        # Колонка user_id проиндексирована вместе с текстом: FTS5 пересекает списки документов
+        # и не ранжирует чужие сообщения. Ее вес в bm25 нулевой.
+        params = [MARK_START, MARK_END, MARK_START, MARK_END, SNIPPET_WORDS, f'user_id : "{self.user.pk}" AND {{message response}} : ({match})']
+        sql = f"""
+            SELECT {FTS_TABLE}.rowid, bm25({FTS_TABLE}, 1.0, 1.0, 0.0) AS rank,
+                   highlight({FTS_TABLE}, 0, %s, %s),
+                   snippet({FTS_TABLE}, 1, %s, %s, '…', %s)
+            FROM {FTS_TABLE}
+            JOIN chatbot_chatmessage m ON m.id = {FTS_TABLE}.rowid
+            WHERE {FTS_TABLE} MATCH %s
+        """
+        if self.conversation_id:
+            sql += " AND m.conversation_id = %s"
+            params.append(self.conversation_id)
+        if after is not None:
+            sql += f" AND (bm25({FTS_TABLE}, 1.0, 1.0, 0.0) > %s OR (bm25({FTS_TABLE}, 1.0, 1.0, 0.0) = %s AND m.id > %s))"
+            params += [after[0], after[0], after[1]]
+        sql += " ORDER BY rank, m.id LIMIT %s"
+        params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def postgres_rows(self, after, limit):
+        if not self.query.strip():
+            return []
+        options = f"StartSel={MARK_START}, StopSel={MARK_END}"
+        params = [
+            options + ", HighlightAll=true",
+            options + f", MaxWords={SNIPPET_WORDS}, MinWords={SNIPPET_WORDS // 2}",
+            self.query, self.user.pk,
+        ]
+        # Условие @@ повторяет выражение индекса дословно, иначе GIN не используется
+        sql = f"""
+            SELECT id, rank, ts_headline('simple', message, q, %s), ts_headline('simple', response, q, %s)
+            FROM (
+                SELECT m.id, m.message, m.response, q, -ts_rank_cd({SEARCH_DOCUMENT}, q) AS rank
+                FROM chatbot_chatmessage m, websearch_to_tsquery('simple', %s) q
+                WHERE {SEARCH_DOCUMENT} @@ q AND m.user_id = %s
+        """
+        if self.conversation_id:
+            sql += " AND m.conversation_id = %s"
+            params.append(self.conversation_id)
+        sql += ") ranked"
+        if after is not None:
+            sql += " WHERE (rank, id) > (%s, %s)"
+            params += [after[0], after[1]]
+        sql += " ORDER BY rank, id LIMIT %s"
+        params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+
+def rebuild_index(optimize=False):
+    """Перестраивает индекс из таблицы сообщений (после загрузки в обход триггеров или повреждения)."""
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute("REINDEX INDEX chatmessage_search_idx")
+            return
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+        if optimize:
+            # Сливает сегменты индекса в один: меньше чтений на запрос
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
@@ -0,0 +1,176 @@
+import os
+import re
+import threading
+from array import array
+
+from django.conf import settings
+
+LEXICON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lexicons")
+
+# Пороги те же, что были у TextBlob в ChatBotView
+POSITIVE_THRESHOLD = 0.1
+NEGATIVE_THRESHOLD = -0.1
+
+SARCASM_RE = re.compile(r"\( ?! ?\)")
+
+
+def label(polarity):
+    if polarity > POSITIVE_THRESHOLD:
+        return "positive"
+    elif polarity < NEGATIVE_THRESHOLD:
+        return "negative"
+    else:
+        return "neutral"
+
+
+class LexiconSentiment:
+    """
+    Оценка тональности по словарю, совместимая с PatternAnalyzer из TextBlob:
+    те же полярности слов, усилители ("very good"), отрицания ("not good"), "!" и смайлики.
+    Словари загружаются один раз в компактные структуры: слово -> индекс в массивах.
+    """
+
+    def __init__(self, paths):
+        self.index = {}
+        self.polarity = array("d")
+        self.intensity = array("d")
+        self.modifier = bytearray()
+        self.negations = set()
+        self.clitics = set()
+        self.emoticons = {}
+        for path in paths:
+            self.load(path)
+        self.negations = frozenset(self.negations)
+        self.clitics = frozenset(self.clitics)
+
+        emoticons = "|".join(re.escape(e) for e in sorted(self.emoticons, key=len, reverse=True))
+        self.token_re = re.compile(
+            r"\(!\)"
+            + (rf"|(?<!\w)(?:{emoticons})(?!\w)" if emoticons else "")
+            + r"|[^\W_]+(?:[-.*][^\W_]+)*|[^\w\s]"
+        )
+
+    def load(self, path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip() or line.startswith("#"):
+                    continue
+                word, polarity, intensity, flags = line.rstrip("\n").split("\t")
+                if "n" in flags:
+                    self.negations.add(word)
+                if "c" in flags:
+                    self.clitics.add(word)
+                if polarity == "-":
+                    continue
+                if "e" in flags:
+                    self.emoticons.setdefault(word, float(polarity))
+                    continue
+                # Слова из первого словаря (английского) не переопределяются
+                if word in self.index:
+                    continue
+                self.index[word] = len(self.polarity)
+                self.polarity.append(float(polarity))
+                self.intensity.append(float(intensity))
+                self.modifier.append(1 if "m" in flags else 0)
+
+    def tokenize(self, text):
+        # Как у pattern: апостроф отделяется ("don't" -> "don ' t")
+        return self.token_re.findall(SARCASM_RE.sub(" (!) ", text.lower()))
+
+    def score(self, text):
+        """Полярность текста от -1.0 до 1.0 (см. pattern Sentiment.assessments)."""
+        index, polarity, intensity, modifier = self.index, self.polarity, self.intensity, self.modifier
+        negations, clitics, emoticons = self.negations, self.clitics, self.emoticons
+
+        scores = []  # [полярность, интенсивность, отрицание] для каждой оценки
+        m = None  # предыдущий усилитель
+        n = None  # предыдущее отрицание
+        for w in self.tokenize(text):
+            i = index.get(w)
+            if i is not None:
+                if m is None:
+                    scores.append([polarity[i], intensity[i], False])
+                else:
+                    last = scores[-1]
+                    last[0] = max(-1.0, min(polarity[i] * last[1], 1.0))
+                    last[1] = intensity[i]
+                if n is not None:
+                    scores[-1][1] = 1.0 / scores[-1][1] if scores[-1][1] else 0.0
+                    scores[-1][2] = True
+                m = w if modifier[i] else None
+                n = w if w in negations else None
+                continue
+
+            if w in negations:
+                n = w
+            elif n and len(w.strip("'")) > 1 and w not in clitics:
+                # Местоимение между ne и глаголом отрицание не закрывает: "je ne l'aime pas"
+                n = None
+            if n is not None and m is not None and m.endswith("ly"):
+                # "really not good"
+                scores[-1][2] = True
+                n = None
+            elif m and len(w) > 2:
+                m = None
+            if w == "!" and scores:
+                scores[-1][0] = max(-1.0, min(scores[-1][0] * 1.25, 1.0))
+            elif w == "(!)":
+                scores.append([0.0, 1.0, False])
+            elif w in emoticons:
+                scores.append([emoticons[w], 1.0, False])
+
+        if not scores:
+            return 0.0
+        # "not good" = слегка плохо, "not bad" = слегка хорошо
+        return sum(p * -0.5 if negated else p for p, _, negated in scores) / len(scores)
+
+    def score_many(self, texts):
+        score = self.score
+        return [score(text) if text else 0.0 for text in texts]
+
+
+class TextBlobSentiment:
+    """Прежний движок, оставлен для сравнения (CHATBOT_SENTIMENT_ENGINE = 'textblob')."""
+
+    def __init__(self):
+        from textblob import TextBlob
+        self.TextBlob = TextBlob
+
+    def score(self, text):
+        return self.TextBlob(text).sentiment.polarity
+
+    def score_many(self, texts):
+        return [self.score(text) if text else 0.0 for text in texts]
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def lexicon_paths():
+    # Английский словарь первым: его значения совпадают с TextBlob
+    names = sorted(name for name in os.listdir(LEXICON_DIR) if name.endswith(".tsv"))
+    names.sort(key=lambda name: name != "en.tsv")
+    return [os.path.join(LEXICON_DIR, name) for name in names]
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                if settings.CHATBOT_SENTIMENT_ENGINE == "textblob":
+                    _engine = TextBlobSentiment()
+                else:
+                    _engine = LexiconSentiment(lexicon_paths())
+    return _engine
+
+
+def analyze_sentiment(text):
+    if not text:
+        return "neutral"
+    return label(get_engine().score(text))
+
+
+def analyze_sentiment_many(texts):
+    return [label(polarity) for polarity in get_engine().score_many(texts)]
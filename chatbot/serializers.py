@@ -4,13 +4,31 @@ from .models import ChatMessage, Conversation, UserSettings
 class ConversationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Conversation
-        fields = ['id', 'title', 'created_at']
+        fields = [
+            'id', 'title', 'created_at', 'last_message_at', 'message_count', 'last_message_preview', 'archived_at',
+            'is_active',
+        ]
+        read_only_fields = ['created_at', 'last_message_at', 'message_count', 'last_message_preview', 'archived_at', 'is_active']
 
 
 class ChatMessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = ChatMessage
-        fields = ['id', 'user', 'conversation', 'message', 'response', 'file', 'sentiment', 'created_at']
+        fields = ['id', 'user', 'conversation', 'message', 'response', 'file', 'sentiment', 'status', 'created_at']
+
+
+class ChatSearchResultSerializer(serializers.ModelSerializer):
+    # Текст экранирован, совпадения обернуты в <mark>
+    message = serializers.CharField(source='message_highlight')
+    response = serializers.CharField(source='response_highlight')
+    score = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ChatMessage
+        fields = ['id', 'conversation', 'message', 'response', 'status', 'score', 'created_at']
+
+    def get_score(self, obj):
+        return round(-obj.rank, 6)
 
 
 class UserSettingsSerializer(serializers.ModelSerializer):
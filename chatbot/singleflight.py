@@ -0,0 +1,167 @@
+import asyncio
+import threading
+import time
+import uuid
+import weakref
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class SingleFlightTimeout(Exception):
+    """Ведомый запрос не дождался результата ведущего."""
+
+
+class SingleFlightError(Exception):
+    """Ведущий запрос в другом процессе завершился ошибкой."""
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Схлопывает одновременные вызовы с одинаковым ключом в один:
+    первый (ведущий) выполняет fn, остальные ждут и получают его результат или его ошибку.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, timeout=None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as exc:
+                call.error = exc
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+            return call.result
+
+        if not call.done.wait(timeout):
+            raise SingleFlightTimeout(f"Timed out waiting for in-flight call {key}")
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class AsyncSingleFlight:
+    """
+    То же для корутин. Вызовы схлопываются в пределах своего event loop: future чужого loop
+    ждать нельзя. fn выполняется отдельной задачей, и каждый вызывающий ждет ее через shield:
+    отмена одного из них, в том числе ведущего, не отменяет вызов для остальных.
+    """
+
+    def __init__(self):
+        self._calls = weakref.WeakKeyDictionary()
+
+    async def do(self, key, fn, timeout=None):
+        loop = asyncio.get_running_loop()
+        calls = self._calls.setdefault(loop, {})
+        task = calls.get(key)
+        if task is None:
+            task = calls[key] = loop.create_task(fn())
+            task.add_done_callback(lambda done: self._finish(calls, key, done))
+            return await asyncio.shield(task)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            raise SingleFlightTimeout(f"Timed out waiting for in-flight call {key}") from None
+
+    @staticmethod
+    def _finish(calls, key, task):
+        if calls.get(key) is task:
+            del calls[key]
+        if not task.cancelled():
+            # Исключение уже получили ожидающие, а если все они отменены — предупреждать не о чем
+            task.exception()
+
+
+class SharedSingleFlight:
+    """
+    Межпроцессный вариант поверх общего кэша Django (Redis, Memcached):
+    ведущий берет блокировку через cache.add и публикует результат, ведомые опрашивают кэш.
+    """
+
+    def __init__(self, cache_alias="default", poll_interval=0.05, lock_ttl=120, result_ttl=30):
+        self.cache_alias = cache_alias
+        self.poll_interval = poll_interval
+        self.lock_ttl = lock_ttl
+        self.result_ttl = result_ttl
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def do(self, key, fn, timeout=None):
+        lock_key = f"singleflight:{key}:lock"
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            token = uuid.uuid4().hex
+            if self.cache.add(lock_key, token, self.lock_ttl):
+                return self._lead(lock_key, token, fn)
+
+            # Блокировку держит другой процесс: ждем результат его вызова
+            leader_token = self.cache.get(lock_key)
+            while leader_token is not None:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise SingleFlightTimeout(f"Timed out waiting for in-flight call {key}")
+                time.sleep(self.poll_interval)
+                outcome = self.cache.get(f"singleflight:result:{leader_token}")
+                if outcome is not None:
+                    ok, value = outcome
+                    if ok:
+                        return value
+                    raise SingleFlightError(value)
+                leader_token = self.cache.get(lock_key)
+            # Ведущий отпустил блокировку без результата (упал или истек lock_ttl): пробуем сами
+
+    def _lead(self, lock_key, token, fn):
+        result_key = f"singleflight:result:{token}"
+        try:
+            value = fn()
+        except Exception as exc:
+            self.cache.set(result_key, (False, f"{type(exc).__name__}: {exc}"), self.result_ttl)
+            raise
+        else:
+            self.cache.set(result_key, (True, value), self.result_ttl)
+            return value
+        finally:
+            if self.cache.get(lock_key) == token:
+                self.cache.delete(lock_key)
+
+
+flights = SingleFlight()
+async_flights = AsyncSingleFlight()
+shared_flights = SharedSingleFlight(settings.CHATBOT_SINGLEFLIGHT_CACHE)
+
+
+def coalesce(key, fn):
+    """
+    Выполняет fn один раз на все одновременные запросы с ключом key:
+    сначала внутри процесса, а при CHATBOT_SINGLEFLIGHT_SHARED — и между процессами.
+    """
+    timeout = settings.CHATBOT_SINGLEFLIGHT_TIMEOUT
+    if settings.CHATBOT_SINGLEFLIGHT_SHARED:
+        return flights.do(key, lambda: shared_flights.do(key, fn, timeout), timeout)
+    return flights.do(key, fn, timeout)
+
+
+async def acoalesce(key, fn):
+    return await async_flights.do(key, fn, settings.CHATBOT_SINGLEFLIGHT_TIMEOUT)
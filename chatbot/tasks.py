@@ -0,0 +1,115 @@
+import logging
+
+from celery import shared_task
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, Value, When
+
+from .archive import archive_inactive
+from .context import build_context
+from .llm import LLMUnavailable
+from .memory import index_messages
+from .metrics import TurnStats, save_turn_metrics
+from .models import ChatMessage, Conversation, message_preview
+from .prompt import forget_prompt
+from .pubsub import notify_message
+from .sentiment import analyze_sentiment
+from .singleflight import SingleFlightError, SingleFlightTimeout
+from .tokens import turn_tokens
+from .utils import ask_openai
+
+logger = logging.getLogger(__name__)
+
+# Временные сбои модели (сеть, 5xx, дедлайн, открытый breaker): задача повторяется с экспоненциальной задержкой
+RETRYABLE_ERRORS = (LLMUnavailable, SingleFlightError, SingleFlightTimeout)
+
+
+@shared_task(bind=True, acks_late=True, max_retries=settings.CHATBOT_TASK_MAX_RETRIES)
+def process_chat_message(self, message_id, use_cache=True):
+    """
+    Получает ответ модели и тональность для сообщения, сохраненного в статусе pending.
+    Повторная доставка задачи (acks_late, повтор после сбоя) не вызывает модель второй раз.
+    """
+    chat = (
+        ChatMessage.objects.select_related('conversation')
+        .filter(pk=message_id, status=ChatMessage.PENDING)
+        .first()
+    )
+    if chat is None:
+        return
+
+    stats = TurnStats()
+    try:
+        with stats.track_db():
+            with stats.timer('sentiment_ms'):
+                sentiment = analyze_sentiment(chat.message)
+            context = build_context(chat.message, chat.conversation)
+            response_text = ask_openai(chat.message, chat.conversation, context=context, use_cache=use_cache, stats=stats)
+    except RETRYABLE_ERRORS as exc:
+        if self.request.retries < self.max_retries:
+            countdown = settings.CHATBOT_TASK_RETRY_DELAY * 2 ** self.request.retries
+            logger.warning("chat message %s: %s, retry in %ss", message_id, exc, countdown)
+            raise self.retry(exc=exc, countdown=countdown)
+        logger.error("chat message %s failed after %d retries: %s", message_id, self.request.retries, exc)
+        mark_failed(message_id)
+        return
+    except Exception:
+        logger.exception("chat message %s failed", message_id)
+        mark_failed(message_id)
+        return
+
+    # Обновляем только pending: параллельная доставка той же задачи не перезапишет ответ
+    updated = ChatMessage.objects.filter(pk=message_id, status=ChatMessage.PENDING).update(
+        response=response_text, sentiment=sentiment, status=ChatMessage.DONE
+    )
+    if updated:
+        # Ход с ответом мог оказаться раньше уже закэшированных ходов беседы
+        forget_prompt(chat.conversation_id)
+        # При создании в history_tokens и превью учтено только сообщение без ответа
+        Conversation.objects.filter(pk=chat.conversation_id).update(
+            history_tokens=F('history_tokens')
+            + turn_tokens(chat.message, response_text) - turn_tokens(chat.message, ""),
+            last_message_preview=Case(
+                When(last_message_at=chat.created_at, then=Value(message_preview(chat.message, response_text))),
+                default=F('last_message_preview'),
+            ),
+        )
+        if settings.CHATBOT_MEMORY_ENABLED:
+            transaction.on_commit(lambda: index_chat_message.delay(message_id))
+        stats.record(chat)
+        # Клиент, подключенный по WebSocket, получает ответ без опроса
+        chat.refresh_from_db()
+        notify_message(chat)
+
+
+def mark_failed(message_id):
+    ChatMessage.objects.filter(pk=message_id, status=ChatMessage.PENDING).update(status=ChatMessage.FAILED)
+
+
+@shared_task(acks_late=True)
+def index_chat_message(message_id):
+    """Добавляет готовый ход в векторный индекс пользователя. Повторный вызов ничего не меняет."""
+    chat = ChatMessage.objects.filter(pk=message_id, status=ChatMessage.DONE).first()
+    if chat is not None:
+        index_messages([chat])
+
+
+@shared_task(acks_late=True)
+def index_chat_messages(message_ids):
+    """То же для нескольких ходов (пакетный чат): эмбеддинги считаются одним вызовом."""
+    index_messages(ChatMessage.objects.filter(pk__in=message_ids, status=ChatMessage.DONE))
+
+
+@shared_task(acks_late=True)
+def record_turn_metrics(message_id, values):
+    """Сохраняет замеры хода (TurnMetrics) и добавляет их в дневные сводки."""
+    chat = ChatMessage.objects.filter(pk=message_id).only('id', 'user', 'created_at').first()
+    if chat is not None:
+        save_turn_metrics(chat, values)
+
+
+@shared_task
+def archive_inactive_conversations():
+    """Переносит неактивные беседы в архив (по расписанию CELERY_BEAT_SCHEDULE)."""
+    conversations, messages = archive_inactive()
+    logger.info("archived %d conversations (%d messages)", conversations, messages)
@@ -3,11 +3,78 @@
 from django.contrib.auth import get_user_model
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
-from chatbot.models import ChatMessage, Conversation
+from chatbot.models import ChatMessage, Conversation, ConversationArchive, DailyUsage, LatencyHistogram, StoredFile, TurnMetrics, UserSettings, message_preview
+from django.core.files.storage import default_storage
 from django.core.files.uploadedfile import SimpleUploadedFile
+from chatbot.archive import archive_batch, archive_inactive, pack
+from chatbot.cache import ResponseCache, response_cache
+from chatbot.context import build_context
+from chatbot.fake_llm import FakeBackend
+from chatbot.llm import CircuitBreaker, LLMRouter, LLMTimeout, LLMUnavailable, get_llm
+from chatbot.prompt import PromptPrefix, forget_prompt, prompt_cache
+from chatbot.pubsub import get_broker, user_channel
+from chatbot.routing import active_conversations, claim, resolve_conversation
+from chatbot.websocket import websocket_application
+from chatbot.memory import HashEmbedder, MemoryIndex, recall, user_index
+from chatbot.metrics import TurnStats, bucket_upper_ms, latency_bucket, percentiles, save_turn_metrics
+from chatbot.sentiment import LexiconSentiment, TextBlobSentiment, analyze_sentiment, analyze_sentiment_many, label, lexicon_paths
+from chatbot.singleflight import AsyncSingleFlight, SharedSingleFlight, SingleFlight, SingleFlightError, SingleFlightTimeout
+from chatbot.tokens import turn_tokens
+from chatbot.uploads import store_upload
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.test import SimpleTestCase, override_settings
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import RefreshToken
+from unittest.mock import patch
+import asyncio
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
 
 User = get_user_model()
 
+# Хранилище в памяти вместо локальной папки или S3
+IN_MEMORY_STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.InMemoryStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+
+def use_fake_llm(testcase, **options):
+    """Подменяет модель локальным FakeBackend до конца теста и возвращает его."""
+    override = override_settings(
+        CHATBOT_LLM_BACKENDS=[{'BACKEND': 'chatbot.fake_llm.FakeBackend', 'OPTIONS': options}]
+    )
+    override.enable()
+    testcase.addCleanup(override.disable)
+    return get_llm().primary
+
+
+def reset_conversation_caches():
+    """Id в тестовой БД повторяются: активные беседы и ходы бесед из прошлых тестов сбрасываются."""
+    active_conversations.clear()
+    prompt_cache.clear()
+    caches[settings.CHATBOT_CONVERSATION_CACHE].clear()
+
+
+def use_memory_root(testcase):
+    """Индексы долговременной памяти пишутся во временную папку, удаляемую после теста."""
+    root = tempfile.TemporaryDirectory()
+    override = override_settings(CHATBOT_MEMORY_ROOT=root.name)
+    override.enable()
+    testcase.addCleanup(root.cleanup)
+    testcase.addCleanup(override.disable)
+    return root.name
+
 
 class ChatBotTests(APITestCase):
     def setUp(self):
@@ -15,6 +82,8 @@ class ChatBotTests(APITestCase):
         self.client = APIClient()
         self.client.force_authenticate(user=self.user)
         self.url = '/api/chatbot/chat/'
+        self.fake = use_fake_llm(self)
+        reset_conversation_caches()
 
     def test_create_conversation_and_chat(self):
         response = self.client.post(self.url, {'message': 'Привет, бот!'}, format='json')
@@ -31,12 +100,15 @@ class ChatBotTests(APITestCase):
         # Проверяем, что был создан разговор (если логика предполагает создание нового разговора)
         self.assertTrue(Conversation.objects.exists())
 
+@override_settings(STORAGES=IN_MEMORY_STORAGES)
 class ChatBotTestsWithFileAndSentiment(APITestCase):
     def setUp(self):
         self.user = User.objects.create_user(email='test@example.com', password='testpass123')
         self.client = APIClient()
         self.client.force_authenticate(user=self.user)
         self.url = '/api/chatbot/chat/'
+        self.fake = use_fake_llm(self)
+        reset_conversation_caches()
 
     def test_send_message_with_file_and_sentiment(self):
         # Создаем файл для теста
@@ -49,7 +121,8 @@ class ChatBotTestsWithFileAndSentiment(APITestCase):
 
         # Проверяем, что файл был сохранен
         chat_message = ChatMessage.objects.first()
-        self.assertEqual(chat_message.file, 'chat_files/test_file.txt')  # Убедитесь, что путь к файлу корректен
+        digest = hashlib.sha256(b'file_content').hexdigest()
+        self.assertEqual(chat_message.file, f'chat_files/{digest[:2]}/{digest}.txt')  # Путь по содержимому файла
 
         # Проверяем, что настроение анализа правильное
         self.assertEqual(chat_message.sentiment, 'positive')
@@ -60,6 +133,8 @@ class ChatHistoryTests(APITestCase):
         self.client = APIClient()
         self.client.force_authenticate(user=self.user)
         self.url = '/api/chatbot/chat/'
+        self.fake = use_fake_llm(self)
+        reset_conversation_caches()
 
         # Создаем разговор
         self.client.post(self.url, {'message': 'Привет, бот!'}, format='json')
@@ -74,10 +149,1741 @@ class ChatHistoryTests(APITestCase):
         # Проверяем, что получаем статус 200
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         
-        # Проверяем, что в ответе есть хотя бы одно сообщение
-        self.assertGreater(len(response.data), 0)
+        # Проверяем, что в ответе есть хотя бы одно сообщение (ответ разбит на страницы)
+        self.assertGreater(len(response.data['results']), 0)
 
         # Проверяем, что все сообщения принадлежат правильному разговору
-        for message in response.data:
+        for message in response.data['results']:
             self.assertEqual(message['conversation'], conversation.id)
 
+
+
+class CursorPaginationTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.conversation = Conversation.objects.create(user=self.user)
+        ChatMessage.objects.bulk_create([
+            ChatMessage(user=self.user, conversation=self.conversation, message=f'question {i}', response=f'answer {i}')
+            for i in range(25)
+        ])
+        # Несколько сообщений с одинаковым created_at: порядок между ними задает id
+        ChatMessage.objects.filter(id__in=ChatMessage.objects.order_by('id').values('id')[5:15]).update(
+            created_at=ChatMessage.objects.order_by('id')[5].created_at
+        )
+        self.url = f'/api/chatbot/conversations/{self.conversation.id}/messages/'
+
+    def test_pages_forward_and_back(self):
+        expected = list(ChatMessage.objects.order_by('created_at', 'id').values_list('id', flat=True))
+
+        pages = []
+        response = self.client.get(self.url, {'page_size': 10})
+        self.assertIsNone(response.data['previous'])
+        while True:
+            pages.append([message['id'] for message in response.data['results']])
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(sum(pages, []), expected)
+
+        # Назад от последней страницы
+        previous = self.client.get(response.data['previous'])
+        self.assertEqual([message['id'] for message in previous.data['results']], pages[1])
+        previous = self.client.get(previous.data['previous'])
+        self.assertEqual([message['id'] for message in previous.data['results']], pages[0])
+        self.assertIsNone(previous.data['previous'])
+
+    def test_conversation_list_recent_first(self):
+        older = self.conversation
+        newer = Conversation.objects.create(user=self.user)
+        Conversation.objects.create(user=User.objects.create_user(email='other@example.com', password='testpass123'))
+
+        response = self.client.get('/api/chatbot/conversations/', {'page_size': 1})
+        self.assertEqual([item['id'] for item in response.data['results']], [newer.id])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([item['id'] for item in response.data['results']], [older.id])
+        self.assertIsNone(response.data['next'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {'cursor': 'cD1ub3QtYS1kYXRl'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+
+class ConversationStatsTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.conversation = Conversation.objects.create(user=self.user)
+
+    def add_message(self, conversation, message, response=''):
+        return ChatMessage.objects.create(user=self.user, conversation=conversation, message=message, response=response)
+
+    def test_counters_follow_messages(self):
+        self.add_message(self.conversation, 'Where is the tax office?', 'On the main square.')
+        last = self.add_message(self.conversation, 'When does it open?', 'At 9 am. ' * 20)
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 2)
+        self.assertEqual(self.conversation.last_message_at, last.created_at)
+        self.assertEqual(self.conversation.last_message_preview, ('At 9 am. ' * 20)[:100])
+
+        # Удаление последнего сообщения возвращает превью предыдущего
+        last.delete()
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 1)
+        self.assertEqual(self.conversation.last_message_preview, 'On the main square.')
+
+        # Удалено последнее оставшееся: превью и время — как у новой беседы
+        self.conversation.chatmessage_set.get().delete()
+        self.conversation.refresh_from_db()
+        self.assertEqual((self.conversation.message_count, self.conversation.last_message_preview), (0, ''))
+        self.assertEqual(self.conversation.last_message_at, self.conversation.created_at)
+
+    def test_message_and_counters_saved_together(self):
+        with patch('chatbot.models.count_new_messages', side_effect=DatabaseError('counter update failed')):
+            with self.assertRaises(DatabaseError):
+                self.add_message(self.conversation, 'Where is the tax office?')
+        self.assertFalse(ChatMessage.objects.exists())
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 0)
+
+    def test_list_sorted_by_activity(self):
+        other = Conversation.objects.create(user=self.user)
+        self.add_message(other, 'Hello')
+        self.add_message(self.conversation, 'How do I open a bank account?', 'Bring your passport.')
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/chatbot/conversations/')
+        first, second = response.data['results']
+        self.assertEqual(first['id'], self.conversation.id)
+        self.assertEqual(first['message_count'], 1)
+        self.assertEqual(first['last_message_preview'], 'Bring your passport.')
+        self.assertEqual(second['id'], other.id)
+        self.assertEqual(second['last_message_preview'], 'Hello')
+
+    def test_rebuild_command(self):
+        # bulk_create обходит ChatMessage.save, счетчики расходятся с данными
+        ChatMessage.objects.bulk_create([
+            ChatMessage(user=self.user, conversation=self.conversation, message=f'question {i}', response=f'answer {i}')
+            for i in range(5)
+        ])
+        empty = Conversation.objects.create(user=self.user)
+        Conversation.objects.filter(pk=empty.pk).update(message_count=7, last_message_preview='stale')
+
+        call_command('rebuild_conversation_stats', batch_size=1, stdout=open(os.devnull, 'w'))
+
+        self.conversation.refresh_from_db()
+        latest = ChatMessage.objects.order_by('-created_at', '-id').first()
+        self.assertEqual(self.conversation.message_count, 5)
+        self.assertEqual(self.conversation.last_message_at, latest.created_at)
+        self.assertEqual(self.conversation.last_message_preview, latest.response)
+        empty.refresh_from_db()
+        self.assertEqual((empty.message_count, empty.last_message_preview), (0, ''))
+        self.assertEqual(empty.last_message_at, empty.created_at)
+
+
+
+class RoutingTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123')
+        self.client.force_authenticate(user=self.user)
+        self.url = '/api/chatbot/chat/'
+        self.fake = use_fake_llm(self, reply='Sure.')
+        use_memory_root(self)
+        response_cache.clear()
+        reset_conversation_caches()
+
+    def conversation(self, days_ago=0, **fields):
+        conversation = Conversation.objects.create(user=self.user, **fields)
+        Conversation.objects.filter(pk=conversation.pk).update(
+            last_message_at=timezone.now() - datetime.timedelta(days=days_ago)
+        )
+        return conversation
+
+    def post_async(self, data):
+        # AsyncChatBotView — обычный View с JWT, force_authenticate на него не действует
+        token = RefreshToken.for_user(self.user).access_token
+        return self.client.post('/api/chatbot/chat/async/', data, format='json', HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def test_message_without_id_goes_to_latest_conversation(self):
+        # Раньше get_or_create падал с MultipleObjectsReturned при второй беседе
+        self.conversation(days_ago=3)
+        latest = self.conversation(days_ago=1)
+        response = self.client.post(self.url, {'message': 'Hello'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['conversation'], latest.pk)
+        self.assertEqual(list(Conversation.objects.filter(is_active=True)), [latest])
+
+        response = self.client.post(self.url, {'message': 'Hello again'}, format='json')
+        self.assertEqual(response.data['conversation'], latest.pk)
+
+    def test_explicit_conversation_id(self):
+        self.conversation()
+        other = self.conversation(days_ago=5)
+        response = self.client.post(self.url, {'message': 'Hello', 'conversation_id': other.pk}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['conversation'], other.pk)
+
+        response = self.post_async({'message': 'Hi', 'conversation_id': other.pk})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['conversation'], other.pk)
+
+    def test_foreign_or_invalid_conversation_id(self):
+        stranger = User.objects.create_user(email='stranger@example.com', password='testpass123')
+        foreign = Conversation.objects.create(user=stranger)
+        for post in (lambda data: self.client.post(self.url, data, format='json'), self.post_async):
+            response = post({'message': 'Hello', 'conversation_id': foreign.pk})
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            response = post({'message': 'Hello', 'conversation_id': 'abc'})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(ChatMessage.objects.exists())
+
+    def test_active_conversation_is_cached(self):
+        conversation = resolve_conversation(self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_conversation(self.user), conversation)
+        # Процесс без своей копии берет указатель из общего кэша
+        active_conversations.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_conversation(self.user), conversation)
+
+    def test_concurrent_claim_returns_winner(self):
+        winner = self.conversation(days_ago=2)
+        self.conversation(days_ago=1)
+        # Другой запрос успел назначить свою беседу: уникальное ограничение не дает второй активной
+        Conversation.objects.filter(pk=winner.pk).update(is_active=True)
+        self.assertEqual(claim(self.user), winner)
+        self.assertEqual(Conversation.objects.filter(user=self.user, is_active=True).count(), 1)
+
+    def test_start_and_activate_conversation(self):
+        first = resolve_conversation(self.user)
+        response = self.client.post('/api/chatbot/conversations/', {'title': 'Visa'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['title'], 'Visa')
+        self.assertTrue(response.data['is_active'])
+        started = response.data['id']
+
+        response = self.client.post(self.url, {'message': 'Hello'}, format='json')
+        self.assertEqual(response.data['conversation'], started)
+
+        response = self.client.post(f'/api/chatbot/conversations/{first.pk}/activate/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['is_active'])
+        response = self.client.post(self.url, {'message': 'Hello'}, format='json')
+        self.assertEqual(response.data['conversation'], first.pk)
+        self.assertEqual(list(Conversation.objects.filter(is_active=True)), [first])
+
+        stranger = User.objects.create_user(email='stranger@example.com', password='testpass123')
+        foreign = Conversation.objects.create(user=stranger)
+        response = self.client.post(f'/api/chatbot/conversations/{foreign.pk}/activate/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(STORAGES=IN_MEMORY_STORAGES)
+class ArchiveTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123')
+        self.client.force_authenticate(user=self.user)
+        self.fake = use_fake_llm(self, reply='Sure.')
+        use_memory_root(self)
+        response_cache.clear()
+        reset_conversation_caches()
+
+    def old_conversation(self, count=3, days=200):
+        conversation = Conversation.objects.create(user=self.user)
+        messages = [
+            ChatMessage.objects.create(user=self.user, conversation=conversation, message=f'Question {i}', response=f'Answer {i}')
+            for i in range(count)
+        ]
+        past = timezone.now() - datetime.timedelta(days=days)
+        for i, msg in enumerate(messages):
+            ChatMessage.objects.filter(pk=msg.pk).update(created_at=past + datetime.timedelta(minutes=i))
+        Conversation.objects.filter(pk=conversation.pk).update(last_message_at=past + datetime.timedelta(minutes=count - 1))
+        return conversation, [msg.pk for msg in messages]
+
+    def test_archive_in_batches_and_read_history(self):
+        old, ids = self.old_conversation()
+        older, _ = self.old_conversation(count=2)
+        recent = Conversation.objects.create(user=self.user)
+        ChatMessage.objects.create(user=self.user, conversation=recent, message='Hi', response='Hello')
+        TurnMetrics.objects.create(message_id=ids[0], prompt_tokens=10)
+
+        call_command('archive_conversations', '--batch-size=1', stdout=io.StringIO())
+
+        self.assertEqual(ConversationArchive.objects.count(), 2)
+        self.assertFalse(ChatMessage.objects.filter(conversation__in=[old, older]).exists())
+        self.assertFalse(TurnMetrics.objects.exists())
+        self.assertEqual(ChatMessage.objects.filter(conversation=recent).count(), 1)
+        old.refresh_from_db()
+        self.assertIsNotNone(old.archived_at)
+        self.assertEqual(old.message_count, 3)
+
+        # История читается из архива, с той же курсорной пагинацией
+        url = f'/api/chatbot/conversations/{old.id}/messages/?page_size=2'
+        first = self.client.get(url).data
+        second = self.client.get(first['next']).data
+        self.assertEqual([msg['id'] for msg in first['results'] + second['results']], ids)
+        self.assertEqual(second['results'][0]['response'], 'Answer 2')
+        self.assertIsNone(second['next'])
+        self.assertEqual([msg['id'] for msg in self.client.get(second['previous']).data['results']], ids[:2])
+        # Повторный запуск не трогает уже архивные беседы
+        call_command('archive_conversations', stdout=io.StringIO())
+        self.assertEqual(ConversationArchive.objects.count(), 2)
+
+    def test_new_message_rehydrates(self):
+        conversation, ids = self.old_conversation()
+        created = list(ChatMessage.objects.filter(pk__in=ids).values_list('created_at', flat=True))
+        call_command('archive_conversations', stdout=io.StringIO())
+
+        response = self.client.post('/api/chatbot/chat/', {'message': 'Question 1 again'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        conversation.refresh_from_db()
+        self.assertIsNone(conversation.archived_at)
+        self.assertEqual(conversation.message_count, 4)
+        self.assertFalse(ConversationArchive.objects.exists())
+        restored = ChatMessage.objects.filter(pk__in=ids).order_by('id')
+        self.assertEqual(list(restored.values_list('created_at', flat=True)), created)
+        # Прошлые ходы попали в контекст модели, сообщения снова находит поиск
+        prompt = [message['content'] for message in self.fake.calls[-1]['messages']]
+        self.assertIn('Answer 2', prompt)
+        found = self.client.get('/api/chatbot/search/', {'q': 'answer'}).data['results']
+        self.assertEqual(sorted(msg['id'] for msg in found), ids)
+
+    def test_conversation_written_during_archival_is_skipped(self):
+        conversation, _ = self.old_conversation()
+
+        def write_then_pack(rows):
+            ChatMessage.objects.create(user=self.user, conversation=conversation, message='Still here?')
+            return pack(rows)
+
+        with patch('chatbot.archive.pack', side_effect=write_then_pack):
+            self.assertEqual(archive_batch([conversation.id]), (0, 0))
+        self.assertEqual(ChatMessage.objects.filter(conversation=conversation).count(), 4)
+        self.assertFalse(ConversationArchive.objects.exists())
+
+    def test_delete_releases_archived_files(self):
+        conversation, ids = self.old_conversation(count=1)
+        StoredFile.objects.create(sha256='0' * 64, name='chat_files/00/doc.pdf', size=3, ref_count=1)
+        ChatMessage.objects.filter(pk=ids[0]).update(file='chat_files/00/doc.pdf')
+        archive_inactive()
+
+        call_command('rehydrate_conversations', str(conversation.id), stdout=io.StringIO())
+        self.assertEqual(ChatMessage.objects.get(pk=ids[0]).file.name, 'chat_files/00/doc.pdf')
+        self.assertEqual(StoredFile.objects.get().ref_count, 1)
+
+        archive_inactive()
+        with self.captureOnCommitCallbacks(execute=True):
+            conversation.delete()
+        self.assertFalse(StoredFile.objects.exists())
+
+
+class ChatExportTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.first = Conversation.objects.create(user=self.user)
+        self.second = Conversation.objects.create(user=self.user)
+        for i in range(6):
+            ChatMessage.objects.create(
+                user=self.user, conversation=self.first if i % 2 else self.second,
+                message=f'Вопрос {i}', response=f'answer {i}'
+            )
+        other = User.objects.create_user(email='other@example.com', password='testpass123')
+        ChatMessage.objects.create(user=other, conversation=Conversation.objects.create(user=other), message='secret')
+        self.url = '/api/chatbot/export/'
+
+    def export(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = b''.join(response.streaming_content)
+        if params.get('gzip'):
+            self.assertEqual(response['Content-Type'], 'application/gzip')
+            body = gzip.decompress(body)
+        return [json.loads(line) for line in body.decode().splitlines()]
+
+    def test_export_all(self):
+        rows = self.export()
+        self.assertEqual([row['message'] for row in rows], [f'Вопрос {i}' for i in range(6)])
+        self.assertEqual(set(rows[0]), {'id', 'conversation_id', 'message', 'response', 'sentiment', 'status', 'file', 'created_at'})
+        self.assertEqual(self.export(gzip='1'), rows)
+
+    def test_filters_and_resume(self):
+        rows = self.export(conversation=self.first.id)
+        self.assertEqual([row['message'] for row in rows], ['Вопрос 1', 'Вопрос 3', 'Вопрос 5'])
+
+        # Выгрузка частями: каждая продолжается после последнего полученного id
+        resumed = []
+        after = None
+        while True:
+            part = self.export(limit=4, **({'after': after} if after else {}))
+            if not part:
+                break
+            resumed += part
+            after = part[-1]['id']
+        self.assertEqual(resumed, self.export())
+
+        middle = ChatMessage.objects.filter(user=self.user).order_by('id')[2]
+        ChatMessage.objects.filter(pk=middle.pk).update(created_at='2020-01-02T12:00:00Z')
+        rows = self.export(since='2020-01-02', until='2020-01-03')
+        self.assertEqual([row['id'] for row in rows], [middle.id])
+
+        response = self.client.get(self.url, {'since': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'export.ndjson.gz')
+            call_command('export_chats', 'test@example.com', '--conversation', str(self.second.id), '--gzip', '-o', path)
+            with gzip.open(path, 'rt') as f:
+                rows = [json.loads(line) for line in f]
+        self.assertEqual([row['message'] for row in rows], ['Вопрос 0', 'Вопрос 2', 'Вопрос 4'])
+
+    def test_export_includes_archived(self):
+        rows = self.export()
+        archive_batch([self.second.id])
+        self.assertFalse(ChatMessage.objects.filter(conversation=self.second).exists())
+
+        self.assertEqual(self.export(), rows)
+        self.assertEqual(
+            [row['message'] for row in self.export(conversation=self.second.id, after=rows[0]['id'])],
+            ['Вопрос 2', 'Вопрос 4'],
+        )
+        self.assertEqual([row['id'] for row in self.export(limit=3)], [row['id'] for row in rows[:3]])
+
+        # Оба архива: id бесед чередуются, строки сливаются по порядку
+        archive_batch([self.first.id])
+        self.assertEqual(self.export(), rows)
+        self.assertEqual(self.export(after=rows[1]['id'], limit=2), rows[2:4])
+
+
+
+class ChatSearchTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123')
+        self.other = User.objects.create_user(email='other@example.com', password='testpass123')
+        self.conversation = Conversation.objects.create(user=self.user)
+        self.client.force_authenticate(user=self.user)
+        self.url = '/api/chatbot/search/'
+
+    def add(self, message, response, user=None, conversation=None):
+        return ChatMessage.objects.create(
+            user=user or self.user, conversation=conversation or self.conversation, message=message, response=response
+        )
+
+    def search(self, q, **params):
+        response = self.client.get(self.url, {'q': q, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def test_ranked_and_highlighted(self):
+        self.add('Hello', 'Hi! How can I help?')
+        once = self.add('How do I get a permit?', 'You need an appointment for the residence permit.')
+        twice = self.add('Residence permit renewal', 'Residence permit renewal is done at the Ausländerbehörde.')
+
+        results = self.search('residence permit').data['results']
+        self.assertEqual([row['id'] for row in results], [twice.id, once.id])
+        self.assertGreater(results[0]['score'], results[1]['score'])
+        self.assertEqual(results[0]['message'], '<mark>Residence</mark> <mark>permit</mark> renewal')
+        self.assertIn('the <mark>residence</mark> <mark>permit</mark>', results[1]['response'])
+
+    def test_escapes_text_and_query_syntax(self):
+        self.add('What is <script>alert(1)</script>?', 'Not a script tag.')
+        results = self.search('script').data['results']
+        self.assertEqual(results[0]['message'], 'What is &lt;<mark>script</mark>&gt;alert(1)&lt;/<mark>script</mark>&gt;?')
+
+        # Операторы FTS5 и незакрытые кавычки во вводе не ломают запрос
+        self.assertEqual(self.search('script AND OR (NEAR "').data['results'], [])
+        self.assertEqual(len(self.search('scr*').data['results']), 1)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_only_own_messages(self):
+        other_conversation = Conversation.objects.create(user=self.other)
+        self.add('Bank account', 'Open a bank account online.', user=self.other, conversation=other_conversation)
+        mine = self.add('Bank account', 'Bring your passport.')
+        second = self.add('Bank account again', 'Sure.', conversation=Conversation.objects.create(user=self.user))
+
+        self.assertEqual({row['id'] for row in self.search('bank account').data['results']}, {mine.id, second.id})
+        results = self.search('bank account', conversation=self.conversation.id).data['results']
+        self.assertEqual([row['id'] for row in results], [mine.id])
+
+    def test_index_follows_updates_and_deletes(self):
+        chat = self.add('Tax ID', '')
+        self.assertEqual(self.search('Finanzamt').data['results'], [])
+
+        # Ответ дописывается позже (фоновая обработка): индекс обновляет триггер
+        ChatMessage.objects.filter(pk=chat.pk).update(response='The Finanzamt sends it by post.')
+        self.assertEqual(self.search('Finanzamt').data['results'][0]['id'], chat.id)
+
+        chat.delete()
+        self.assertEqual(self.search('Finanzamt').data['results'], [])
+
+    def test_cursor_pagination(self):
+        for i in range(7):
+            self.add(f'Question {i} about kindergarten', 'kindergarten ' * (i + 1))
+        seen = []
+        response = self.search('kindergarten', page_size=3)
+        while True:
+            seen += [row['id'] for row in response.data['results']]
+            self.assertIsNone(response.data['previous'])
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(len(seen), 7)
+        self.assertEqual(len(set(seen)), 7)
+
+        scores = [row['score'] for row in self.search('kindergarten', page_size=7).data['results']]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+    def test_rebuild_command(self):
+        chat = self.add('Health insurance', 'Choose a public or private insurer.')
+        call_command('rebuild_search_index', '--optimize', stdout=open(os.devnull, 'w'))
+        self.assertEqual(self.search('insurer').data['results'][0]['id'], chat.id)
+
+
+class ChatBotStreamingTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.url = '/api/chatbot/chat/?stream=1'
+
+        # Локальный фейковый OpenAI: 10 токенов по 50 мс
+        self.fake = use_fake_llm(self, reply='I am glad to help you with this wonderful question today!', token_delay=0.05)
+        response_cache.clear()
+        reset_conversation_caches()
+
+    def read_events(self, response):
+        body = b''.join(response.streaming_content).decode()
+        events = []
+        for block in body.strip().split('\n\n'):
+            event, data = block.split('\n')
+            events.append((event[len('event: '):], json.loads(data[len('data: '):])))
+        return events
+
+    def test_stream_deltas_and_save_message(self):
+        response = self.client.post(self.url, {'message': 'I am very happy today!'}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+
+        events = self.read_events(response)
+        deltas = [data['delta'] for event, data in events if event == 'delta']
+        self.assertEqual(''.join(deltas), self.fake.reply)
+
+        # Последнее событие содержит сохраненное сообщение
+        event, data = events[-1]
+        self.assertEqual(event, 'done')
+        chat_message = ChatMessage.objects.get()
+        self.assertEqual(data['id'], chat_message.id)
+        self.assertEqual(chat_message.response, self.fake.reply)
+        self.assertEqual(chat_message.sentiment, 'positive')
+
+    def test_time_to_first_byte(self):
+        started = time.monotonic()
+        response = self.client.post(self.url, {'message': 'Привет, бот!'}, format='json')
+        content = iter(response.streaming_content)
+        first_chunk = next(content)
+        first_byte = time.monotonic() - started
+        list(content)
+        total = time.monotonic() - started
+
+        self.assertIn(b'event: delta', first_chunk)
+        # Первый байт приходит задолго до конца генерации
+        self.assertLess(first_byte, total / 3)
+
+    def test_client_disconnect(self):
+        response = self.client.post(self.url, {'message': 'Привет, бот!'}, format='json')
+        content = iter(response.streaming_content)
+        next(content)
+        next(content)
+
+        # Клиент отключился: поток к OpenAI закрыт, частичный ответ сохранен
+        response.close()
+        self.assertTrue(self.fake.streams[0].closed)
+        chat_message = ChatMessage.objects.get()
+        self.assertEqual(chat_message.response, 'I am')
+
+
+class AsyncChatBotTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123')
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+        self.url = '/api/chatbot/chat/async/'
+
+        self.fake = use_fake_llm(self, reply='Glad to help!', token_delay=0.01)
+        response_cache.clear()
+        reset_conversation_caches()
+
+    async def test_async_chat(self):
+        response = await self.async_client.post(
+            self.url, {'message': 'I am very happy today!'}, content_type='application/json',
+            AUTHORIZATION=f'Bearer {self.token}',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(data['response'], 'Glad to help!')
+        self.assertEqual(data['sentiment'], 'positive')
+        self.assertEqual(await ChatMessage.objects.filter(user=self.user).acount(), 1)
+
+        # История беседы уходит в OpenAI на следующем ходу
+        await self.async_client.post(
+            self.url, {'message': 'Еще вопрос'}, content_type='application/json',
+            AUTHORIZATION=f'Bearer {self.token}',
+        )
+        messages = self.fake.calls[-1]['messages']
+        self.assertEqual([m['content'] for m in messages[1:]], ['I am very happy today!', 'Glad to help!', 'Еще вопрос'])
+
+    async def test_async_chat_requires_auth(self):
+        response = await self.async_client.post(self.url, {'message': 'Привет'}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    async def test_async_chat_requires_message(self):
+        response = await self.async_client.post(
+            self.url, {}, content_type='application/json', AUTHORIZATION=f'Bearer {self.token}',
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ContextBudgetTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123')
+        self.conversation = Conversation.objects.create(user=self.user)
+        for i in range(10):
+            ChatMessage.objects.create(
+                user=self.user, conversation=self.conversation,
+                message=f'Question {i} ' + 'x' * 200, response=f'Answer {i} ' + 'y' * 200,
+            )
+        self.conversation.refresh_from_db()
+
+        self.fake = use_fake_llm(self, reply='User asked ten questions.')
+        response_cache.clear()
+        reset_conversation_caches()
+
+    @override_settings(CHATBOT_CONTEXT_TOKEN_BUDGET=400)
+    def test_old_turns_replaced_by_summary(self):
+        context = build_context('New question', self.conversation)
+
+        contents = [m['content'] for m in context.messages]
+        self.assertTrue(contents[1].endswith('User asked ten questions.'))
+        # Дословно остались только последние ходы, и они в хронологическом порядке
+        self.assertTrue(contents[-3].startswith('Question 9'))
+        self.assertTrue(contents[-2].startswith('Answer 9'))
+        self.assertEqual(contents[-1], 'New question')
+        self.assertNotIn('Question 0', ' '.join(contents[2:]))
+        self.assertLessEqual(context.prompt_tokens, 400)
+        self.assertGreater(context.tokens_saved, 0)
+
+        # Summary сохранено в беседе и не пересчитывается на следующем ходу
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.summary, 'User asked ten questions.')
+        self.assertEqual(self.conversation.summarized_until, context.turns[0].id - 1)
+        calls = len(self.fake.calls)
+        build_context('Another question', self.conversation)
+        self.assertEqual(len(self.fake.calls), calls)
+
+    @override_settings(CHATBOT_CONTEXT_TOKEN_BUDGET=600)
+    def test_summary_folds_in_batches(self):
+        build_context('New question', self.conversation)
+        self.assertEqual(len(self.fake.calls), 1)
+        # Свертка оставила запас: следующие ходы помещаются без нового summarize
+        for i in range(10, 12):
+            ChatMessage.objects.create(
+                user=self.user, conversation=self.conversation,
+                message=f'Question {i} ' + 'x' * 200, response=f'Answer {i} ' + 'y' * 200,
+            )
+            context = build_context(f'Question {i + 1}', self.conversation)
+            self.assertEqual(len(self.fake.calls), 1)
+            self.assertLessEqual(context.prompt_tokens, 600)
+
+    @override_settings(CHATBOT_CONTEXT_TOKEN_BUDGET=400)
+    def test_failed_summary_keeps_trimmed_window(self):
+        self.fake.errors = [LLMTimeout('summary timed out')]
+        with self.assertLogs('chatbot.context', 'WARNING'):
+            context = build_context('New question', self.conversation)
+        # Старое summary остается, в контексте — последние ходы в пределах бюджета
+        self.conversation.refresh_from_db()
+        self.assertEqual((self.conversation.summary, self.conversation.summarized_until), ('', 0))
+        contents = [m['content'] for m in context.messages]
+        self.assertTrue(contents[-3].startswith('Question 9'))
+        self.assertNotIn('Question 0', ' '.join(contents))
+        self.assertLessEqual(context.prompt_tokens, 400)
+
+        # Ход через API тоже отвечает, а не падает с 500
+        self.fake.errors = [LLMUnavailable('summary failed')]
+        self.client.force_authenticate(user=self.user)
+        with self.assertLogs('chatbot.context', 'WARNING'):
+            response = self.client.post(
+                '/api/chatbot/chat/', {'message': 'Hi', 'conversation_id': self.conversation.id}, format='json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Следующий ход сворачивает историю, когда модель снова доступна
+        build_context('Another question', self.conversation)
+        self.assertEqual(self.conversation.summary, 'User asked ten questions.')
+
+    @override_settings(CHATBOT_CONTEXT_MAX_TURNS=4, CHATBOT_CONTEXT_TOKEN_BUDGET=100000)
+    def test_turn_window_folds_in_batches(self):
+        build_context('New question', self.conversation)
+        self.assertEqual(len(self.fake.calls), 1)
+        ChatMessage.objects.create(user=self.user, conversation=self.conversation, message='Question 10', response='Answer 10')
+        build_context('Another question', self.conversation)
+        self.assertEqual(len(self.fake.calls), 1)
+
+    @override_settings(CHATBOT_CONTEXT_TOKEN_BUDGET=100000)
+    def test_whole_history_fits(self):
+        with self.assertNumQueries(1):
+            context = build_context('New question', self.conversation)
+
+        self.assertEqual(len(context.messages), 1 + 10 * 2 + 1)
+        self.assertEqual(context.tokens_saved, 0)
+        self.assertEqual(self.fake.calls, [])
+
+    def test_tokens_saved_header(self):
+        self.client.force_authenticate(user=self.user)
+        with self.settings(CHATBOT_CONTEXT_TOKEN_BUDGET=400):
+            response = self.client.post('/api/chatbot/chat/', {'message': 'Привет, бот!'}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(int(response['X-Context-Tokens-Saved']), 0)
+
+    @override_settings(CHATBOT_CONTEXT_TOKEN_BUDGET=100000)
+    def test_next_turn_reads_only_new_turn(self):
+        build_context('New question', self.conversation)
+        ChatMessage.objects.create(user=self.user, conversation=self.conversation, message='Question 10', response='Answer 10')
+
+        with patch('chatbot.prompt.turn_tokens', wraps=turn_tokens) as counted, self.assertNumQueries(1):
+            context = build_context('Another question', self.conversation)
+        # Токены считаются только у нового хода, остальная история — из кэша беседы
+        self.assertEqual(counted.call_count, 1)
+        self.assertEqual(len(context.messages), 1 + 11 * 2 + 1)
+        self.assertEqual([m['content'] for m in context.messages[-3:]], ['Question 10', 'Answer 10', 'Another question'])
+
+    @override_settings(CHATBOT_CONTEXT_TOKEN_BUDGET=100000)
+    def test_edit_and_delete_reset_cached_turns(self):
+        build_context('New question', self.conversation)
+        first, second = self.conversation.chatmessage_set.order_by('id')[:2]
+        first.response = 'Edited answer'
+        first.save()
+        second.delete()
+
+        contents = [m['content'] for m in build_context('New question', self.conversation).messages]
+        self.assertEqual(contents[2], 'Edited answer')
+        self.assertFalse(any(content.startswith('Question 1 ') for content in contents))
+
+    @override_settings(CHATBOT_CONTEXT_TOKEN_BUDGET=100000)
+    def test_reset_in_other_process(self):
+        build_context('New question', self.conversation)
+        first = self.conversation.chatmessage_set.order_by('id').first()
+        # Правка в другом процессе: его кэш ходов сбрасывается, кэш этого процесса — нет
+        ChatMessage.objects.filter(pk=first.pk).update(response='Edited elsewhere')
+        with patch('chatbot.prompt.prompt_cache', ResponseCache(10, 60)):
+            forget_prompt(self.conversation.pk)
+        self.assertIsNotNone(prompt_cache.get(self.conversation.pk))
+
+        contents = [m['content'] for m in build_context('New question', self.conversation).messages]
+        self.assertEqual(contents[2], 'Edited elsewhere')
+
+    @override_settings(CHATBOT_CONTEXT_MAX_TURNS=3)
+    def test_prompt_prefix_keeps_last_turns(self):
+        prefix = PromptPrefix(summarized_until=0)
+        prefix.extend([(1, 'q1', 'a1'), (2, 'q2', 'a2')])
+        # Повтор уже дописанного хода (параллельный запрос) пропускается
+        prefix.extend([(2, 'q2', 'a2'), (3, 'q3', 'a3'), (4, 'q4', 'a4')])
+        self.assertEqual(list(prefix.ids), [2, 3, 4])
+        self.assertEqual(len(prefix.messages), 6)
+
+        prefix.fold(3)
+        turns, messages, used, total = prefix.tail(available=1000)
+        self.assertEqual([turn.id for turn in turns], [4])
+        self.assertEqual(messages, [{'role': 'user', 'content': 'q4'}, {'role': 'assistant', 'content': 'a4'}])
+        self.assertEqual((used, total), (turn_tokens('q4', 'a4'), 1))
+
+
+class ResponseCacheTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123')
+        self.other = User.objects.create_user(email='other@example.com', password='testpass123')
+        self.url = '/api/chatbot/chat/'
+
+        self.fake = use_fake_llm(self, reply='Go to the Bürgeramt.')
+        response_cache.clear()
+        reset_conversation_caches()
+
+    def ask(self, user, message, url=None):
+        self.client.force_authenticate(user=user)
+        response = self.client.post(url or self.url, {'message': message}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def test_first_turn_questions_hit_cache(self):
+        self.ask(self.user, 'How do I register my address?')
+        response = self.ask(self.other, '  how do I register my address ')
+
+        self.assertEqual(len(self.fake.calls), 1)
+        self.assertEqual(response.data['response'], 'Go to the Bürgeramt.')
+        self.assertEqual(response_cache.stats()['hits'], 1)
+        self.assertEqual(response_cache.stats()['misses'], 1)
+
+    def test_history_and_settings_change_key(self):
+        self.ask(self.user, 'How do I register my address?')
+        # У второго пользователя другой тон: ответ не берется из кэша
+        UserSettings.objects.create(user=self.other, tone_of_voice='friendly')
+        self.ask(self.other, 'How do I register my address?')
+        # Тот же вопрос, но уже с историей беседы
+        self.ask(self.user, 'How do I register my address?')
+
+        self.assertEqual(len(self.fake.calls), 3)
+
+    def test_bypass_flag(self):
+        self.ask(self.user, 'Where do I get a tax ID?')
+        self.ask(self.other, 'Where do I get a tax ID?', url=self.url + '?cache=0')
+
+        self.assertEqual(len(self.fake.calls), 2)
+
+    def test_stats_for_admin_only(self):
+        admin = User.objects.create_superuser(email='admin@example.com', password='testpass123')
+        self.client.force_authenticate(user=self.user)
+        self.assertEqual(self.client.get('/api/chatbot/cache/stats/').status_code, status.HTTP_403_FORBIDDEN)
+        self.client.force_authenticate(user=admin)
+        response = self.client.get('/api/chatbot/cache/stats/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('hit_rate', response.data)
+
+    def test_lru_and_ttl(self):
+        cache = ResponseCache(max_size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        # Вытеснен давно не использованный 'b'
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.evictions, 1)
+
+        with patch('chatbot.cache.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get('a'))
+
+
+class BackgroundChatTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.url = '/api/chatbot/chat/?async=1'
+
+        self.fake = use_fake_llm(self, reply='You can register at the local town hall.', first_token_delay=0.5)
+        use_memory_root(self)
+        response_cache.clear()
+        reset_conversation_caches()
+
+    def connection_error(self):
+        return LLMUnavailable('connection error')
+
+    def test_accepted_then_poll(self):
+        started = time.monotonic()
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(self.url, {'message': 'Where do I register my address?'}, format='json')
+
+        # Ответ не ждет модель: сообщение сохранено в статусе pending
+        self.assertLess(time.monotonic() - started, self.fake.first_token_delay)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], 'pending')
+        self.assertEqual(response['Location'], f"/api/chatbot/messages/{response.data['id']}/")
+        self.assertEqual(self.fake.calls, [])
+
+        # Воркер (eager) обрабатывает задачу
+        for callback in callbacks:
+            callback()
+
+        poll = self.client.get(response['Location'])
+        self.assertEqual(poll.status_code, status.HTTP_200_OK)
+        self.assertEqual(poll.data['status'], 'done')
+        self.assertEqual(poll.data['response'], self.fake.reply)
+        self.assertEqual(poll.data['sentiment'], 'neutral')
+        conversation = Conversation.objects.get()
+        self.assertGreater(conversation.history_tokens, 0)
+
+    def test_idempotency_key(self):
+        for expected_status in (status.HTTP_202_ACCEPTED, status.HTTP_200_OK, status.HTTP_200_OK):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(
+                    self.url, {'message': 'Where do I register my address?'}, format='json',
+                    HTTP_IDEMPOTENCY_KEY='request-1'
+                )
+            self.assertEqual(response.status_code, expected_status)
+
+        self.assertEqual(ChatMessage.objects.count(), 1)
+        self.assertEqual(len(self.fake.calls), 1)
+
+        # Тот же ключ в синхронном режиме тоже не создает новое сообщение
+        response = self.client.post(
+            '/api/chatbot/chat/', {'message': 'Where do I register my address?'}, format='json',
+            HTTP_IDEMPOTENCY_KEY='request-1'
+        )
+        self.assertEqual(response.data['id'], ChatMessage.objects.get().id)
+
+    def test_retry_upstream_error(self):
+        self.fake.errors = [self.connection_error(), self.connection_error()]
+        with self.assertLogs('chatbot.tasks', 'WARNING') as logs, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.url, {'message': 'Where do I register my address?'}, format='json')
+        self.assertEqual(len(logs.records), 2)
+
+        chat_message = ChatMessage.objects.get(pk=response.data['id'])
+        self.assertEqual(chat_message.status, ChatMessage.DONE)
+        self.assertEqual(chat_message.response, self.fake.reply)
+        self.assertEqual(len(self.fake.calls), 3)
+
+    def test_failed_after_retries(self):
+        self.fake.errors = [self.connection_error() for _ in range(10)]
+        with self.assertLogs('chatbot.tasks', 'WARNING'), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.url, {'message': 'Where do I register my address?'}, format='json')
+
+        chat_message = ChatMessage.objects.get(pk=response.data['id'])
+        self.assertEqual(chat_message.status, ChatMessage.FAILED)
+        self.assertEqual(len(self.fake.calls), 1 + settings.CHATBOT_TASK_MAX_RETRIES)
+
+        # Неготовые сообщения не попадают в контекст следующих запросов
+        self.fake.errors = []
+        self.client.post('/api/chatbot/chat/', {'message': 'Thanks'}, format='json')
+        self.assertEqual(len(self.fake.calls[-1]['messages']), 2)
+
+
+class ChatBatchTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123')
+        self.client.force_authenticate(user=self.user)
+        self.url = '/api/chatbot/chat/batch/'
+        self.fake = use_fake_llm(self, reply='See the FAQ.')
+        use_memory_root(self)
+        response_cache.clear()
+        reset_conversation_caches()
+
+    def test_items_across_conversations(self):
+        first = Conversation.objects.create(user=self.user)
+        second = Conversation.objects.create(user=self.user)
+        items = [
+            {'message': 'I love this service!', 'conversation_id': first.id},
+            {'message': 'This is terrible.', 'conversation_id': second.id},
+            {'message': 'How do I pay rent?', 'conversation_id': second.id},
+        ]
+        with patch('chatbot.batch.analyze_sentiment_many', wraps=analyze_sentiment_many) as sentiment, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.url, {'items': items}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.data['results']
+        self.assertEqual([result['index'] for result in results], [0, 1, 2])
+        self.assertEqual([result['status'] for result in results], [201, 201, 201])
+        self.assertEqual([result['message']['sentiment'] for result in results], ['positive', 'negative', 'neutral'])
+        self.assertEqual(results[2]['message']['response'], 'See the FAQ.')
+        # Тональность — один вызов на пакет
+        sentiment.assert_called_once()
+
+        # Счетчики бесед учитывают вставку в обход save()
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.message_count, second.message_count), (1, 2))
+        self.assertEqual(second.last_message_preview, message_preview('How do I pay rent?', 'See the FAQ.'))
+        self.assertEqual(TurnMetrics.objects.count(), 3)
+        self.assertEqual(len(user_index(self.user.id)), 3)
+
+    def test_partial_failure(self):
+        other = User.objects.create_user(email='other@example.com', password='testpass123')
+        foreign = Conversation.objects.create(user=other)
+        self.fake.errors = [LLMUnavailable('connection error')]
+        items = [
+            {'message': 'Where is the town hall?'},
+            {'message': ''},
+            {'message': 'Hi', 'conversation_id': foreign.id},
+            {'message': 'Where is the post office?'},
+        ]
+        with override_settings(CHATBOT_BATCH_CONCURRENCY=1):
+            response = self.client.post(self.url, {'items': items}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual([result['status'] for result in response.data['results']], [503, 400, 404, 201])
+        self.assertEqual(list(ChatMessage.objects.values_list('message', flat=True)), ['Where is the post office?'])
+        # Без conversation_id — последняя беседа пользователя (создается при первом сообщении)
+        self.assertEqual(Conversation.objects.get(user=self.user).message_count, 1)
+
+    @override_settings(CHATBOT_BATCH_CONCURRENCY=2)
+    def test_concurrency_limit(self):
+        self.fake.first_token_delay = 0.05
+        active, peak = [0], [0]
+        lock = threading.Lock()
+        complete = self.fake.complete
+
+        def tracked(*args, **kwargs):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            try:
+                return complete(*args, **kwargs)
+            finally:
+                with lock:
+                    active[0] -= 1
+
+        items = [{'message': f'Question number {i}'} for i in range(6)]
+        with patch.object(self.fake, 'complete', side_effect=tracked):
+            response = self.client.post(self.url + '?cache=0', {'items': items}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(peak[0], 2)
+        self.assertEqual(ChatMessage.objects.count(), 6)
+
+    @override_settings(CHATBOT_BATCH_MAX_ITEMS=2)
+    def test_invalid_batch(self):
+        for body in ({}, {'items': []}, {'items': [{'message': 'a'}] * 3}):
+            response = self.client.post(self.url, body, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.fake.calls, [])
+
+
+class SocketClient:
+    """Клиент WebSocket поверх ASGI-приложения: кадры через очереди, чтение можно приостановить."""
+
+    def __init__(self, query_string=b"", path='/api/chatbot/ws/'):
+        self.scope = {'type': 'websocket', 'path': path, 'query_string': query_string, 'headers': []}
+        self.incoming = asyncio.Queue()
+        self.frames = asyncio.Queue()
+        self.reading = asyncio.Event()
+        self.reading.set()
+
+    async def connect(self):
+        self.task = asyncio.create_task(websocket_application(self.scope, self.incoming.get, self.deliver))
+        await self.incoming.put({'type': 'websocket.connect'})
+        return await self.frame()
+
+    async def deliver(self, message):
+        # Пока клиент "не читает", запись сервера блокируется, как при заполненном TCP-буфере
+        await self.reading.wait()
+        await self.frames.put(message)
+
+    async def frame(self, timeout=5):
+        return await asyncio.wait_for(self.frames.get(), timeout)
+
+    async def event(self):
+        frame = await self.frame()
+        assert frame['type'] == 'websocket.send', frame
+        return json.loads(frame['text'])
+
+    async def events_until(self, kind):
+        events = []
+        while not events or events[-1]['type'] != kind:
+            events.append(await self.event())
+        return events
+
+    async def send(self, data):
+        await self.incoming.put({'type': 'websocket.receive', 'text': json.dumps(data)})
+
+    async def close(self):
+        await self.incoming.put({'type': 'websocket.disconnect', 'code': 1000})
+        await asyncio.wait_for(self.task, 5)
+
+
+class WebSocketChatTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123')
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+        self.fake = use_fake_llm(self, reply='Welcome to Lilhome!')
+        use_memory_root(self)
+        response_cache.clear()
+        reset_conversation_caches()
+
+    def client_for(self, token=None):
+        return SocketClient(f"token={token or self.token}".encode())
+
+    async def test_rejects_invalid_token(self):
+        for client in (SocketClient(), self.client_for('not-a-token')):
+            self.assertEqual(await client.connect(), {'type': 'websocket.close', 'code': 4401})
+        client = SocketClient(f"token={self.token}".encode(), path='/api/chatbot/other/')
+        self.assertEqual((await client.connect())['code'], 4404)
+
+    async def test_streamed_reply(self):
+        client = self.client_for()
+        self.assertEqual(await client.connect(), {'type': 'websocket.accept'})
+        self.assertEqual((await client.event())['type'], 'ready')
+
+        await client.send({'type': 'message', 'message': 'Hello there', 'id': 'a1'})
+        events = await client.events_until('done')
+
+        self.assertEqual({event['ref'] for event in events}, {'a1'})
+        kinds = [event['type'] for event in events]
+        self.assertEqual(kinds[:2], ['status', 'typing'])
+        self.assertEqual(kinds[-2:], ['typing', 'done'])
+        self.assertEqual(''.join(event['delta'] for event in events if event['type'] == 'delta'), 'Welcome to Lilhome!')
+        self.assertEqual(events[-1]['message']['response'], 'Welcome to Lilhome!')
+        self.assertGreater(kinds.count('delta'), 1)
+
+        chat = await ChatMessage.objects.aget(pk=events[-1]['message']['id'])
+        self.assertEqual(chat.message, 'Hello there')
+        self.assertEqual((await Conversation.objects.aget(user=self.user)).message_count, 1)
+
+        # Ошибки не закрывают соединение
+        await client.send({'type': 'message', 'message': 'Hi', 'conversation_id': 999999, 'id': 'a2'})
+        self.assertEqual((await client.events_until('error'))[-1]['status'], 404)
+        await client.send({'type': 'ping'})
+        self.assertEqual(await client.event(), {'type': 'pong'})
+        await client.close()
+
+    async def test_streamed_reply_tracks_db_time(self):
+        recorded = []
+        client = self.client_for()
+        with patch.object(TurnStats, 'record', autospec=True, side_effect=lambda stats, chat: recorded.append(stats)):
+            await client.connect()
+            await client.event()
+            await client.send({'type': 'message', 'message': 'Hello there', 'id': 'a1'})
+            await client.events_until('done')
+            await client.close()
+        self.assertEqual(len(recorded), 1)
+        self.assertGreater(recorded[0].db_ms, 0)
+
+    async def test_push_events(self):
+        client = self.client_for()
+        await client.connect()
+        ready = await client.event()
+
+        # Событие от другого соединения доходит, свое — нет
+        broker = get_broker()
+        broker.publish(user_channel(self.user.id), {'type': 'message', 'message': {'id': 1}, 'origin': 'other'})
+        broker.publish(user_channel(self.user.id), {'type': 'message', 'message': {'id': 2}, 'origin': ready['connection']})
+        await client.send({'type': 'ping'})
+        self.assertEqual((await client.event())['message'], {'id': 1})
+        self.assertEqual(await client.event(), {'type': 'pong'})
+
+        await client.close()
+        self.assertEqual(broker.channel_count(), 0)
+
+    @override_settings(CHATBOT_WS_SEND_QUEUE=2)
+    async def test_slow_consumer_is_disconnected(self):
+        client = self.client_for()
+        await client.connect()
+        await client.event()
+
+        client.reading.clear()
+        for i in range(5):
+            get_broker().publish(user_channel(self.user.id), {'type': 'message', 'message': {'id': i}})
+        await asyncio.sleep(0.05)
+        client.reading.set()
+
+        frames = [await client.frame()]
+        while frames[-1]['type'] != 'websocket.close':
+            frames.append(await client.frame())
+        self.assertEqual(frames[-1]['code'], 1013)
+        await asyncio.wait_for(client.task, 5)
+
+    @override_settings(CHATBOT_WS_HEARTBEAT=0.05)
+    async def test_heartbeat_timeout(self):
+        client = self.client_for()
+        await client.connect()
+        frames = [await client.frame()]
+        while frames[-1]['type'] != 'websocket.close':
+            frames.append(await client.frame())
+        self.assertIn({'type': 'ping'}, [json.loads(frame['text']) for frame in frames[:-1]])
+        self.assertEqual(frames[-1]['code'], 4408)
+
+    def test_background_reply_is_pushed(self):
+        events = []
+        unsubscribe = get_broker().subscribe(user_channel(self.user.id), events.append)
+        self.addCleanup(unsubscribe)
+        self.client.force_authenticate(user=self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/chatbot/chat/?async=1', {'message': 'Hi'}, format='json')
+        self.assertEqual([event['message']['id'] for event in events], [response.data['id']])
+        self.assertEqual(events[0]['message']['response'], 'Welcome to Lilhome!')
+
+
+@override_settings(STORAGES=IN_MEMORY_STORAGES, CHATBOT_UPLOAD_MAX_SIZE=1024, CHATBOT_UPLOAD_USER_QUOTA=4096)
+class ChatFileUploadTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.url = '/api/chatbot/chat/'
+
+        self.fake = use_fake_llm(self)
+        use_memory_root(self)
+        response_cache.clear()
+        reset_conversation_caches()
+
+    def upload(self, content, name='document.pdf'):
+        file = SimpleUploadedFile(name, content, content_type='application/pdf')
+        return self.client.post(self.url, {'message': 'Please check my document', 'file': file}, format='multipart')
+
+    def test_identical_content_stored_once(self):
+        self.assertEqual(self.upload(b'residence permit').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.upload(b'residence permit', name='copy.pdf').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.upload(b'rental contract').status_code, status.HTTP_200_OK)
+
+        first, second, third = ChatMessage.objects.order_by('id')
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertNotEqual(first.file.name, third.file.name)
+        self.assertEqual(StoredFile.objects.get(name=first.file.name).ref_count, 2)
+        self.assertEqual(default_storage.open(first.file.name).read(), b'residence permit')
+
+        # Файл удаляется из хранилища вместе с последним сообщением, которое на него ссылается
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(default_storage.exists(second.file.name))
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(default_storage.exists(second.file.name))
+        self.assertFalse(StoredFile.objects.filter(name=second.file.name).exists())
+
+    def test_failed_reply_releases_upload(self):
+        self.assertEqual(self.upload(b'residence permit').status_code, status.HTTP_200_OK)
+        stored = StoredFile.objects.get()
+        self.assertEqual(stored.ref_count, 1)
+
+        # Модель недоступна: сообщение не сохраняется, ссылка на файл снимается
+        self.fake.errors = [LLMUnavailable('connection error')] * 2
+        response = self.upload(b'residence permit', name='copy.pdf')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(StoredFile.objects.get().ref_count, 1)
+
+        # Новое содержимое удаляется из хранилища и не занимает квоту
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.upload(b'rental contract')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(list(StoredFile.objects.values_list('pk', flat=True)), [stored.pk])
+        self.assertEqual(ChatMessage.objects.count(), 1)
+
+    def test_file_too_large(self):
+        response = self.upload(b'x' * 2048)
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertFalse(ChatMessage.objects.exists())
+        self.assertFalse(StoredFile.objects.exists())
+        self.assertEqual(self.fake.calls, [])
+
+    def test_user_quota(self):
+        # Один и тот же файл в двух сообщениях занимает квоту один раз
+        self.assertEqual(self.upload(b'a' * 1000).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.upload(b'a' * 1000).status_code, status.HTTP_200_OK)
+        for content in (b'b', b'c', b'd'):
+            self.assertEqual(self.upload(content * 1000).status_code, status.HTTP_200_OK)
+
+        # Из 4096 байт осталось 96
+        self.assertEqual(self.upload(b'e' * 97).status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(self.upload(b'e' * 96).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.upload(b'f').status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    def test_quota_counts_archived_files(self):
+        for content in (b'a', b'b', b'c', b'd'):
+            self.assertEqual(self.upload(content * 1000).status_code, status.HTTP_200_OK)
+        conversation = Conversation.objects.get(user=self.user)
+        archive_batch([conversation.id])
+        self.assertEqual(len(ConversationArchive.objects.get().files), 4)
+        # Файлы архивной беседы по-прежнему занимают квоту
+        self.assertEqual(self.upload(b'e' * 97).status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(self.upload(b'a' * 96).status_code, status.HTTP_200_OK)
+
+    def test_concurrent_uploads_of_same_content(self):
+        file = SimpleUploadedFile('document.pdf', b'residence permit')
+        digest = hashlib.sha256(b'residence permit').hexdigest()
+        with patch('chatbot.uploads.default_storage.save', wraps=default_storage.save) as save:
+            names = {store_upload(file, digest, 16) for _ in range(3)}
+        # Файл записан один раз, счетчик — по числу загрузок
+        self.assertEqual(save.call_count, 1)
+        self.assertEqual(StoredFile.objects.get(name=names.pop()).ref_count, 3)
+
+        # Вставка, проигравшая гонку, увеличивает счетчик строки победителя
+        digest = hashlib.sha256(b'rental contract').hexdigest()
+        winner = StoredFile.objects.create(sha256=digest, name=f'chat_files/{digest}.pdf', size=15, ref_count=1)
+        with patch('chatbot.uploads.StoredFile.objects.select_for_update') as locked:
+            locked.return_value.filter.return_value.first.side_effect = [None, winner]
+            self.assertEqual(store_upload(SimpleUploadedFile('contract.pdf', b'rental contract'), digest, 15), winner.name)
+        winner.refresh_from_db()
+        self.assertEqual(winner.ref_count, 2)
+
+
+class MemoryTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123')
+        self.client.force_authenticate(user=self.user)
+        self.root = use_memory_root(self)
+        self.fake = use_fake_llm(self, reply='You need an appointment at the Bürgeramt.')
+        self.embedder = HashEmbedder(dim=64)
+        response_cache.clear()
+        reset_conversation_caches()
+
+    def chat(self, message):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/chatbot/chat/', {'message': message}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def test_hash_embedder(self):
+        first, again, similar, other = self.embedder.embed_many([
+            'How do I extend my residence permit?', 'How do I extend my residence permit?',
+            'Residence permit extension documents', 'Best pizza in Berlin',
+        ])
+        self.assertTrue((first == again).all())
+        self.assertAlmostEqual(float(first @ first), 1.0, places=5)
+        self.assertGreater(first @ similar, first @ other)
+
+    def test_index_search(self):
+        index = MemoryIndex(self.root, self.embedder.key, self.embedder.dim)
+        texts = ['residence permit extension', 'open a bank account', 'rent an apartment', 'tax id letter']
+        self.assertEqual(index.add([1, 2, 3, 4], self.embedder.embed_many(texts)), 4)
+        # Повторное добавление тех же сообщений не дублирует строки
+        self.assertEqual(index.add([2, 5], self.embedder.embed_many(['open a bank account', 'bank account card'])), 1)
+        self.assertEqual(len(index), 5)
+
+        query = self.embedder.embed_many(['bank account'])[0]
+        self.assertEqual(sorted(pk for pk, _ in index.search(query, 2)), [2, 5])
+        self.assertEqual(index.search(query, 1, exclude=[2])[0][0], 5)
+
+        # Оборванная запись (вектор без id) не читается и обрезается при следующем добавлении
+        with open(index.vectors_path, 'ab') as file:
+            file.write(b'\0' * 10)
+        self.assertEqual(len(index), 5)
+        index.add([6], self.embedder.embed_many(['kindergarten place']))
+        self.assertEqual(len(index), 6)
+        self.assertEqual(index.vectors_path.stat().st_size, 6 * index.row_bytes)
+
+    def test_relevant_turns_from_other_conversations(self):
+        self.chat('How do I register my address in Berlin?')
+        self.chat('Which documents do I need to open a bank account?')
+        self.assertEqual(len(user_index(self.user.id)), 2)
+
+        # Ходы текущей беседы и так идут в контекст дословно
+        conversation = Conversation.objects.get(user=self.user)
+        self.assertEqual(build_context('Where do I register my address?', conversation).memories, [])
+
+        other = Conversation.objects.create(user=self.user)
+        context = build_context('Where do I register my address?', other)
+        self.assertEqual([msg.message for msg in context.memories], ['How do I register my address in Berlin?'])
+        memory = context.messages[1]['content']
+        self.assertTrue(memory.startswith('Relevant messages'))
+        self.assertIn('You need an appointment at the Bürgeramt.', memory)
+        self.assertNotIn('bank account', memory)
+        self.assertEqual(context.messages[-1]['content'], 'Where do I register my address?')
+
+    def test_recall_skips_deleted_and_other_users(self):
+        first = self.chat('How do I register my address in Berlin?')
+        stranger = User.objects.create_user(email='other@example.com', password='testpass123')
+        self.client.force_authenticate(user=stranger)
+        self.chat('How do I register my address in Berlin?')
+
+        memories = recall(self.user.id, 'register my address')
+        self.assertEqual([msg.id for msg in memories], [first.data['id']])
+        ChatMessage.objects.filter(pk=first.data['id']).delete()
+        self.assertEqual(recall(self.user.id, 'register my address'), [])
+
+    def test_rebuild_command(self):
+        conversation = Conversation.objects.create(user=self.user)
+        # Сообщения, записанные в обход сигналов, в индекс не попадают
+        ChatMessage.objects.bulk_create(
+            ChatMessage(user=self.user, conversation=conversation, message=f'Question {i}', response='Answer')
+            for i in range(5)
+        )
+        self.assertEqual(len(user_index(self.user.id)), 0)
+
+        call_command('rebuild_memory_index', '--batch-size', '2', stdout=open(os.devnull, 'w'))
+        self.assertEqual(len(user_index(self.user.id)), 5)
+
+
+class TurnMetricsTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123')
+        self.other = User.objects.create_user(email='other@example.com', password='testpass123')
+        self.admin = User.objects.create_superuser(email='admin@example.com', password='testpass123')
+        self.fake = use_fake_llm(self, reply='Register within two weeks.', first_token_delay=0.02)
+        use_memory_root(self)
+        response_cache.clear()
+        reset_conversation_caches()
+
+    def chat(self, user, message, url='/api/chatbot/chat/'):
+        self.client.force_authenticate(user=user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, {'message': message}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def test_turn_metrics(self):
+        first = self.chat(self.user, 'How do I register my address?')
+        cached = self.chat(self.other, 'How do I register my address?')
+
+        metrics = TurnMetrics.objects.get(message_id=first.data['id'])
+        self.assertEqual(metrics.model, 'gpt-3.5-turbo')
+        self.assertFalse(metrics.cache_hit)
+        self.assertGreater(metrics.prompt_tokens, 0)
+        self.assertGreater(metrics.completion_tokens, 0)
+        self.assertGreaterEqual(metrics.upstream_ms, 20)
+        self.assertGreater(metrics.db_ms, 0)
+        self.assertGreaterEqual(metrics.total_ms, metrics.upstream_ms)
+
+        # Ответ из кэша: модель не вызывалась, токены не потрачены
+        metrics = TurnMetrics.objects.get(message_id=cached.data['id'])
+        self.assertTrue(metrics.cache_hit)
+        self.assertEqual((metrics.prompt_tokens, metrics.upstream_ms), (0, 0))
+
+    def test_streaming_and_background_turns(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post('/api/chatbot/chat/?stream=1', {'message': 'Hello'}, format='json')
+        with self.captureOnCommitCallbacks(execute=True):
+            b''.join(response.streaming_content)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/chatbot/chat/?async=1', {'message': 'Another question'}, format='json')
+
+        self.assertEqual(TurnMetrics.objects.filter(message__user=self.user).count(), 2)
+        self.assertTrue(all(m.completion_tokens > 0 for m in TurnMetrics.objects.all()))
+        # Потоковый ход сохраняется после выхода из dispatch, время SQL все равно учтено
+        streamed = ChatMessage.objects.get(message='Hello')
+        self.assertGreater(TurnMetrics.objects.get(message=streamed).db_ms, 0)
+
+    def test_rollups(self):
+        for message in ('First question', 'Second question', 'Third question'):
+            self.chat(self.user, message)
+        self.chat(self.other, 'Only question')
+
+        today = ChatMessage.objects.first().created_at.date()
+        usage = DailyUsage.objects.get(day=today, user=self.user)
+        total = DailyUsage.objects.get(day=today, user=None)
+        self.assertEqual((usage.turns, total.turns), (3, 4))
+        self.assertEqual(
+            total.prompt_tokens, sum(TurnMetrics.objects.values_list('prompt_tokens', flat=True))
+        )
+        counts = LatencyHistogram.objects.filter(day=today, user=None, metric=LatencyHistogram.TOTAL)
+        self.assertEqual(sum(counts.values_list('count', flat=True)), 4)
+
+        # Повторная запись хода (повтор задачи) не удваивает сводки
+        message = ChatMessage.objects.filter(user=self.user).first()
+        save_turn_metrics(message, {'prompt_tokens': 1000, 'completion_tokens': 0, 'upstream_ms': 0, 'sentiment_ms': 0,
+                                    'db_ms': 0, 'total_ms': 0, 'cache_hit': False, 'model': ''})
+        self.assertEqual(DailyUsage.objects.get(day=today, user=None).turns, 4)
+
+    def test_percentiles(self):
+        self.assertEqual(latency_bucket(0), 0)
+        for ms in (1, 7, 120, 1500, 30000):
+            # Верхняя граница корзины не меньше значения и больше его не более чем на ~19%
+            upper = bucket_upper_ms(latency_bucket(ms))
+            self.assertGreaterEqual(upper, ms)
+            self.assertLessEqual(upper, ms * 1.2 + 1)
+
+        histogram = [(latency_bucket(100), 90), (latency_bucket(1000), 9), (latency_bucket(5000), 1)]
+        result = percentiles(histogram)
+        self.assertEqual(result['p50'], bucket_upper_ms(latency_bucket(100)))
+        self.assertEqual(result['p95'], bucket_upper_ms(latency_bucket(1000)))
+        self.assertEqual(result['p99'], bucket_upper_ms(latency_bucket(1000)))
+        self.assertEqual(percentiles([]), {'p50': None, 'p95': None, 'p99': None})
+
+    def test_endpoints(self):
+        for message in ('First question', 'Second question'):
+            self.chat(self.user, message)
+        self.chat(self.other, 'Only question')
+
+        self.client.force_authenticate(user=self.user)
+        self.assertEqual(self.client.get('/api/chatbot/metrics/daily/').status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(user=self.admin)
+        daily = self.client.get('/api/chatbot/metrics/daily/').data['results']
+        self.assertEqual(len(daily), 1)
+        self.assertEqual(daily[0]['turns'], 3)
+        self.assertIsNotNone(daily[0]['latency_ms']['total']['p99'])
+
+        daily = self.client.get('/api/chatbot/metrics/daily/', {'user': self.other.id}).data['results']
+        self.assertEqual(daily[0]['turns'], 1)
+
+        report = self.client.get(f'/api/chatbot/metrics/users/{self.user.id}/').data
+        self.assertEqual(report['turns'], 2)
+        self.assertGreaterEqual(report['latency_ms']['upstream']['p50'], 20)
+
+        top = self.client.get('/api/chatbot/metrics/top-users/', {'limit': 1}).data['results']
+        self.assertEqual([row['user__email'] for row in top], ['test@example.com'])
+
+        future = (datetime.date.today() + datetime.timedelta(days=30)).isoformat()
+        self.assertEqual(self.client.get('/api/chatbot/metrics/daily/', {'since': future}).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get('/api/chatbot/metrics/daily/', {'since': 'yesterday'}).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+
+
+class SingleFlightTests(SimpleTestCase):
+    def run_concurrently(self, flight, fn, count=5, timeout=5):
+        results, errors = [], []
+
+        def worker():
+            try:
+                results.append(flight.do('key', fn, timeout))
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=worker) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+    def slow_call(self, calls, delay=0.2, error=None):
+        def fn():
+            calls.append(1)
+            time.sleep(delay)
+            if error:
+                raise error
+            return 'answer'
+        return fn
+
+    def test_concurrent_calls_share_one_upstream_call(self):
+        calls = []
+        results, errors = self.run_concurrently(SingleFlight(), self.slow_call(calls))
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ['answer'] * 5)
+        self.assertEqual(errors, [])
+
+    def test_leader_failure_reaches_every_waiter(self):
+        calls = []
+        results, errors = self.run_concurrently(SingleFlight(), self.slow_call(calls, error=ValueError('upstream down')))
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 5)
+        self.assertTrue(all(isinstance(error, ValueError) for error in errors))
+
+    def test_follower_timeout(self):
+        calls = []
+        results, errors = self.run_concurrently(SingleFlight(), self.slow_call(calls, delay=0.5), count=3, timeout=0.1)
+        self.assertEqual(results, ['answer'])
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(all(isinstance(error, SingleFlightTimeout) for error in errors))
+
+    def test_shared_flight(self):
+        # LocMemCache общий для потоков и имитирует общий кэш между процессами
+        calls = []
+        flight = SharedSingleFlight(poll_interval=0.01)
+        results, errors = self.run_concurrently(flight, self.slow_call(calls))
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ['answer'] * 5)
+
+        calls = []
+        results, errors = self.run_concurrently(flight, self.slow_call(calls, error=ValueError('upstream down')))
+        self.assertEqual(calls, [1])
+        self.assertEqual(len(errors), 5)
+        self.assertEqual(sum(isinstance(error, SingleFlightError) for error in errors), 4)
+
+    def test_async_flight(self):
+        calls = []
+        flight = AsyncSingleFlight()
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return 'answer'
+
+        async def main():
+            return await asyncio.gather(*(flight.do('key', fn, 5) for _ in range(5)))
+
+        self.assertEqual(asyncio.run(main()), ['answer'] * 5)
+        self.assertEqual(calls, [1])
+
+    def test_async_flight_survives_cancelled_leader(self):
+        calls = []
+        flight = AsyncSingleFlight()
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return 'answer'
+
+        async def main():
+            leader = asyncio.ensure_future(flight.do('key', fn, 5))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(flight.do('key', fn, 5))
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            return await follower, leader.cancelled()
+
+        self.assertEqual(asyncio.run(main()), ('answer', True))
+        self.assertEqual(calls, [1])
+
+    def test_async_flight_per_event_loop(self):
+        calls = []
+        flight = AsyncSingleFlight()
+        results, errors = [], []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return 'answer'
+
+        def worker():
+            try:
+                results.append(asyncio.run(flight.do('key', fn, 5)))
+            except Exception as exc:
+                errors.append(exc)
+
+        # Два потока — два event loop: вызовы не ждут future чужого loop
+        threads = [threading.Thread(target=worker) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(results, ['answer'] * 2)
+        self.assertEqual(len(calls), 2)
+
+
+class SentimentTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.engine = LexiconSentiment(lexicon_paths())
+
+    def test_matches_textblob(self):
+        textblob = TextBlobSentiment()
+        samples = [
+            'I am very happy with the service!',
+            'This is not good at all.',
+            'The office was really terrible and the staff were rude :(',
+            'Not bad, thanks :)',
+            'Where do I get a tax ID?',
+            'Great, another broken form (!)',
+            "I don't like waiting in long queues",
+        ]
+        for text in samples:
+            with self.subTest(text=text):
+                self.assertAlmostEqual(self.engine.score(text), textblob.score(text))
+
+    def test_multilingual(self):
+        self.assertEqual(label(self.engine.score('Очень хорошо, спасибо!')), 'positive')
+        self.assertEqual(label(self.engine.score('Это ужасно')), 'negative')
+        self.assertEqual(label(self.engine.score('Das ist sehr gut')), 'positive')
+        self.assertEqual(label(self.engine.score('Es muy malo')), 'negative')
+
+    def test_german_and_french_negation(self):
+        self.assertGreater(self.engine.score('Das ist gut'), 0)
+        self.assertLess(self.engine.score('Das ist nicht gut'), 0)
+        self.assertGreater(self.engine.score('Das ist toll'), 0)
+        # ne … pas: "n'" перед глаголом и местоимения между ними
+        self.assertGreater(self.engine.score("J'aime ça"), 0)
+        self.assertLess(self.engine.score("Je n'aime pas ça"), 0)
+        self.assertLess(self.engine.score("Je ne l'aime pas"), 0)
+        self.assertLess(self.engine.score("Ce n'est pas bon"), 0)
+
+    def test_analyze_sentiment(self):
+        self.assertEqual(analyze_sentiment(''), 'neutral')
+        self.assertEqual(analyze_sentiment(None), 'neutral')
+        self.assertEqual(
+            analyze_sentiment_many(['I love it', 'I hate it', 'Where is the bank?', '']),
+            ['positive', 'negative', 'neutral', 'neutral'],
+        )
+
+
+class LLMBackendTests(SimpleTestCase):
+    messages = [{'role': 'user', 'content': 'Hello'}]
+
+    def test_breaker_opens_and_fails_fast(self):
+        backend = FakeBackend(errors=[LLMUnavailable('down')] * 3)
+        router = LLMRouter([backend], failure_threshold=3, reset_timeout=60)
+        for _ in range(3):
+            with self.assertRaises(LLMUnavailable):
+                router.complete(self.messages)
+        self.assertEqual(router.status()[0]['circuit'], 'open')
+
+        # Открытый breaker отклоняет вызов, не обращаясь к бэкенду
+        with self.assertRaises(LLMUnavailable):
+            router.complete(self.messages)
+        self.assertEqual(len(backend.calls), 3)
+
+    def test_breaker_half_open_probe(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        with patch('chatbot.llm.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertEqual(breaker.state, 'half-open')
+            # Пробный вызов пропускается один
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_fallback_backend(self):
+        primary = FakeBackend(name='primary', error_rate=1.0)
+        fallback = FakeBackend(name='fallback', reply='From fallback.')
+        router = LLMRouter([primary, fallback])
+
+        completion = router.complete(self.messages)
+        self.assertEqual((completion.text, completion.backend), ('From fallback.', 'fallback'))
+        self.assertEqual(''.join(router.stream(self.messages)), 'From fallback.')
+        completion = asyncio.run(router.acomplete(self.messages))
+        self.assertEqual(completion.backend, 'fallback')
+
+    def test_deadline(self):
+        router = LLMRouter([FakeBackend(first_token_delay=0.5)], timeout=0.05)
+        started = time.monotonic()
+        with self.assertRaises(LLMTimeout):
+            router.complete(self.messages)
+        with self.assertRaises(LLMTimeout):
+            asyncio.run(router.acomplete(self.messages))
+        self.assertLess(time.monotonic() - started, 0.5)
+
+    def test_concurrency_limit(self):
+        backend = FakeBackend(first_token_delay=0.2)
+        router = LLMRouter([backend], max_concurrency=2, timeout=0.1)
+        errors = []
+
+        def call():
+            try:
+                router.complete(self.messages, timeout=1)
+            except LLMTimeout as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=call) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        # Оба слота заняты: третий вызов не дожидается слота до дедлайна
+        with self.assertRaises(LLMTimeout):
+            router.complete(self.messages)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(backend.calls), 2)
+
+    def test_seeded_error_rate(self):
+        def outcomes():
+            backend = FakeBackend(error_rate=0.3, seed=7)
+            results = []
+            for _ in range(50):
+                try:
+                    backend.complete(self.messages)
+                    results.append(True)
+                except LLMUnavailable:
+                    results.append(False)
+            return results
+
+        self.assertEqual(outcomes(), outcomes())
+        self.assertIn(False, outcomes())
+
+
+class LLMUnavailableViewTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123')
+        self.client.force_authenticate(user=self.user)
+        self.fake = use_fake_llm(self, error_rate=1.0)
+        response_cache.clear()
+        reset_conversation_caches()
+
+    def test_service_unavailable(self):
+        response = self.client.post('/api/chatbot/chat/', {'message': 'Привет, бот!'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    @override_settings(CHATBOT_LLM_TIMEOUT=0.05)
+    def test_gateway_timeout(self):
+        self.fake = use_fake_llm(self, first_token_delay=0.5)
+        response = self.client.post('/api/chatbot/chat/', {'message': 'Привет, бот!'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_504_GATEWAY_TIMEOUT)
+
+    def test_status_for_admin(self):
+        admin = User.objects.create_superuser(email='admin@example.com', password='testpass123')
+        self.client.force_authenticate(user=admin)
+        response = self.client.get('/api/chatbot/llm/status/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[0]['backend'], 'fake')
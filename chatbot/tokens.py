@@ -0,0 +1,13 @@
+# Грубая оценка числа токенов без токенизатора модели:
+# ~4 байта UTF-8 на токен (латиница ~4 символа, кириллица ~2 символа)
+TURN_OVERHEAD = 8  # служебные токены ролей user/assistant на один ход
+
+
+def estimate_tokens(text):
+    if not text:
+        return 0
+    return len(text.encode('utf-8')) // 4 + 1
+
+
+def turn_tokens(message, response):
+    return estimate_tokens(message) + estimate_tokens(response) + TURN_OVERHEAD
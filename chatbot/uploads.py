@@ -0,0 +1,120 @@
+import hashlib
+import os
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.files.uploadhandler import FileUploadHandler
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q, Sum
+from rest_framework.exceptions import APIException
+
+from .models import ChatMessage, ConversationArchive, StoredFile
+
+UPLOAD_DIR = 'chat_files'
+
+
+class UploadTooLarge(APIException):
+    status_code = 413
+    default_detail = 'File exceeds the upload size limit.'
+    default_code = 'file_too_large'
+
+
+class HashingUploadHandler(FileUploadHandler):
+    """
+    Первый в цепочке обработчиков загрузки: считает sha256 и размер файла по мере чтения запроса
+    и обрывает загрузку, как только превышен лимит, не дочитывая и не буферизуя остаток.
+    Данные передаются дальше стандартным обработчикам Django (память или временный файл).
+    """
+
+    def __init__(self, request=None, limit=None):
+        super().__init__(request)
+        self.limit = limit
+        self.digests = {}  # поле формы -> (sha256, размер)
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.size += len(raw_data)
+        if self.limit is not None and self.size > self.limit:
+            raise UploadTooLarge()
+        self.sha256.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        self.digests[self.field_name] = (self.sha256.hexdigest(), self.size)
+        return None
+
+
+def user_usage(user):
+    """
+    Суммарный размер файлов пользователя, в том числе в архивных беседах (ConversationArchive.files);
+    одинаковые файлы считаются один раз.
+    """
+    names = ChatMessage.objects.filter(user=user).exclude(file='').exclude(file=None).values('file')
+    archived = {
+        name
+        for files in ConversationArchive.objects.filter(conversation__user=user).values_list('files', flat=True)
+        for name in files
+    }
+    return StoredFile.objects.filter(Q(name__in=names) | Q(name__in=archived)).aggregate(total=Sum('size'))['total'] or 0
+
+
+def upload_limit(user):
+    remaining = settings.CHATBOT_UPLOAD_USER_QUOTA - user_usage(user)
+    return max(0, min(settings.CHATBOT_UPLOAD_MAX_SIZE, remaining))
+
+
+def file_digest(file):
+    sha256 = hashlib.sha256()
+    size = 0
+    for chunk in file.chunks():
+        sha256.update(chunk)
+        size += len(chunk)
+    file.seek(0)
+    return sha256.hexdigest(), size
+
+
+def store_upload(file, digest=None, size=None):
+    """
+    Сохраняет загруженный файл в хранилище по адресу его содержимого и возвращает путь для ChatMessage.file.
+    Если такое содержимое уже есть, файл не записывается повторно, а счетчик ссылок увеличивается.
+    """
+    if digest is None:
+        digest, size = file_digest(file)
+    extension = os.path.splitext(file.name)[1].lower()[:16]
+    name = f"{UPLOAD_DIR}/{digest[:2]}/{digest}{extension}"
+
+    # Строка StoredFile фиксируется только вместе с записанным файлом: одновременная загрузка того же
+    # содержимого ждет на блокировке строки (или на уникальном sha256, пока строки еще нет) и видит
+    # уже сохраненный файл. Вставка, проигравшая гонку, повторяется как увеличение счетчика
+    for attempt in range(2):
+        try:
+            with transaction.atomic():
+                stored = StoredFile.objects.select_for_update().filter(sha256=digest).first()
+                if stored is not None:
+                    StoredFile.objects.filter(pk=stored.pk).update(ref_count=F('ref_count') + 1)
+                    return stored.name
+                StoredFile.objects.create(sha256=digest, name=name, size=size, ref_count=1)
+                # Хранилище читает файл кусками: в память целиком он не загружается
+                saved = default_storage.save(name, file)
+                if saved != name:
+                    # Файл с этим содержимым уже лежит в хранилище (например, остался от удаленной строки)
+                    default_storage.delete(saved)
+                return name
+        except IntegrityError:
+            if attempt:
+                raise
+
+
+def release(name):
+    """Уменьшает счетчик ссылок на файл и удаляет его из хранилища, когда ссылок не осталось."""
+    with transaction.atomic():
+        # Строка блокируется до конца транзакции, как в store_upload: счетчик не увеличат, пока файл удаляется
+        StoredFile.objects.select_for_update().filter(name=name).first()
+        StoredFile.objects.filter(name=name, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+        deleted, _ = StoredFile.objects.filter(name=name, ref_count=0).delete()
+    if deleted:
+        transaction.on_commit(lambda: default_storage.delete(name))
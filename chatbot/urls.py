@@ -1,8 +1,19 @@
 from django.urls import path
-from .views import ChatBotView, ChatHistoryView, ConversationListView
+from .views import AsyncChatBotView, ChatBatchView, ChatBotView, ChatExportView, ChatHistoryView, ChatMessageDetailView, ChatSearchView, ConversationActivateView, ConversationListView, LLMStatusView, MetricsDailyView, MetricsUserView, ResponseCacheStatsView, TopConsumersView
 
 urlpatterns = [
     path('chat/', ChatBotView.as_view(), name='chat'),
+    path('chat/async/', AsyncChatBotView.as_view(), name='chat-async'),
+    path('chat/batch/', ChatBatchView.as_view(), name='chat-batch'),
+    path('messages/<int:pk>/', ChatMessageDetailView.as_view(), name='chat-message'),
     path('conversations/', ConversationListView.as_view(), name='conversation-list'),
+    path('conversations/<int:conversation_id>/activate/', ConversationActivateView.as_view(), name='conversation-activate'),
     path('conversations/<int:conversation_id>/messages/', ChatHistoryView.as_view(), name='chat-history'),
+    path('search/', ChatSearchView.as_view(), name='chat-search'),
+    path('export/', ChatExportView.as_view(), name='chat-export'),
+    path('cache/stats/', ResponseCacheStatsView.as_view(), name='response-cache-stats'),
+    path('metrics/daily/', MetricsDailyView.as_view(), name='metrics-daily'),
+    path('metrics/users/<int:user_id>/', MetricsUserView.as_view(), name='metrics-user'),
+    path('metrics/top-users/', TopConsumersView.as_view(), name='metrics-top-users'),
+    path('llm/status/', LLMStatusView.as_view(), name='llm-status'),
 ]
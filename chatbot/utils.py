@@ -1,29 +1,155 @@
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from .cache import response_cache, response_cache_key
+from .context import build_context
+from .llm import get_llm
+from .metrics import TurnStats
+from .singleflight import acoalesce, coalesce
 from .models import ChatMessage, Conversation
-from openai import OpenAI
+from .tokens import estimate_tokens
+import logging
+import time
 
-client = OpenAI(api_key=settings.OPENAI_API_KEY)
+logger = logging.getLogger(__name__)
 
 # Убедись, что в вызове передается conversation_id
 
-def ask_openai(message_text, conversation):
-    # Получаем все сообщения из этой беседы
-    chat_history = conversation.chatmessage_set.order_by('created_at')
+def log_context(conversation, context):
+    logger.info(
+        "conversation %s: %d prompt tokens, %d saved by context budget",
+        conversation.pk, context.prompt_tokens, context.tokens_saved,
+    )
 
-    # Формируем сообщение для OpenAI
-    messages = [{"role": "system", "content": "You are a helpful assistant."}]
-    for msg in chat_history:
-        messages.append({"role": "user", "content": msg.message})
-        messages.append({"role": "assistant", "content": msg.response})
 
-    messages.append({"role": "user", "content": message_text})
+def count_usage(stats, completion):
+    if stats is not None:
+        stats.model = completion.model
+        stats.prompt_tokens = completion.prompt_tokens
+        stats.completion_tokens = completion.completion_tokens
 
-    # Отправка запроса в OpenAI
-    response = client.chat.completions.create(model="gpt-3.5-turbo",
-    messages=messages,
-    temperature=0.9)
 
-    return response.choices[0].message.content.strip()
+def lookup_response(message_text, context, user_id, use_cache, stats):
+    """Ключ кэша ответа и ответ из кэша (None, если его нет). Читает настройки пользователя из БД."""
+    cache_key = response_cache_key(message_text, context, user_id) if use_cache else None
+    if cache_key:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            stats.cache_hit = True
+            return cache_key, cached
+    return cache_key, None
 
 
+def request_response(context, cache_key, stats):
+    """Ответ модели на собранный контекст. Не обращается к БД: можно вызывать из пула потоков."""
+    def request_openai():
+        # Отправка запроса модели (бэкенды из CHATBOT_LLM_BACKENDS)
+        completion = get_llm().complete(context.messages)
+        count_usage(stats, completion)
+        response_text = completion.text.strip()
+        if cache_key:
+            response_cache.set(cache_key, response_text)
+        return response_text
 
+    with stats.timer('upstream_ms'):
+        if not cache_key:
+            return request_openai()
+        # Одинаковые запросы, пришедшие одновременно, ждут один вызов OpenAI
+        return coalesce(cache_key, request_openai)
+
+
+def ask_openai(message_text, conversation, context=None, use_cache=True, stats=None):
+    """stats (TurnStats) — если передан, в него пишутся токены, модель и время ожидания ответа."""
+    # Контекст: последние ходы + summary старых в пределах бюджета токенов
+    if context is None:
+        context = build_context(message_text, conversation)
+    log_context(conversation, context)
+    stats = stats if stats is not None else TurnStats()
+
+    # Одинаковые вопросы с тем же контекстом и настройками отвечаем из кэша
+    cache_key, cached = lookup_response(message_text, context, conversation.user_id, use_cache, stats)
+    if cached is not None:
+        return cached
+    return request_response(context, cache_key, stats)
+
+
+async def ask_openai_async(message_text, conversation, context=None, use_cache=True, stats=None):
+    if context is None:
+        context = await sync_to_async(build_context)(message_text, conversation)
+    log_context(conversation, context)
+    stats = stats if stats is not None else TurnStats()
+
+    cache_key = None
+    if use_cache:
+        cache_key = await sync_to_async(response_cache_key)(message_text, context, conversation.user_id)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            stats.cache_hit = True
+            return cached
+
+    async def request_openai():
+        # Не блокирует поток: пока ждем модель, event loop обслуживает другие запросы
+        completion = await get_llm().acomplete(context.messages)
+        count_usage(stats, completion)
+        response_text = completion.text.strip()
+        if cache_key:
+            response_cache.set(cache_key, response_text)
+        return response_text
+
+    with stats.timer('upstream_ms'):
+        if not cache_key:
+            return await request_openai()
+        return await acoalesce(cache_key, request_openai)
+
+
+def stream_openai(message_text, conversation, context=None, use_cache=True, stats=None):
+    """
+    Генератор кусочков ответа (delta) по мере генерации моделью.
+    При закрытии генератора (например, клиент отключился) закрывает поток к модели.
+    Ответ из кэша отдается одним куском; в кэш попадают только полностью полученные ответы.
+    """
+    if context is None:
+        context = build_context(message_text, conversation)
+    log_context(conversation, context)
+    stats = stats if stats is not None else TurnStats()
+
+    cache_key, cached = lookup_response(message_text, context, conversation.user_id, use_cache, stats)
+    if cached is not None:
+        yield cached
+        return
+    yield from stream_response(context, cache_key, stats)
+
+
+def stream_response(context, cache_key, stats):
+    """Кусочки ответа модели на собранный контекст. Не обращается к БД, как request_response."""
+    router = get_llm()
+    stream = router.stream(context.messages)
+
+    parts = []
+    # Потоковый ответ приходит без usage: токены оцениваются, в upstream — время до последнего кусочка
+    started = time.perf_counter()
+    try:
+        for delta in stream:
+            parts.append(delta)
+            yield delta
+    finally:
+        stream.close()
+        stats.upstream_ms += (time.perf_counter() - started) * 1000
+        stats.model = router.primary.model
+        stats.prompt_tokens = context.prompt_tokens
+        stats.completion_tokens = estimate_tokens("".join(parts))
+
+    if cache_key and parts:
+        response_cache.set(cache_key, "".join(parts).strip())
+
+
+def summarize_turns(summary, turns):
+    """Дополняет summary беседы новыми ходами (список пар вопрос/ответ)."""
+    transcript = "\n".join(f"User: {message}\nAssistant: {response}" for message, response in turns)
+    prompt = (
+        f"Update the summary of a conversation between a user and an assistant. "
+        f"Keep facts about the user, their situation and open questions. "
+        f"Answer with the summary only, at most {settings.CHATBOT_SUMMARY_MAX_TOKENS} tokens.\n\n"
+        f"Current summary:\n{summary or '(empty)'}\n\nNew turns:\n{transcript}"
+    )
+    completion = get_llm().complete([{"role": "user", "content": prompt}], temperature=0)
+    return completion.text.strip()
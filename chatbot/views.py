@@ -1,27 +1,104 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import AuthenticationFailed, NotFound, ValidationError
+from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework import generics
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from .models import ChatMessage, Conversation, UserSettings
-from .serializers import ChatMessageSerializer, ConversationSerializer, UserSettingsSerializer
-from .utils import ask_openai  # Предположим, что у вас есть функция для общения с OpenAI
-from textblob import TextBlob
-import os
-
-def analyze_sentiment(text):
-    blob = TextBlob(text)
-    sentiment = blob.sentiment.polarity
-    # Устанавливаем пороги для положительного и отрицательного настроения
-    if sentiment > 0.1:
-        return "positive"
-    elif sentiment < -0.1:
-        return "negative"
-    else:
-        return "neutral"
+from .routing import activate, resolve_conversation, start_conversation
+from .pagination import KeysetCursorPagination, RecentActivityPagination, SearchCursorPagination
+from .serializers import ChatMessageSerializer, ChatSearchResultSerializer, ConversationSerializer, UserSettingsSerializer
+from .archive import archived_messages
+from .batch import ChatBatch
+from .cache import response_cache
+from .context import build_context
+from .export import encode_blocks, export_rows, ndjson_lines, parse_time
+from .llm import LLMError, LLMTimeout, LLMUnavailable, get_llm
+from .metrics import TurnStats, day_range, daily_report, top_consumers, user_report
+from .search import MessageSearch
+from .sentiment import analyze_sentiment
+from .singleflight import SingleFlightError, SingleFlightTimeout
+from .tasks import process_chat_message
+from .uploads import HashingUploadHandler, release, store_upload, upload_limit
+from .utils import ask_openai, ask_openai_async, stream_openai  # Предположим, что у вас есть функция для общения с OpenAI
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def sse_event(event, data):
+    # Одно событие в формате Server-Sent Events
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def stream_chat(user, conversation, message_text, file_name, sentiment, context, use_cache=True, stats=None):
+    """
+    Отдает ответ модели по кусочкам (SSE) и сохраняет ChatMessage, когда поток закончился.
+    Если клиент отключился, поток к OpenAI закрывается, а полученная часть ответа сохраняется.
+    """
+    parts = []
+    stats = stats if stats is not None else TurnStats()
+    deltas = stream_openai(message_text, conversation, context=context, use_cache=use_cache, stats=stats)
+
+    def save():
+        # Поток отдается после выхода из dispatch, поэтому время сохранения замеряется отдельно
+        with stats.track_db():
+            chat = ChatMessage.objects.create(
+                user=user,
+                conversation=conversation,
+                message=message_text,
+                response="".join(parts).strip(),
+                file=file_name,
+                sentiment=sentiment
+            )
+        stats.record(chat)
+        return chat
+
+    try:
+        for delta in deltas:
+            parts.append(delta)
+            yield sse_event("delta", {"delta": delta})
+    except GeneratorExit:
+        # Клиент закрыл соединение
+        deltas.close()
+        save()
+        raise
+    except Exception:
+        logger.exception("LLM stream failed")
+        deltas.close()
+        chat = save()
+        yield sse_event("error", {"error": "Response generation failed", "id": chat.id})
+        return
+
+    chat = save()
+    yield sse_event("done", ChatMessageSerializer(chat).data)
 
 class ChatBotView(APIView):
     permission_classes = [IsAuthenticated]
 
+    def dispatch(self, request, *args, **kwargs):
+        # Замеры хода (TurnMetrics): время SQL считается за весь запрос
+        self.stats = TurnStats()
+        with self.stats.track_db():
+            return super().dispatch(request, *args, **kwargs)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        # Хэш и лимиты размера файла считаются по мере чтения запроса, до разбора request.data
+        self.upload_handler = None
+        if request.content_type.startswith('multipart/form-data'):
+            self.upload_handler = HashingUploadHandler(request._request, upload_limit(request.user))
+            request._request.upload_handlers.insert(0, self.upload_handler)
+
     def post(self, request):
         user = request.user
         message_text = request.data.get("message")
@@ -30,53 +107,369 @@ class ChatBotView(APIView):
         if not message_text and not file:
             return Response({"error": "Message or file is required"}, status=400)
 
-        # Анализируем настроение
-        sentiment = analyze_sentiment(message_text)
+        # Повтор запроса с тем же Idempotency-Key возвращает уже созданное сообщение
+        idempotency_key = request.headers.get("Idempotency-Key") or None
+        if idempotency_key:
+            existing = ChatMessage.objects.filter(user=user, idempotency_key=idempotency_key).first()
+            if existing is not None:
+                return self.replay(existing)
 
-        # Получаем или создаем разговор для пользователя
-        conversation, created = Conversation.objects.get_or_create(user=user)
+        # Беседа из conversation_id или активная беседа пользователя (создается при первом сообщении)
+        conversation = resolve_conversation(user, request.data.get("conversation_id"))
 
-        # Логика отправки сообщения в OpenAI
-        response_text = ask_openai(message_text, conversation)
-
-        # Сохраняем файл, если он есть
+        # Сохраняем файл, если он есть: в хранилище по sha256 содержимого, дубликаты не записываются
         file_name = None
         if file:
-            # Сохраняем файл в нужную директорию
-            file_name = os.path.join('chat_files', file.name)
-            # сохраняем файл в Media директории
-            with open(os.path.join('media', file_name), 'wb') as f:
-                for chunk in file.chunks():
-                    f.write(chunk)
+            digest = self.upload_handler.digests.get("file") if self.upload_handler else None
+            file_name = store_upload(file, *(digest or ()))
+
+        # До сохранения ChatMessage файл никому не принадлежит: при ошибке ссылка на него снимается
+        try:
+            # ?cache=0 — запросить свежий ответ в обход кэша
+            use_cache = request.query_params.get("cache") not in ("0", "false")
+
+            # Фоновый режим: ?async=1 — ответ 202 сразу, модель вызывает воркер Celery
+            if request.query_params.get("async") in ("1", "true"):
+                return self.enqueue(user, conversation, message_text, file_name, idempotency_key, use_cache)
+
+            # Анализируем настроение
+            with self.stats.timer('sentiment_ms'):
+                sentiment = analyze_sentiment(message_text)
+
+            # Контекст для модели в пределах бюджета токенов
+            context = build_context(message_text, conversation)
+
+            # Потоковый режим: ?stream=1
+            if request.query_params.get("stream") in ("1", "true"):
+                response = StreamingHttpResponse(
+                    stream_chat(user, conversation, message_text, file_name, sentiment, context, use_cache, self.stats),
+                    content_type="text/event-stream",
+                )
+                response["Cache-Control"] = "no-cache"
+                response["X-Accel-Buffering"] = "no"
+                response["X-Context-Tokens-Saved"] = context.tokens_saved
+                return response
+
+            # Логика отправки сообщения в OpenAI
+            try:
+                response_text = ask_openai(message_text, conversation, context=context, use_cache=use_cache, stats=self.stats)
+            except (SingleFlightTimeout, LLMTimeout):
+                return self.discard_upload(file_name, Response({"error": "Response generation timed out"}, status=504))
+            except LLMUnavailable:
+                return self.discard_upload(
+                    file_name, Response({"error": "Response generation is temporarily unavailable"}, status=503)
+                )
+            except (SingleFlightError, LLMError):
+                return self.discard_upload(file_name, Response({"error": "Response generation failed"}, status=502))
+        except Exception:
+            if file_name:
+                release(file_name)
+            raise
 
         # Сохраняем в БД
-        chat = ChatMessage.objects.create(
+        try:
+            with transaction.atomic():
+                chat = ChatMessage.objects.create(
+                    user=user,
+                    conversation=conversation,
+                    message=message_text,
+                    response=response_text,
+                    file=file_name if file else None,
+                    sentiment=sentiment,  # Добавляем настроение
+                    idempotency_key=idempotency_key
+                )
+        except IntegrityError:
+            # Одновременный запрос с тем же ключом сохранил сообщение раньше (или ошибка): файл не нужен
+            if file_name:
+                release(file_name)
+            if not idempotency_key:
+                raise
+            return self.replay(ChatMessage.objects.get(user=user, idempotency_key=idempotency_key))
+
+        self.stats.record(chat)
+        serializer = ChatMessageSerializer(chat)
+        return Response(serializer.data, headers={"X-Context-Tokens-Saved": context.tokens_saved})
+
+    def discard_upload(self, file_name, response):
+        # Ответа нет и сообщение не сохраняется: загруженный файл не должен занимать хранилище и квоту
+        if file_name:
+            release(file_name)
+        return response
+
+    def enqueue(self, user, conversation, message_text, file_name, idempotency_key, use_cache):
+        try:
+            with transaction.atomic():
+                chat = ChatMessage.objects.create(
+                    user=user,
+                    conversation=conversation,
+                    message=message_text or "",
+                    file=file_name,
+                    status=ChatMessage.PENDING,
+                    idempotency_key=idempotency_key
+                )
+        except IntegrityError:
+            if not idempotency_key:
+                raise
+            if file_name:
+                release(file_name)
+            return self.replay(ChatMessage.objects.get(user=user, idempotency_key=idempotency_key))
+
+        # Задача ставится после коммита, чтобы воркер точно увидел сообщение
+        transaction.on_commit(lambda: process_chat_message.delay(chat.id, use_cache))
+        return self.replay(chat)
+
+    def replay(self, chat):
+        # Пока ответа нет — 202 и ссылка, по которой его можно опрашивать
+        headers = {"Location": reverse("chat-message", args=[chat.id])}
+        status_code = 202 if chat.status == ChatMessage.PENDING else 200
+        return Response(ChatMessageSerializer(chat).data, status=status_code, headers=headers)
+
+class ChatBatchView(APIView):
+    """
+    Несколько независимых сообщений за один запрос: {"items": [{"message": ..., "conversation_id": ...}, ...]}.
+    Без conversation_id сообщение попадает в последнюю активную беседу. Результаты — по элементу
+    в порядке запроса со своим статусом; 207, если хотя бы один элемент не удался.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        items = request.data.get("items") if isinstance(request.data, dict) else None
+        if not isinstance(items, list) or not items:
+            return Response({"error": "items must be a non-empty list"}, status=400)
+        if len(items) > settings.CHATBOT_BATCH_MAX_ITEMS:
+            return Response({"error": f"At most {settings.CHATBOT_BATCH_MAX_ITEMS} items per batch"}, status=400)
+
+        use_cache = request.query_params.get("cache") not in ("0", "false")
+        results = ChatBatch(request.user, items, use_cache).run()
+        failed = any(result["status"] != 201 for result in results)
+        return Response({"results": results}, status=207 if failed else 200)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncChatBotView(View):
+    """
+    Асинхронный вариант ChatBotView для ASGI: ожидание OpenAI не занимает поток воркера.
+    Принимает только текст сообщения, файлы отправляются через /chat/.
+    """
+
+    async def authenticate(self, request):
+        try:
+            result = await sync_to_async(JWTAuthentication().authenticate)(request)
+        except AuthenticationFailed:
+            return None
+        return result[0] if result else None
+
+    async def post(self, request):
+        user = await self.authenticate(request)
+        if user is None:
+            return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+
+        if request.content_type == "application/json":
+            try:
+                data = json.loads(request.body or b"{}")
+            except ValueError:
+                return JsonResponse({"error": "Invalid JSON"}, status=400)
+        else:
+            data = request.POST
+        message_text = data.get("message")
+
+        if not message_text:
+            return JsonResponse({"error": "Message is required"}, status=400)
+
+        # Время SQL здесь не замеряется: запросы выполняются в другом потоке (sync_to_async)
+        stats = TurnStats()
+        # Оценка тональности — работа процессора, уводим ее из event loop
+        with stats.timer('sentiment_ms'):
+            sentiment = await sync_to_async(analyze_sentiment, thread_sensitive=False)(message_text)
+
+        try:
+            conversation = await sync_to_async(resolve_conversation)(user, data.get("conversation_id"))
+        except NotFound as exc:
+            return JsonResponse({"detail": str(exc.detail)}, status=404)
+        except ValidationError as exc:
+            return JsonResponse(exc.detail, status=400)
+
+        context = await sync_to_async(build_context)(message_text, conversation)
+        use_cache = request.GET.get("cache") not in ("0", "false")
+        try:
+            response_text = await ask_openai_async(
+                message_text, conversation, context=context, use_cache=use_cache, stats=stats
+            )
+        except (SingleFlightTimeout, LLMTimeout):
+            return JsonResponse({"error": "Response generation timed out"}, status=504)
+        except LLMUnavailable:
+            return JsonResponse({"error": "Response generation is temporarily unavailable"}, status=503)
+        except LLMError:
+            return JsonResponse({"error": "Response generation failed"}, status=502)
+
+        chat = await ChatMessage.objects.acreate(
             user=user,
             conversation=conversation,
             message=message_text,
             response=response_text,
-            file=file_name if file else None,    
-            sentiment=sentiment  # Добавляем настроение
+            sentiment=sentiment
         )
+        await sync_to_async(stats.record)(chat)
 
         serializer = ChatMessageSerializer(chat)
-        return Response(serializer.data)
+        response = JsonResponse(serializer.data)
+        response["X-Context-Tokens-Saved"] = context.tokens_saved
+        return response
+
+class ChatMessageDetailView(generics.RetrieveAPIView):
+    """Сообщение со статусом: сюда клиент опрашивает результат фоновой обработки."""
+    permission_classes = [IsAuthenticated]
+    serializer_class = ChatMessageSerializer
+
+    def get_queryset(self):
+        return ChatMessage.objects.filter(user=self.request.user)
 
 class ChatHistoryView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = ChatMessageSerializer
+    # Страницы от старых сообщений к новым по индексу (conversation, created_at)
+    pagination_class = KeysetCursorPagination
 
     def get_queryset(self):
         user = self.request.user
         conversation_id = self.kwargs['conversation_id']
-        return ChatMessage.objects.filter(conversation__id=conversation_id, user=user).order_by('created_at')
+        messages = ChatMessage.objects.filter(conversation_id=conversation_id, user=user)
+        conversation = Conversation.objects.filter(pk=conversation_id, user=user, archived_at__isnull=False).first()
+        if conversation is not None:
+            # Архивная беседа читается из архива без возврата в основную таблицу (пагинация — в памяти)
+            return archived_messages(conversation) + list(messages)
+        return messages
     
-class ConversationListView(generics.ListAPIView):
+class ConversationListView(generics.ListCreateAPIView):
+    """GET — беседы пользователя; POST — новая беседа, она же становится активной."""
     permission_classes = [IsAuthenticated]
     serializer_class = ConversationSerializer
+    # Сначала разговоры с недавней активностью, по индексу (user, last_message_at)
+    pagination_class = RecentActivityPagination
 
     def get_queryset(self):
-        return Conversation.objects.filter(user=self.request.user).order_by('-created_at')
+        return Conversation.objects.filter(user=self.request.user)
+
+    def perform_create(self, serializer):
+        serializer.instance = start_conversation(self.request.user, serializer.validated_data.get("title", ""))
+
+class ConversationActivateView(APIView):
+    """Делает беседу активной: сообщения без conversation_id пойдут в нее."""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, conversation_id):
+        conversation = Conversation.objects.filter(pk=conversation_id, user=request.user).first()
+        if conversation is None:
+            return Response({"error": "Conversation not found"}, status=404)
+        activate(conversation)
+        return Response(ConversationSerializer(conversation).data)
+
+class ChatSearchView(generics.GenericAPIView):
+    """
+    Поиск по истории чатов пользователя: ?q=вид на жительство, слова через AND,
+    "фраза в кавычках", слово* — по префиксу; ?conversation=<id> — в одном разговоре.
+    Результаты по релевантности, с подсветкой совпадений и курсорной пагинацией.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = ChatSearchResultSerializer
+    pagination_class = SearchCursorPagination
+
+    def get(self, request):
+        query = request.query_params.get("q", "").strip()
+        if not query:
+            return Response({"error": "q is required"}, status=400)
+        try:
+            conversation_id = int(request.query_params["conversation"]) if request.query_params.get("conversation") else None
+        except ValueError:
+            return Response({"error": "conversation must be an integer"}, status=400)
+
+        page = self.paginate_queryset(MessageSearch(request.user, query, conversation_id=conversation_id))
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+class ChatExportView(APIView):
+    """
+    Потоковая выгрузка всех сообщений пользователя в NDJSON, включая архивные беседы;
+    живые сообщения читаются порциями, память не растет с их числом.
+    Фильтры: conversation, since, until; after=<id> продолжает прерванную выгрузку; gzip=1 сжимает поток.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        params = request.query_params
+        try:
+            conversation_id = int(params["conversation"]) if params.get("conversation") else None
+            after = int(params["after"]) if params.get("after") else None
+            limit = int(params["limit"]) if params.get("limit") else None
+        except ValueError:
+            return Response({"error": "conversation, after and limit must be integers"}, status=400)
+
+        rows = export_rows(
+            request.user,
+            limit=limit,
+            conversation_id=conversation_id,
+            since=parse_time(params.get("since"), "since"),
+            until=parse_time(params.get("until"), "until"),
+            after=after,
+        )
+        compress = params.get("gzip") in ("1", "true")
+        response = StreamingHttpResponse(
+            encode_blocks(ndjson_lines(rows), compress=compress),
+            content_type="application/gzip" if compress else "application/x-ndjson",
+        )
+        filename = "chat-export.ndjson.gz" if compress else "chat-export.ndjson"
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+class ResponseCacheStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        # Счетчики кэша ответов текущего процесса
+        return Response(response_cache.stats())
+
+class MetricsDailyView(APIView):
+    """
+    Сводка ходов по дням: токены, доля ответов из кэша, среднее время этапов и p50/p95/p99 задержки.
+    ?since=&until= (даты, по умолчанию 7 дней), ?user=<id> — по одному пользователю.
+    Читает только дневные сводки (DailyUsage, LatencyHistogram), не TurnMetrics.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        since, until = day_range(request.query_params)
+        try:
+            user_id = int(request.query_params["user"]) if request.query_params.get("user") else None
+        except ValueError:
+            return Response({"error": "user must be an integer"}, status=400)
+        return Response({"since": since, "until": until, "user": user_id, "results": daily_report(since, until, user_id)})
+
+class MetricsUserView(APIView):
+    """Итог пользователя за период (?since=&until=) с перцентилями задержки."""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, user_id):
+        since, until = day_range(request.query_params)
+        return Response(user_report(user_id, since, until))
+
+class TopConsumersView(APIView):
+    """Пользователи с наибольшим расходом токенов за период, ?limit= (по умолчанию 10, не больше 100)."""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        since, until = day_range(request.query_params)
+        try:
+            limit = min(int(request.query_params.get("limit", 10)), 100)
+        except ValueError:
+            return Response({"error": "limit must be an integer"}, status=400)
+        return Response({"since": since, "until": until, "results": top_consumers(since, until, limit)})
+
+class LLMStatusView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        # Состояние circuit breaker бэкендов модели в текущем процессе
+        return Response(get_llm().status())
 
 class UserSettingsView(APIView):
     permission_classes = [IsAuthenticated]
@@ -0,0 +1,299 @@
+import asyncio
+import json
+import logging
+import threading
+import uuid
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from .batch import upstream_error
+from .context import build_context
+from .metrics import TurnStats
+from .models import ChatMessage, Conversation
+from .pubsub import get_broker, user_channel
+from .routing import active_conversations
+from .sentiment import analyze_sentiment
+from .serializers import ChatMessageSerializer
+from .utils import log_context, lookup_response, stream_response
+
+logger = logging.getLogger(__name__)
+
+WEBSOCKET_PATH = "/api/chatbot/ws/"
+
+# Коды закрытия: 4xxx — свои, остальные из RFC 6455
+UNAUTHORIZED = 4401
+NOT_FOUND = 4404
+HEARTBEAT_TIMEOUT = 4408
+MESSAGE_TOO_BIG = 1009
+SLOW_CONSUMER = 1013
+
+
+def raw_token(auth, scope):
+    # Браузер не может задать заголовок у WebSocket, поэтому токен можно передать и в ?token=
+    for name, value in scope.get("headers", ()):
+        if name == b"authorization":
+            return auth.get_raw_token(value)
+    token = parse_qs(scope.get("query_string", b"").decode()).get("token")
+    return token[0] if token else None
+
+
+async def authenticate(scope):
+    auth = JWTAuthentication()
+    try:
+        token = raw_token(auth, scope)
+        if not token:
+            return None
+        validated = auth.get_validated_token(token)
+        return await sync_to_async(auth.get_user)(validated)
+    except AuthenticationFailed:
+        return None
+
+
+async def stream_deltas(deltas):
+    """
+    Кусочки синхронного генератора ответа, каждый next() — в пуле потоков, event loop не блокируется.
+    При отмене (клиент отключился) генератор закрывается после завершения текущего next().
+    """
+    loop = asyncio.get_running_loop()
+    step = None
+    try:
+        while True:
+            step = loop.run_in_executor(None, next, deltas, None)
+            delta = await asyncio.shield(step)
+            if delta is None:
+                return
+            yield delta
+    finally:
+        if step is not None and not step.done():
+            await asyncio.wait({step})
+        await loop.run_in_executor(None, deltas.close)
+
+
+class ChatConnection:
+    """
+    Одно WebSocket-подключение пользователя.
+
+    Клиент шлет {"type": "message", "message": ..., "conversation_id"?, "id"?} и получает
+    status/typing/delta/done (или error) с тем же "id" в поле "ref"; готовые сообщения из других
+    вкладок и фоновой обработки приходят событием "message" через брокер pub/sub.
+
+    Все исходящие события идут через ограниченную очередь и одну задачу записи. Свои ответы ждут
+    места в очереди, так что медленный клиент замедляет чтение потока модели; push-события
+    в очередь не ждут, и если она переполнена, соединение закрывается (SLOW_CONSUMER) — клиент
+    переподключается и догоняет историю по HTTP. Простаивающее соединение — две задачи без потоков.
+    """
+
+    def __init__(self, user, receive, send):
+        self.user = user
+        self.receive = receive
+        self.send = send
+        self.id = uuid.uuid4().hex
+        self.loop = asyncio.get_running_loop()
+        self.thread = threading.get_ident()
+        self.outbox = asyncio.Queue(settings.CHATBOT_WS_SEND_QUEUE)
+        self.heartbeat = settings.CHATBOT_WS_HEARTBEAT
+        self.last_seen = self.loop.time()
+        self.replies = set()
+        self.close_code = None
+        self.writer = None
+        self.timer = None
+
+    async def run(self):
+        await self.send({"type": "websocket.accept"})
+        unsubscribe = get_broker().subscribe(user_channel(self.user.pk), self.deliver)
+        reader = asyncio.create_task(self.read())
+        self.writer = asyncio.create_task(self.write())
+        self.push({"type": "ready", "connection": self.id, "heartbeat": self.heartbeat})
+        # Таймер вместо wait_for в задаче записи: простаивающее соединение не создает задач
+        self.timer = self.loop.call_later(self.heartbeat, self.tick)
+        try:
+            await asyncio.wait({reader, self.writer}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self.timer.cancel()
+            unsubscribe()
+            tasks = [reader, self.writer, *self.replies]
+            for task in tasks:
+                task.cancel()
+            for task, result in zip(tasks, await asyncio.gather(*tasks, return_exceptions=True)):
+                if isinstance(result, Exception):
+                    logger.error("websocket %s: %r", self.id, result, exc_info=result)
+        if self.close_code is not None:
+            await self.send({"type": "websocket.close", "code": self.close_code})
+
+    # Исходящие события
+
+    def deliver(self, event):
+        # Вызывается брокером из любого потока; call_soon_threadsafe будит event loop, поэтому
+        # из потока самого loop событие кладется в очередь сразу
+        if event.get("origin") == self.id:
+            return
+        if threading.get_ident() == self.thread:
+            self.push(event)
+        else:
+            self.loop.call_soon_threadsafe(self.push, event)
+
+    def push(self, event):
+        try:
+            self.outbox.put_nowait(event)
+        except asyncio.QueueFull:
+            self.abort(SLOW_CONSUMER)
+
+    async def emit(self, event):
+        await self.outbox.put(event)
+
+    def abort(self, code):
+        if self.close_code is None:
+            self.close_code = code
+            if self.writer is not None:
+                self.writer.cancel()
+
+    def tick(self):
+        # Клиент должен отвечать на ping (или слать что угодно) хотя бы раз за два интервала
+        if self.loop.time() - self.last_seen > 2 * self.heartbeat:
+            return self.abort(HEARTBEAT_TIMEOUT)
+        self.push({"type": "ping"})
+        self.timer = self.loop.call_later(self.heartbeat, self.tick)
+
+    async def write(self):
+        while self.close_code is None:
+            event = await self.outbox.get()
+            await self.send({"type": "websocket.send", "text": json.dumps(event, ensure_ascii=False)})
+
+    # Входящие сообщения
+
+    async def read(self):
+        while True:
+            message = await self.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            if message["type"] != "websocket.receive":
+                continue
+            self.last_seen = self.loop.time()
+            text = message.get("text")
+            if text is None:
+                text = (message.get("bytes") or b"").decode("utf-8", "replace")
+            if len(text) > settings.CHATBOT_WS_MAX_MESSAGE:
+                self.abort(MESSAGE_TOO_BIG)
+                return
+            try:
+                data = json.loads(text)
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                await self.error(None, 400, "Invalid JSON")
+                continue
+
+            kind = data.get("type")
+            if kind == "ping":
+                await self.emit({"type": "pong"})
+            elif kind == "pong":
+                pass
+            elif kind == "message":
+                await self.start_reply(data)
+            else:
+                await self.error(data.get("id"), 400, "Unknown message type")
+
+    async def error(self, ref, status, text):
+        await self.emit({"type": "error", "ref": ref, "status": status, "error": text})
+
+    async def start_reply(self, data):
+        ref = data.get("id")
+        message_text = data.get("message")
+        conversation_id = data.get("conversation_id")
+        if not isinstance(message_text, str) or not message_text.strip():
+            return await self.error(ref, 400, "Message is required")
+        if conversation_id is not None and (isinstance(conversation_id, bool) or not isinstance(conversation_id, int)):
+            return await self.error(ref, 400, "conversation_id must be an integer")
+        if len(self.replies) >= settings.CHATBOT_WS_MAX_INFLIGHT:
+            return await self.error(ref, 429, "Too many messages in flight")
+        use_cache = data.get("cache", True) is not False
+        await self.emit({"type": "status", "ref": ref, "status": "received"})
+        task = asyncio.create_task(self.reply(ref, message_text, conversation_id, use_cache))
+        self.replies.add(task)
+        task.add_done_callback(self.replies.discard)
+
+    async def reply(self, ref, message_text, conversation_id, use_cache):
+        stats = TurnStats()
+        with stats.timer('sentiment_ms'):
+            sentiment = await sync_to_async(analyze_sentiment, thread_sensitive=False)(message_text)
+        conversation = await sync_to_async(self.conversation)(conversation_id)
+        if conversation is None:
+            return await self.error(ref, 404, "Conversation not found")
+
+        context, cache_key, cached = await sync_to_async(self.prepare)(message_text, conversation, use_cache, stats)
+        await self.emit({"type": "typing", "ref": ref, "conversation_id": conversation.id, "typing": True})
+        parts = []
+        try:
+            if cached is not None:
+                parts.append(cached)
+                await self.emit({"type": "delta", "ref": ref, "delta": cached})
+            else:
+                async for delta in stream_deltas(stream_response(context, cache_key, stats)):
+                    parts.append(delta)
+                    await self.emit({"type": "delta", "ref": ref, "delta": delta})
+        except asyncio.CancelledError:
+            # Клиент отключился: полученная часть ответа сохраняется, как в потоковом режиме /chat/
+            if parts:
+                await sync_to_async(self.save)(message_text, conversation, parts, sentiment, stats)
+            raise
+        except Exception as exc:
+            logger.exception("websocket %s: LLM stream failed", self.id)
+            try:
+                status, text = upstream_error(exc)
+            except Exception:
+                status, text = 500, "Response generation failed"
+            data = None
+            if parts:
+                data = await sync_to_async(self.save)(message_text, conversation, parts, sentiment, stats)
+            await self.emit({"type": "typing", "ref": ref, "conversation_id": conversation.id, "typing": False})
+            return await self.emit({
+                "type": "error", "ref": ref, "status": status, "error": text, "id": data["id"] if data else None,
+            })
+
+        data = await sync_to_async(self.save)(message_text, conversation, parts, sentiment, stats)
+        await self.emit({"type": "typing", "ref": ref, "conversation_id": conversation.id, "typing": False})
+        await self.emit({"type": "done", "ref": ref, "message": data})
+
+    # Работа с БД — в потоке Django (sync_to_async), вызовы модели — в пуле потоков
+
+    def conversation(self, conversation_id):
+        if conversation_id is None:
+            return active_conversations.get(self.user)
+        return Conversation.objects.filter(user=self.user, pk=conversation_id).first()
+
+    def prepare(self, message_text, conversation, use_cache, stats):
+        # Время SQL считается здесь и в save: оба выполняются в потоке Django, где стоит execute_wrapper
+        with stats.track_db():
+            context = build_context(message_text, conversation)
+            log_context(conversation, context)
+            cache_key, cached = lookup_response(message_text, context, self.user.pk, use_cache, stats)
+        return context, cache_key, cached
+
+    def save(self, message_text, conversation, parts, sentiment, stats):
+        chat = ChatMessage(
+            user=self.user, conversation=conversation, message=message_text,
+            response="".join(parts).strip(), sentiment=sentiment,
+        )
+        chat.origin = self.id  # это соединение получает ответ событием done, а не message
+        with stats.track_db():
+            chat.save()
+        stats.record(chat)
+        return ChatMessageSerializer(chat).data
+
+
+async def websocket_application(scope, receive, send):
+    """ASGI-приложение для WebSocket-соединений (см. lilhome_backend/asgi.py)."""
+    message = await receive()
+    if message["type"] != "websocket.connect":
+        return
+    # Закрытие до accept сервер отдает клиенту как 403 на рукопожатие
+    if scope["path"] != WEBSOCKET_PATH:
+        return await send({"type": "websocket.close", "code": NOT_FOUND})
+    user = await authenticate(scope)
+    if user is None:
+        return await send({"type": "websocket.close", "code": UNAUTHORIZED})
+    await ChatConnection(user, receive, send).run()
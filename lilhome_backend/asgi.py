@@ -13,4 +13,14 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'lilhome_backend.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Импорт после настройки Django: модулю нужны модели
+from chatbot.websocket import websocket_application  # noqa: E402
+
+
+async def application(scope, receive, send):
+    # WebSocket-чат (/api/chatbot/ws/) обслуживается напрямую, без Django Channels; остальное — Django
+    if scope["type"] == "websocket":
+        return await websocket_application(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -12,11 +12,15 @@ https://docs.djangoproject.com/en/4.0/ref/settings/
 
 from pathlib import Path
 import os
+
+from celery.schedules import crontab
 from dotenv import load_dotenv
 
 load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# Можно направить клиента на совместимый сервер или локальную заглушку
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
 
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -144,7 +148,133 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Загруженные файлы
+MEDIA_URL = 'media/'
+MEDIA_ROOT = BASE_DIR / 'media'
+
+# Файлы хранятся локально в MEDIA_ROOT или в S3 (django-storages), если задан бакет.
+# AWS_S3_ENDPOINT_URL позволяет подставить S3-совместимый сервер (MinIO, localstack) для разработки.
+AWS_STORAGE_BUCKET_NAME = os.getenv("AWS_STORAGE_BUCKET_NAME")
+AWS_S3_ENDPOINT_URL = os.getenv("AWS_S3_ENDPOINT_URL") or None
+AWS_S3_REGION_NAME = os.getenv("AWS_S3_REGION_NAME") or None
+
+STORAGES = {
+    'default': {
+        'BACKEND': (
+            'storages.backends.s3.S3Storage' if AWS_STORAGE_BUCKET_NAME
+            else 'django.core.files.storage.FileSystemStorage'
+        ),
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Chatbot
+
+# Бэкенды модели: первый основной, остальные запасные (если основной недоступен или открыт circuit breaker).
+# CHATBOT_LLM_BACKEND=fake — локальный фейковый бэкенд без сети для нагрузочных прогонов.
+if os.getenv("CHATBOT_LLM_BACKEND") == "fake":
+    CHATBOT_LLM_BACKENDS = [{
+        "BACKEND": "chatbot.fake_llm.FakeBackend",
+        "OPTIONS": {
+            "first_token_delay": float(os.getenv("CHATBOT_FAKE_LLM_LATENCY", 0.2)),
+            "error_rate": float(os.getenv("CHATBOT_FAKE_LLM_ERROR_RATE", 0)),
+        },
+    }]
+else:
+    CHATBOT_LLM_BACKENDS = [{
+        "BACKEND": "chatbot.llm.OpenAIBackend",
+        "OPTIONS": {"model": "gpt-3.5-turbo", "temperature": 0.9, "max_connections": 64},
+    }]
+# Дедлайн одного вызова модели вместе с запасными бэкендами, секунды
+CHATBOT_LLM_TIMEOUT = float(os.getenv("CHATBOT_LLM_TIMEOUT", 30))
+# Одновременных вызовов одного бэкенда на процесс; остальные ждут слот в пределах дедлайна
+CHATBOT_LLM_MAX_CONCURRENCY = int(os.getenv("CHATBOT_LLM_MAX_CONCURRENCY", 32))
+# Circuit breaker: после стольких ошибок подряд бэкенд пропускается на CHATBOT_LLM_BREAKER_RESET секунд
+CHATBOT_LLM_BREAKER_THRESHOLD = 5
+CHATBOT_LLM_BREAKER_RESET = 30
+
+# Бюджет токенов на контекст одного запроса к модели
+CHATBOT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CHATBOT_CONTEXT_TOKEN_BUDGET", 3000))
+# Сколько последних ходов максимум читаем из БД для контекста
+CHATBOT_CONTEXT_MAX_TURNS = 50
+# Ограничение на длину summary старых ходов
+CHATBOT_SUMMARY_MAX_TOKENS = 300
+# Кэш ходов бесед для контекста (в памяти процесса): бесед в кэше и сколько секунд держать запись;
+# сбросы видны другим процессам через номер версии беседы в CHATBOT_CONVERSATION_CACHE
+CHATBOT_PROMPT_CACHE_SIZE = int(os.getenv("CHATBOT_PROMPT_CACHE_SIZE", 2048))
+CHATBOT_PROMPT_CACHE_TTL = int(os.getenv("CHATBOT_PROMPT_CACHE_TTL", 900))  # секунды
+# Кэш ответов модели на повторяющиеся вопросы (в памяти процесса)
+CHATBOT_RESPONSE_CACHE_SIZE = int(os.getenv("CHATBOT_RESPONSE_CACHE_SIZE", 1024))
+CHATBOT_RESPONSE_CACHE_TTL = int(os.getenv("CHATBOT_RESPONSE_CACHE_TTL", 3600))  # секунды
+# Одновременные одинаковые запросы к модели выполняются один раз (single-flight)
+CHATBOT_SINGLEFLIGHT_TIMEOUT = int(os.getenv("CHATBOT_SINGLEFLIGHT_TIMEOUT", 60))  # секунды ожидания ведомых
+# Схлопывать и между процессами через общий кэш (нужен Redis/Memcached в CACHES)
+CHATBOT_SINGLEFLIGHT_SHARED = os.getenv("CHATBOT_SINGLEFLIGHT_SHARED", "false").lower() in ("1", "true")
+CHATBOT_SINGLEFLIGHT_CACHE = "default"
+# Долговременная память: векторы прошлых ходов по пользователям, близкие к новому сообщению
+# ходы добавляются в контекст (в пределах CHATBOT_CONTEXT_TOKEN_BUDGET)
+CHATBOT_MEMORY_ENABLED = os.getenv("CHATBOT_MEMORY_ENABLED", "true").lower() in ("1", "true")
+CHATBOT_MEMORY_ROOT = os.getenv("CHATBOT_MEMORY_ROOT", BASE_DIR / 'var' / 'memory')
+# Модель эмбеддингов: локальная HashEmbedder (без сети) или chatbot.memory.OpenAIEmbedder
+CHATBOT_MEMORY_EMBEDDER = {"BACKEND": "chatbot.memory.HashEmbedder", "OPTIONS": {"dim": 256}}
+CHATBOT_MEMORY_TOP_K = 4
+CHATBOT_MEMORY_MIN_SCORE = 0.3  # минимальная косинусная близость
+# Движок тональности сообщений: "lexicon" (chatbot/lexicons) или прежний "textblob"
+CHATBOT_SENTIMENT_ENGINE = os.getenv("CHATBOT_SENTIMENT_ENGINE", "lexicon")
+# Ограничения на файлы в чате: размер одного файла и суммарный объем файлов пользователя
+CHATBOT_UPLOAD_MAX_SIZE = int(os.getenv("CHATBOT_UPLOAD_MAX_SIZE", 10 * 1024 * 1024))  # байты
+CHATBOT_UPLOAD_USER_QUOTA = int(os.getenv("CHATBOT_UPLOAD_USER_QUOTA", 100 * 1024 * 1024))  # байты
+# Активная беседа пользователя (сообщения без conversation_id): указатель кэшируется в общем
+# кэше CHATBOT_CONVERSATION_CACHE и на CHATBOT_CONVERSATION_LOCAL_CACHE_TTL секунд в памяти процесса
+CHATBOT_CONVERSATION_CACHE = "default"
+CHATBOT_CONVERSATION_CACHE_TTL = int(os.getenv("CHATBOT_CONVERSATION_CACHE_TTL", 600))  # секунды
+CHATBOT_CONVERSATION_LOCAL_CACHE_SIZE = 10000
+CHATBOT_CONVERSATION_LOCAL_CACHE_TTL = 5  # секунды
+# Пакетный чат (chat/batch/): элементов в одном запросе и одновременных вызовов модели на запрос
+CHATBOT_BATCH_MAX_ITEMS = int(os.getenv("CHATBOT_BATCH_MAX_ITEMS", 50))
+CHATBOT_BATCH_CONCURRENCY = int(os.getenv("CHATBOT_BATCH_CONCURRENCY", 8))
+# WebSocket-чат (ws://.../api/chatbot/ws/?token=<access JWT>, lilhome_backend/asgi.py): ping раз
+# в CHATBOT_WS_HEARTBEAT секунд, соединение без входящих кадров дольше двух интервалов закрывается
+CHATBOT_WS_HEARTBEAT = float(os.getenv("CHATBOT_WS_HEARTBEAT", 20))
+CHATBOT_WS_SEND_QUEUE = 256  # исходящих событий в очереди соединения
+CHATBOT_WS_MAX_INFLIGHT = 2  # одновременных ответов на одно соединение
+CHATBOT_WS_MAX_MESSAGE = 64 * 1024  # символов во входящем кадре
+# Рассылка событий подключениям: в памяти процесса; для нескольких процессов — общий брокер с тем же интерфейсом
+CHATBOT_PUBSUB_BACKEND = {"BACKEND": "chatbot.pubsub.InMemoryBroker"}
+# Архив: сообщения бесед без активности дольше CHATBOT_ARCHIVE_AFTER_DAYS дней переносятся в сжатый
+# ConversationArchive пачками (не больше бесед и примерно сообщений в одной транзакции)
+CHATBOT_ARCHIVE_AFTER_DAYS = int(os.getenv("CHATBOT_ARCHIVE_AFTER_DAYS", 180))
+CHATBOT_ARCHIVE_BATCH_SIZE = 100
+CHATBOT_ARCHIVE_BATCH_MESSAGES = 5000
+# Фоновая обработка сообщений (?async=1): повторы при сбоях модели
+CHATBOT_TASK_MAX_RETRIES = int(os.getenv("CHATBOT_TASK_MAX_RETRIES", 3))
+CHATBOT_TASK_RETRY_DELAY = int(os.getenv("CHATBOT_TASK_RETRY_DELAY", 2))  # секунды, удваивается с каждым повтором
+
+
+# Celery
+
+# Без брокера (локально и в тестах) задачи выполняются сразу в процессе
+CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "memory://")
+CELERY_TASK_ALWAYS_EAGER = os.getenv(
+    "CELERY_TASK_ALWAYS_EAGER", "false" if os.getenv("CELERY_BROKER_URL") else "true"
+).lower() in ("1", "true")
+# Задача подтверждается после выполнения: при падении воркера ее получит другой
+CELERY_TASK_ACKS_LATE = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+# Результат хранится в ChatMessage, бэкенд результатов Celery не нужен
+CELERY_TASK_IGNORE_RESULT = True
+# Периодические задачи (celery -A lilhome_backend beat)
+CELERY_BEAT_SCHEDULE = {
+    "archive-inactive-conversations": {
+        "task": "chatbot.tasks.archive_inactive_conversations",
+        "schedule": crontab(hour=3, minute=30),
+    },
+}